@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+"""
+Deploy Benchmark
+
+Runs deploy.py's main() end to end against a generated Django project, with
+stub git, mysql and pip executables whose latency and output volume are
+configurable, and reports the time of every stage over repeated runs:
+- git runs the real git (on a local repository) after the configured delay
+- mysql reads and discards its input, and answers the queries deploy.py makes
+- pip "installs" a minimal fake Django package into the virtualenv
+
+The virtualenvs deploy.py creates run pip from their own bin directory, so a
+python3 wrapper on PATH creates them without pip and puts the stub pip there.
+Nothing is downloaded and no database is needed, so the numbers only depend
+on deploy.py itself and the configured delays.
+
+Usage:
+    python3 bench_deploy.py [--runs N] [--fresh] [--json FILE]
+    python3 bench_deploy.py --baseline FILE [-- <deploy.py options>]
+
+Example:
+    python3 bench_deploy.py --runs 5 --git-latency 0.2 --pip-latency 2
+    python3 bench_deploy.py --runs 3 --json before.json -- --jobs 1
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import deploy
+
+PROJECT_MANAGE = """\
+#!/usr/bin/env python3
+import os
+import sys
+
+if __name__ == "__main__":
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "panorbit.settings")
+    print("Benchmark project, nothing to do for: " + " ".join(sys.argv[1:]))
+"""
+
+PROJECT_SETTINGS = """\
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.mysql",
+        "NAME": "world",
+        "USER": "<mysql-user>",
+        "PASSWORD": "<mysql-password>",
+        "HOST": "<mysql-host>",
+        "PORT": "<mysql-port>",
+    }
+}
+TEMPLATES = [{
+    "BACKEND": "django.template.backends.django.DjangoTemplates",
+    "DIRS": [],
+    "APP_DIRS": True,
+    "OPTIONS": {},
+}]
+STATIC_URL = "/static/"
+"""
+
+FAKE_DJANGO = {
+    "__init__.py": """\
+import importlib
+import os
+
+VERSION = (4, 2, 0, "final", 0)
+
+
+def setup():
+    importlib.import_module(os.environ["DJANGO_SETTINGS_MODULE"])
+""",
+    "core/__init__.py": "",
+    "core/management/__init__.py": """\
+import importlib
+import os
+import shutil
+
+
+def call_command(name, *args, **options):
+    if name == "collectstatic":
+        settings = importlib.import_module(
+            os.environ["DJANGO_SETTINGS_MODULE"])
+        shutil.copytree(os.path.join(os.getcwd(), "assets"),
+                        settings.STATIC_ROOT, dirs_exist_ok=True)
+""",
+}
+
+STUB_PRELUDE = """\
+#!{python}
+import os, shutil, sys, sysconfig, time
+
+time.sleep(float(os.environ.get("BENCH_{name}_LATENCY", "0")))
+for number in range(int(os.environ.get("BENCH_OUTPUT_LINES", "0"))):
+    print("{name}: benchmark output line", number, "." * 60,
+          file=sys.stderr)
+"""
+
+GIT_STUB = """
+os.execv(os.environ["BENCH_REAL_GIT"], ["git"] + sys.argv[1:])
+"""
+
+MYSQL_STUB = """
+args = sys.argv[1:]
+if "--version" in args:
+    print("mysql  Ver 8.0.36 for Linux on x86_64 (benchmark stub)")
+elif "-e" in args:
+    if "django_migrations" in args[args.index("-e") + 1]:
+        print("cities\\t0001_initial")
+    else:
+        print("world.city\\t4079")
+else:
+    while sys.stdin.buffer.read(1024 * 1024):
+        pass
+"""
+
+PIP_STUB = """
+args = sys.argv[1:]
+if args[:1] == ["wheel"]:
+    wheel_dir = args[args.index("--wheel-dir") + 1]
+    os.makedirs(wheel_dir, exist_ok=True)
+    open(os.path.join(wheel_dir, "Django-4.2-py3-none-any.whl"), "w").close()
+elif args[:1] == ["install"]:
+    shutil.copytree(os.environ["BENCH_FAKE_DJANGO"],
+                    os.path.join(sysconfig.get_paths()["purelib"], "django"),
+                    dirs_exist_ok=True)
+    print("Successfully installed Django-4.2")
+else:
+    print("pip stub: unsupported command", args, file=sys.stderr)
+    sys.exit(1)
+"""
+
+PYTHON_WRAPPER = """\
+#!{python}
+import os, subprocess, sys
+
+args = sys.argv[1:]
+if args[:2] != ["-m", "venv"]:
+    os.execv(sys.executable, [sys.executable] + args)
+
+result = subprocess.run([sys.executable, "-m", "venv", "--without-pip"]
+                        + args[2:])
+if result.returncode != 0:
+    sys.exit(result.returncode)
+venv_path = args[-1]
+pip_path = os.path.join(venv_path, "bin", "pip")
+with open(os.environ["BENCH_PIP_STUB"]) as file:
+    source = file.read()
+with open(pip_path, "w") as file:
+    file.write("#!" + os.path.join(os.path.abspath(venv_path), "bin",
+                                   "python3") + source[source.index("\\n"):])
+os.chmod(pip_path, 0o755)
+"""
+
+
+def write_file(path, content, mode=None):
+    """Writes a file, creating its directory; mode makes it executable"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(content)
+    if mode is not None:
+        os.chmod(path, mode)
+
+
+def world_dump(rows):
+    """A mysqldump-like world.sql with extended INSERTs of 500 rows each"""
+    lines = ["SET NAMES utf8;",
+             "DROP TABLE IF EXISTS `city`;",
+             "CREATE TABLE `city` (`id` int NOT NULL, `name` char(35), "
+             "`population` int, PRIMARY KEY (`id`));",
+             "LOCK TABLES `city` WRITE;"]
+    for start in range(1, rows + 1, 500):
+        values = ",".join(f"({row},'City {row}',{row * 37 % 100000})"
+                          for row in range(start, min(start + 500,
+                                                      rows + 1)))
+        lines.append(f"INSERT INTO `city` VALUES {values};")
+    lines.append("UNLOCK TABLES;")
+    return "\n".join(lines) + "\n"
+
+
+def make_project(root, sql_rows=50000, static_files=40):
+    """Creates a bare repository with a v1 tag of a small Django project
+
+    Returns the repository path, to be deployed with --repo-url.
+    """
+    work = os.path.join(root, "project")
+    files = {
+        "manage.py": PROJECT_MANAGE,
+        "requirements.txt": "Django>=4.2,<5.0\n",
+        "world.sql": world_dump(sql_rows),
+        "panorbit/__init__.py": "",
+        "panorbit/settings.py": PROJECT_SETTINGS,
+        "cities/__init__.py": "",
+        "cities/models.py": "# City model\n",
+        "cities/migrations/__init__.py": "",
+        "cities/migrations/0001_initial.py": "# Initial migration\n",
+        "cities/search_indexes.py": "# City search index\n",
+    }
+    for number in range(static_files):
+        suffix = ".css" if number % 2 else ".js"
+        files[f"assets/file{number}{suffix}"] = "".join(
+            f"/* benchmark asset {number}, line {line} */\n"
+            for line in range(100))
+    for name, content in files.items():
+        write_file(os.path.join(work, name), content)
+
+    git = ["git", "-c", "user.name=Benchmark",
+           "-c", "user.email=benchmark@localhost"]
+    repository = os.path.join(root, "upstream.git")
+    for command in (["init", "--quiet", work],
+                    ["-C", work, "add", "--all"],
+                    ["-C", work, "commit", "--quiet", "-m", "Benchmark"],
+                    ["-C", work, "tag", "v1"],
+                    ["clone", "--quiet", "--bare", work, repository]):
+        subprocess.run(git + command, check=True)
+    return repository
+
+
+def install_stubs(root):
+    """Writes the stub executables; returns the directory to put on PATH"""
+    bin_dir = os.path.join(root, "bin")
+    for name, body in (("git", GIT_STUB), ("mysql", MYSQL_STUB),
+                       ("pip", PIP_STUB)):
+        prelude = STUB_PRELUDE.replace("{python}", sys.executable)
+        write_file(os.path.join(bin_dir, name),
+                   prelude.replace("{name}", name.upper()) + body, 0o755)
+    write_file(os.path.join(bin_dir, "python3"),
+               PYTHON_WRAPPER.replace("{python}", sys.executable), 0o755)
+    for name, content in FAKE_DJANGO.items():
+        write_file(os.path.join(root, "fake-django", name), content)
+    return bin_dir
+
+
+def run_deploy(argv, env, cwd, verbose=False):
+    """Runs deploy.main() once with the given arguments and environment
+
+    Returns (exit status, seconds, deploy report, output). The environment
+    and working directory are restored afterwards.
+    """
+    saved_argv, saved_env, saved_cwd = sys.argv, dict(os.environ), os.getcwd()
+    output = io.StringIO()
+    status = 0
+    sys.argv = ["deploy.py"] + argv
+    os.environ.update(env)
+    os.chdir(cwd)
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(sys.stdout if verbose else output):
+            deploy.main()
+    except SystemExit as exit:
+        if exit.code is None or isinstance(exit.code, int):
+            status = exit.code or 0
+        else:
+            status = 1
+    finally:
+        seconds = time.perf_counter() - started
+        sys.argv = saved_argv
+        os.environ.clear()
+        os.environ.update(saved_env)
+        os.chdir(saved_cwd)
+    return status, seconds, deploy.metrics.report(), output.getvalue()
+
+
+def summarize(runs):
+    """Min, median and max seconds of every stage and of the whole deploy"""
+    stages = {}
+    for run in runs:
+        for name, seconds in run["stages"].items():
+            stages.setdefault(name, []).append(seconds)
+    totals = [run["total_seconds"] for run in runs]
+    return {
+        "stages": {name: {"min": min(values),
+                          "median": statistics.median(values),
+                          "max": max(values)}
+                   for name, values in stages.items()},
+        "total": {"min": min(totals), "median": statistics.median(totals),
+                  "max": max(totals)},
+    }
+
+
+def format_summary(summary):
+    """A table with one line per stage, slowest median first"""
+    lines = [f"{'Stage':<28}{'Min (s)':>10}{'Median (s)':>12}{'Max (s)':>10}"]
+    for name, timing in sorted(summary["stages"].items(),
+                               key=lambda item: -item[1]["median"]):
+        lines.append(f"{name:<28}{timing['min']:>10.2f}"
+                     f"{timing['median']:>12.2f}{timing['max']:>10.2f}")
+    total = summary["total"]
+    lines.append(f"{'Total':<28}{total['min']:>10.2f}"
+                 f"{total['median']:>12.2f}{total['max']:>10.2f}")
+    return "\n".join(lines)
+
+
+def compare_baseline(summary, baseline, tolerance=1.25, min_seconds=0.1):
+    """Lists the stages whose median got slower than in a baseline summary
+
+    A stage is slower when its median is more than `tolerance` times the
+    baseline's and at least min_seconds longer. Returns (name, median,
+    baseline median) tuples; "Total" stands for the whole deploy.
+    """
+    timings = dict(summary["stages"], Total=summary["total"])
+    before = dict(baseline["stages"], Total=baseline["total"])
+    slower = []
+    for name, timing in timings.items():
+        if name not in before:
+            continue
+        median, previous = timing["median"], before[name]["median"]
+        if median > previous * tolerance and median - previous >= min_seconds:
+            slower.append((name, median, previous))
+    return slower
+
+
+def parse_arguments(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(
+        description='Benchmark deploy.py with stub git, mysql and pip'
+    )
+    parser.add_argument(
+        '--runs',
+        type=int,
+        default=3,
+        help='Measured deploys (default: 3)'
+    )
+    parser.add_argument(
+        '--warmup',
+        type=int,
+        default=0,
+        help='Deploys run before the measured ones and not counted '
+             '(default: 0)'
+    )
+    parser.add_argument(
+        '--fresh',
+        action='store_true',
+        help='Remove the cache and the deployment before every run, so '
+             'every run is a cold deploy'
+    )
+    parser.add_argument(
+        '--git-latency',
+        type=float,
+        default=0.0,
+        help='Seconds every git command is delayed (default: 0)'
+    )
+    parser.add_argument(
+        '--pip-latency',
+        type=float,
+        default=0.0,
+        help='Seconds every pip command is delayed (default: 0)'
+    )
+    parser.add_argument(
+        '--mysql-latency',
+        type=float,
+        default=0.0,
+        help='Seconds every mysql command is delayed (default: 0)'
+    )
+    parser.add_argument(
+        '--output-lines',
+        type=int,
+        default=0,
+        help='Lines of output each stub command writes (default: 0)'
+    )
+    parser.add_argument(
+        '--sql-rows',
+        type=int,
+        default=50000,
+        help='Rows in the generated world.sql (default: 50000)'
+    )
+    parser.add_argument(
+        '--static-files',
+        type=int,
+        default=40,
+        help='Static files in the generated project (default: 40)'
+    )
+    parser.add_argument(
+        '--work-dir',
+        help='Directory for the project, stubs, cache and deployment, kept '
+             'afterwards (default: a temporary directory)'
+    )
+    parser.add_argument(
+        '--json',
+        help='Write the timings of every run and the summary to this file'
+    )
+    parser.add_argument(
+        '--baseline',
+        help='--json file of an earlier benchmark; exit with status 1 if '
+             'a stage got slower'
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=1.25,
+        help='How many times its baseline median a stage may take '
+             '(default: 1.25)'
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help="Show deploy.py's output"
+    )
+    parser.add_argument(
+        'deploy_args',
+        nargs=argparse.REMAINDER,
+        help='Options passed on to deploy.py, after --'
+    )
+
+    args = parser.parse_args(argv)
+    if args.runs < 1:
+        parser.error("--runs must be at least 1")
+    if args.warmup < 0:
+        parser.error("--warmup cannot be negative")
+    if args.tolerance <= 1:
+        parser.error("--tolerance must be greater than 1")
+    if args.deploy_args[:1] == ['--']:
+        args.deploy_args = args.deploy_args[1:]
+    return args
+
+
+def main(argv=None):
+    """Benchmark workflow; returns the exit status"""
+    args = parse_arguments(argv)
+    real_git = shutil.which("git")
+    if real_git is None:
+        print("Error: Git is not installed")
+        return 1
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench-deploy-")
+    work_dir = os.path.abspath(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        print("Generating the benchmark project...")
+        repository = make_project(work_dir, args.sql_rows, args.static_files)
+        bin_dir = install_stubs(work_dir)
+        app_dir = os.path.join(work_dir, "app")
+        cache_dir = os.path.join(work_dir, "cache")
+        env = {
+            "PATH": bin_dir + os.pathsep + os.environ.get("PATH", ""),
+            "BENCH_REAL_GIT": real_git,
+            "BENCH_PIP_STUB": os.path.join(bin_dir, "pip"),
+            "BENCH_FAKE_DJANGO": os.path.join(work_dir, "fake-django"),
+            "BENCH_GIT_LATENCY": str(args.git_latency),
+            "BENCH_PIP_LATENCY": str(args.pip_latency),
+            "BENCH_MYSQL_LATENCY": str(args.mysql_latency),
+            "BENCH_OUTPUT_LINES": str(args.output_lines),
+            "DEPLOY_DB_PASSWORD": "benchmark",
+        }
+        deploy_args = ["--version", "v1", "--repo-url", repository,
+                       "--app-dir", app_dir, "--cache-dir", cache_dir,
+                       "--db-user", "root", "--db-name", "world",
+                       "--detach", "--no-ready-check"] + args.deploy_args
+
+        runs = []
+        for number in range(args.warmup + args.runs):
+            if args.fresh:
+                shutil.rmtree(app_dir, ignore_errors=True)
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            status, seconds, report, output = run_deploy(
+                deploy_args, env, work_dir, args.verbose)
+            if status != 0:
+                print(output[-4000:])
+                print(f"Error: Deploy {number + 1} failed with status "
+                      f"{status}")
+                return 1
+            warmup = number < args.warmup
+            print(f"Deploy {number + 1}: {seconds:.2f}s"
+                  + (" (warm-up, not counted)" if warmup else ""))
+            if not warmup:
+                runs.append({
+                    "total_seconds": round(seconds, 4),
+                    "stages": {stage["name"]: stage["wall_seconds"]
+                               for stage in report["stages"]},
+                })
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = summarize(runs)
+    print(format_summary(summary))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"options": vars(args), "runs": runs, **summary}, file,
+                      indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        slower = compare_baseline(summary, baseline, args.tolerance)
+        for name, median, previous in slower:
+            print(f"Warning: '{name}' took {median:.2f}s, "
+                  f"{median / previous:.1f}x the baseline's {previous:.2f}s")
+        if slower:
+            return 1
+        print("No stage is slower than in the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
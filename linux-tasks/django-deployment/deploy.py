@@ -12,42 +12,823 @@ This script automates the deployment of a Django application by:
 - Running migrations
 - Starting the development server
 
+Independent steps (version probes, virtualenv creation, cloning, database
+import) run concurrently; see deployment_stages() for the dependency graph.
+
 Usage:
-    python3 deploy.py --version <version>
+    python3 deploy.py --version <version> [--jobs N]
+    python3 deploy.py build --version <version> [--artifact FILE]
+    python3 deploy.py --artifact FILE
+    python3 deploy.py agent [--pool-size N]
+    python3 deploy.py --version <version> --agent-socket PATH
 
 Example:
     python3 deploy.py --version master
     python3 deploy.py --version v1.0.0
 """
 import argparse
+import collections
+import contextlib
+import functools
 import platform
 import sys
 import subprocess
 import re
 import os
+import resource
+import secrets
 import shutil
+import signal
+import socket
+import socketserver
 import getpass
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import sqlite3
+import statistics
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import (ThreadPoolExecutor, wait, as_completed,
+                                FIRST_COMPLETED)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+REPO_URL = "https://github.com/Manisha-Bayya/simple-django-project.git"
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "django-deploy")
+
+SQL_BATCH_ROWS = 10000
+SQL_MAX_STATEMENT_BYTES = 1024 * 1024
+BULK_LOAD_PRELUDE = (
+    "SET autocommit=0;\n"
+    "SET unique_checks=0;\n"
+    "SET foreign_key_checks=0;\n"
+)
+BULK_LOAD_EPILOGUE = (
+    "COMMIT;\n"
+    "SET unique_checks=1;\n"
+    "SET foreign_key_checks=1;\n"
+    "SET autocommit=1;\n"
+)
+
+_SQL_TOKEN = re.compile(
+    r"'[^'\\]*(?:\\.[^'\\]*)*'"
+    r'|"[^"\\]*(?:\\.[^"\\]*)*"'
+    r"|`[^`]*`"
+    r"|[;'\"`#]|--|/\*|\*/", re.DOTALL)
+_SQL_STATEMENT = re.compile(
+    r"(?:[^;'\"`#/\-]+(?![^;'\"`#/\-])"
+    r"|'[^'\\]*(?:\\.[^'\\]*)*'"
+    r'|"[^"\\]*(?:\\.[^"\\]*)*"'
+    r"|`[^`]*`"
+    r"|-(?!-)|/(?!\*))*;", re.DOTALL)
+_SQL_QUOTE_REST = {
+    "'": re.compile(r"[^'\\]*(?:\\.[^'\\]*)*'", re.DOTALL),
+    '"': re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL),
+    "`": re.compile(r"[^`]*`"),
+}
+_SQL_INSERT_PREFIX = re.compile(
+    r"\s*INSERT\s+INTO\s+[^\s(]+\s*(\([^)]*\)\s*)?VALUES\s*",
+    re.IGNORECASE)
+_SQL_ON_DUPLICATE = re.compile(r"\bON\s+DUPLICATE\b", re.IGNORECASE)
+_SQL_TABLE_STATEMENT = re.compile(
+    r"\s*(?:/\*!\d*\s*)?"
+    r"(INSERT(?:\s+IGNORE)?\s+INTO|REPLACE\s+INTO|CREATE\s+TABLE|"
+    r"DROP\s+TABLE|ALTER\s+TABLE|LOCK\s+TABLES|UNLOCK\s+TABLES|SET|USE)\b"
+    r"\s*(?:IF\s+(?:NOT\s+)?EXISTS\s+)?`?([\w$]*)",
+    re.IGNORECASE)
+_SQL_CREATE_TABLE = re.compile(
+    r"CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?`?([\w$]+)",
+    re.IGNORECASE)
+_SQL_KEYS_TOGGLE = re.compile(r"\b(?:DISABLE|ENABLE)\s+KEYS\b",
+                              re.IGNORECASE)
+
+_IMPORT_TIME = re.compile(
+    r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+_DJANGO_SETTINGS = re.compile(
+    r"DJANGO_SETTINGS_MODULE['\"]\s*,\s*['\"]([\w.]+)['\"]")
+MANAGEMENT_RESULT_MARKER = "@@deploy-results@@"
+MANAGEMENT_RUNNER = f"""
+import importlib, json, os, sys, time, traceback
+sys.path.insert(0, os.getcwd())
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", sys.argv[1])
+import django
+from django.core.management import call_command
+django.setup()
+results = []
+for command in json.loads(sys.argv[2]):
+    importlib.invalidate_caches()
+    started = time.monotonic()
+    try:
+        call_command(command["name"], *command["args"], **command["options"])
+        error = None
+    except BaseException as exc:
+        error = "".join(traceback.format_exception(
+            type(exc), exc, exc.__traceback__))[-8000:]
+    results.append({{"command": command["name"], "ok": error is None,
+                     "error": error,
+                     "seconds": time.monotonic() - started}})
+    if error and command["critical"]:
+        break
+# A command's output may not end with a newline; the marker must start a line
+print("\\n{MANAGEMENT_RESULT_MARKER}" + json.dumps(results))
+"""
 
-
-def parse_arguments():
+# name: (description, binary, arguments, minimum version)
+PROBES = {
+    "mysql": ("MySQL", "mysql", ["--version"], (8, 0)),
+    "git": ("Git", "git", ["--version"], None),
+    "venv": ("The Python venv module (python3-venv)", "python3",
+             ["-c", "import ensurepip, sys, venv; "
+                    "print(sys.version.split()[0])"], (3, 7)),
+    "pip": ("pip for new virtualenvs (ensurepip)", "python3",
+            ["-c", "import ensurepip; print(ensurepip.version())"], (19, 0)),
+}
+OS_RELEASE_FILES = ("/etc/os-release", "/usr/lib/os-release")
+STATIC_COMPRESSIBLE = (".css", ".js", ".mjs", ".map", ".json", ".svg",
+                       ".html", ".txt", ".xml", ".ico", ".ttf", ".otf",
+                       ".eot")
+STATIC_MIN_SIZE = 256
+DEFAULT_SETTINGS_PROFILE = {
+    "conn_max_age": 600,
+    "conn_health_checks": True,
+    "caches": {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "django-deploy",
+        },
+    },
+    "cached_templates": True,
+    "session_engine": "django.contrib.sessions.backends.cached_db",
+}
+SETTINGS_FILE = "panorbit/settings.py"
+RENDERED_SETTINGS_MARKER = "# Rendered by deploy.py - do not edit below"
+RENDERED_SETTINGS = RENDERED_SETTINGS_MARKER + """
+import django as _django
+
+# Persistent database connections
+for _database in DATABASES.values():
+    _database["CONN_MAX_AGE"] = {conn_max_age!r}
+    if _django.VERSION >= (4, 1):
+        _database["CONN_HEALTH_CHECKS"] = {conn_health_checks!r}
+
+CACHES = {caches!r}
+SESSION_ENGINE = {session_engine!r}
+
+# Keep compiled templates in memory
+if {cached_templates!r}:
+    for _template in TEMPLATES:
+        if (_template["BACKEND"]
+                == "django.template.backends.django.DjangoTemplates"):
+            _loaders = ["django.template.loaders.filesystem.Loader"]
+            if _template.pop("APP_DIRS", False):
+                _loaders.append(
+                    "django.template.loaders.app_directories.Loader")
+            _template.setdefault("OPTIONS", {{}}).setdefault(
+                "loaders", [("django.template.loaders.cached.Loader",
+                             _loaders)])
+
+# Static files collected with content-hashed names
+STATIC_ROOT = {static_root!r}
+_STATIC_STORAGE = (
+    "django.contrib.staticfiles.storage.ManifestStaticFilesStorage")
+if _django.VERSION >= (4, 2):
+    STORAGES = {{
+        "default": {{
+            "BACKEND": "django.core.files.storage.FileSystemStorage"}},
+        "staticfiles": {{"BACKEND": _STATIC_STORAGE}},
+    }}
+else:
+    STATICFILES_STORAGE = _STATIC_STORAGE
+"""
+ARTIFACT_MANIFEST = "manifest.json"
+AGENT_EXIT_MARKER = "@@deploy-exit@@"
+STREAM_TAIL_LINES = 200
+STREAM_MAX_LINE = 64 * 1024
+SECRET_INPUTS = {"db_password"}
+
+_active_processes = set()
+_active_processes_lock = threading.Lock()
+_cancel_event = threading.Event()
+_stage_state = threading.local()
+_step_timeouts = {}
+
+
+class StageCancelled(Exception):
+    """Raised inside a stage whose command was stopped by a failing sibling"""
+
+
+class Stage:
+    """A deployment step that declares the names it consumes and produces"""
+
+    def __init__(self, name, func, inputs=(), outputs=(), after=()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.after = tuple(after)
+
+    def run(self, context):
+        """Call the step with its inputs and return its outputs as a dict"""
+        with measure_stage(self.name):
+            result = self.func(*[context[name] for name in self.inputs])
+        if not self.outputs:
+            return {}
+        if len(self.outputs) == 1:
+            return {self.outputs[0]: result}
+        return dict(zip(self.outputs, result))
+
+
+class MeasuredPopen(subprocess.Popen):
+    """Popen that keeps the resource usage of the child when reaping it
+
+    Popen reaps its child with os.waitpid(), which throws the rusage of the
+    child away; os.wait4() returns it, so the usage of this one process is
+    known even when several commands run at the same time.
+
+    This overrides Popen._try_wait(), a private CPython method used by
+    wait() (and so by communicate() and the context manager exit), but not
+    by poll(). tracked_process() only ever waits for its commands; if the
+    child is reaped some other way, rusage stays None and the command is
+    recorded without CPU time and peak RSS.
+    """
+
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+        if pid == self.pid:
+            self.rusage = rusage
+        return pid, status
+
+
+class DeployMetrics:
+    """Wall time, CPU time and peak RSS of every stage and command"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far and restart the clock"""
+        with self.lock:
+            self.started_at = time.time()
+            self.started = time.perf_counter()
+            self.stages = []
+            self.commands = []
+            self.extra = {}
+
+    def add(self, name, value):
+        """Adds a named section, e.g. an import time profile, to the report"""
+        with self.lock:
+            self.extra[name] = value
+
+    def record_command(self, args, seconds, returncode, rusage=None):
+        """Remember one finished command, attributed to the current stage"""
+        entry = {
+            "stage": getattr(_stage_state, "name", None),
+            "command": command_label(args),
+            "returncode": returncode,
+            "wall_seconds": round(seconds, 4),
+            "cpu_seconds": None,
+            "max_rss_kb": None,
+        }
+        if rusage is not None:
+            entry["cpu_seconds"] = round(rusage.ru_utime + rusage.ru_stime, 4)
+            entry["max_rss_kb"] = rusage.ru_maxrss
+        with self.lock:
+            self.commands.append(entry)
+
+    def record_stage(self, name, seconds, cpu_seconds, status):
+        """Remember one stage, adding up the usage of its commands"""
+        with self.lock:
+            commands = [entry for entry in self.commands
+                        if entry["stage"] == name]
+            self.stages.append({
+                "name": name,
+                "status": status,
+                "wall_seconds": round(seconds, 4),
+                "cpu_seconds": round(cpu_seconds + sum(
+                    entry["cpu_seconds"] or 0 for entry in commands), 4),
+                "max_rss_kb": max([entry["max_rss_kb"] or 0
+                                   for entry in commands], default=0),
+                "commands": len(commands),
+            })
+
+    def report(self):
+        """The recorded metrics as a JSON-serialisable dict"""
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        with self.lock:
+            return {
+                "started_at": self.started_at,
+                "wall_seconds": round(time.perf_counter() - self.started, 4),
+                "deploy_process": {
+                    "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 4),
+                    "max_rss_kb": usage.ru_maxrss,
+                },
+                "stages": list(self.stages),
+                "commands": list(self.commands),
+                **self.extra,
+            }
+
+    def summary(self):
+        """A table with one line per stage, slowest stages first"""
+        report = self.report()
+        lines = [f"{'Stage':<28}{'Status':>10}{'Wall (s)':>10}"
+                 f"{'CPU (s)':>10}{'Peak RSS (MB)':>15}"]
+        for stage in sorted(report["stages"],
+                            key=lambda stage: -stage["wall_seconds"]):
+            lines.append(f"{stage['name']:<28}{stage['status']:>10}"
+                         f"{stage['wall_seconds']:>10.2f}"
+                         f"{stage['cpu_seconds']:>10.2f}"
+                         f"{stage['max_rss_kb'] / 1024:>15.1f}")
+        lines.append(f"{'Total':<28}{'':>10}{report['wall_seconds']:>10.2f}")
+        return "\n".join(lines)
+
+
+metrics = DeployMetrics()
+
+
+def command_label(args, limit=60):
+    """A short, password-free description of a command for reports"""
+    parts = [os.path.basename(str(args[0]))]
+    for arg in args[1:]:
+        arg = str(arg)
+        if arg.startswith("-p") and len(arg) > 2:
+            arg = "-p***"
+        if len(arg) > limit or "\n" in arg:
+            arg = arg.splitlines()[0][:limit] + "..."
+        parts.append(arg)
+    return " ".join(parts)
+
+
+@contextlib.contextmanager
+def measure_stage(name):
+    """Time a stage running in the current thread and record its metrics"""
+    started = time.perf_counter()
+    _stage_state.name = name
+    _stage_state.started = started
+    cpu_started = time.thread_time()
+    status = "failed"
+    try:
+        yield
+        status = "ok"
+    except StageCancelled:
+        status = "cancelled"
+        raise
+    finally:
+        _stage_state.name = None
+        metrics.record_stage(name, time.perf_counter() - started,
+                             time.thread_time() - cpu_started, status)
+
+
+def stage_bound(func):
+    """Wraps func to run in the current stage from any thread
+
+    The stage is kept per thread, so without this the commands of a nested
+    executor's workers would not be attributed to the stage and would not
+    see its step timeout.
+    """
+    name = getattr(_stage_state, "name", None)
+    started = getattr(_stage_state, "started", None)
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        _stage_state.name = name
+        _stage_state.started = started
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _stage_state.name = None
+
+    return run
+
+
+def parse_arguments(argv=None):
     """Parse command-line arguments"""
     parser = argparse.ArgumentParser(description='Deploy Django application')
 
+    parser.add_argument(
+        'command',
+        nargs='?',
+        choices=['deploy', 'build', 'agent'],
+        default='deploy',
+        help='deploy: deploy the application (default); build: build a '
+             'release artifact with the code and a populated virtualenv; '
+             'agent: serve deploys on a Unix socket with warm virtualenvs'
+    )
     parser.add_argument(
         '--version',
-        required=True,
         help='Application version to deploy (e.g., v1.0.0, main, commit-hash)'
     )
+    parser.add_argument(
+        '--artifact',
+        help='build: where to write the release artifact (default: '
+             '<version>.tar.gz); deploy: unpack and verify this artifact '
+             'instead of cloning and installing dependencies'
+    )
+    parser.add_argument(
+        '--releases',
+        action='store_true',
+        help='Build each deploy in its own release directory and switch '
+             'the current symlink to it once it is ready'
+    )
+    parser.add_argument(
+        '--keep-releases',
+        type=int,
+        default=5,
+        help='Number of release directories kept for rollbacks (default: 5)'
+    )
+    parser.add_argument(
+        '--rollback',
+        action='store_true',
+        help='Switch back to the previous release instead of deploying'
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=4,
+        help='Maximum number of deployment stages run at once (default: 4)'
+    )
+    parser.add_argument(
+        '--app-dir',
+        help='Deployment directory (default: project-dir, or build-dir '
+             'when building an artifact)'
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Keep the deployment directory and reuse the virtualenv, '
+             'checkout and installed packages when they are still valid'
+    )
+    parser.add_argument(
+        '--repo-url',
+        default=REPO_URL,
+        help='Git repository to deploy from (default: the GitHub project)'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=DEFAULT_CACHE_DIR,
+        help=f'Directory for caches kept between deploys '
+             f'(default: {DEFAULT_CACHE_DIR})'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not read or write any cache'
+    )
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        help='Install dependencies only from cached wheels and fail if '
+             'they are missing'
+    )
+    parser.add_argument(
+        '--sql-batch-rows',
+        type=int,
+        default=SQL_BATCH_ROWS,
+        help=f'Rows per transaction when importing world.sql '
+             f'(default: {SQL_BATCH_ROWS})'
+    )
+    parser.add_argument(
+        '--sql-jobs',
+        type=int,
+        default=1,
+        help='Number of tables imported at the same time over separate '
+             'MySQL connections (default: 1)'
+    )
+    parser.add_argument(
+        '--force-import',
+        action='store_true',
+        help='Import world.sql even if the database already matches it'
+    )
+    parser.add_argument(
+        '--force-migrate',
+        action='store_true',
+        help='Run makemigrations and migrate even if nothing changed'
+    )
+    parser.add_argument(
+        '--index-workers',
+        type=int,
+        default=0,
+        help='Worker processes used to update the search index '
+             '(default: 0, index in the main process)'
+    )
+    parser.add_argument(
+        '--index-batch-size',
+        type=int,
+        default=None,
+        help='Records indexed per batch (default: Haystack default)'
+    )
+    parser.add_argument(
+        '--full-reindex',
+        action='store_true',
+        help='Rebuild the whole search index instead of updating it'
+    )
+    parser.add_argument(
+        '--server',
+        choices=['runserver', 'gunicorn'],
+        default='runserver',
+        help='runserver: Django development server (default); gunicorn: '
+             'pre-fork WSGI server with a pool of worker processes'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8001,
+        help='Port the application listens on (default: 8001)'
+    )
+    parser.add_argument(
+        '--instances',
+        type=int,
+        default=1,
+        help='Number of server instances, on consecutive ports from --port '
+             '(default: 1)'
+    )
+    parser.add_argument(
+        '--no-cpu-pinning',
+        action='store_true',
+        help='Do not pin each instance to its own set of CPUs'
+    )
+    parser.add_argument(
+        '--upstream-conf',
+        help='nginx upstream file written for several instances '
+             '(default: <app-dir>/nginx-upstream.conf)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='gunicorn worker processes per instance '
+             '(default: 2 x CPUs + 1)'
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=1,
+        help='Threads per gunicorn worker (default: 1)'
+    )
+    parser.add_argument(
+        '--max-requests',
+        type=int,
+        default=1000,
+        help='Restart a gunicorn worker after this many requests, '
+             '0 disables it (default: 1000)'
+    )
+    parser.add_argument(
+        '--pid-file',
+        default='gunicorn.pid',
+        help='gunicorn master PID file, used for graceful reloads '
+             '(default: gunicorn.pid)'
+    )
+    parser.add_argument(
+        '--clone-mode',
+        choices=['mirror', 'full', 'shallow', 'partial'],
+        default='mirror',
+        help='mirror: clone from a local mirror that is fetched incrementally '
+             '(default); full: plain git clone; shallow: fetch only the '
+             'requested commit; partial: clone without file contents and '
+             'download only the checked-out ones'
+    )
+    parser.add_argument(
+        '--db-user',
+        help='MySQL user (default: prompt, or $DEPLOY_DB_USER)'
+    )
+    parser.add_argument(
+        '--db-name',
+        help='Database name (default: prompt, or $DEPLOY_DB_NAME); the '
+             'password is read from $DEPLOY_DB_PASSWORD if it is set'
+    )
+    parser.add_argument(
+        '--detach',
+        action='store_true',
+        help='Start the server in the background and return'
+    )
+    parser.add_argument(
+        '--agent-socket',
+        help='agent: Unix socket to listen on (default: '
+             '<cache-dir>/agent.sock); deploy: send the deploy to the agent '
+             'listening on this socket'
+    )
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        default=1,
+        help='agent: warm virtualenvs kept per requirements fingerprint '
+             '(default: 1)'
+    )
+    parser.add_argument(
+        '--pool-fingerprints',
+        type=int,
+        default=3,
+        help='agent: number of recently used requirements fingerprints '
+             'kept warm (default: 3)'
+    )
+    parser.add_argument(
+        '--venv-pool',
+        help='Claim a warm virtualenv from this pool directory instead of '
+             'creating one (set by the agent)'
+    )
+    parser.add_argument(
+        '--settings-profile',
+        help='JSON file overriding the performance settings written to '
+             'settings.py (conn_max_age, conn_health_checks, caches, '
+             'cached_templates, session_engine)'
+    )
+    parser.add_argument(
+        '--ready-url',
+        help='URL polled after the server starts until it answers '
+             '(default: http://127.0.0.1:<port>/)'
+    )
+    parser.add_argument(
+        '--ready-timeout',
+        type=float,
+        default=60,
+        help='Seconds the server may take to answer (default: 60)'
+    )
+    parser.add_argument(
+        '--no-ready-check',
+        action='store_true',
+        help='Do not wait for the server to answer'
+    )
+    parser.add_argument(
+        '--warm-url',
+        action='append',
+        default=[],
+        metavar='PATH',
+        help='URL requested once the server is ready, to warm imports and '
+             'caches (relative to --ready-url, may be repeated)'
+    )
+    parser.add_argument(
+        '--importtime',
+        action='store_true',
+        help='Profile Django startup with python -X importtime and report '
+             'the slowest imports'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Skip the stages that finished in the previous run of this '
+             'deploy with the same inputs and continue from the first '
+             'failed or changed one'
+    )
+    parser.add_argument(
+        '--step-timeout',
+        action='append',
+        default=[],
+        metavar='STAGE=SECONDS',
+        help='Stop the commands of a stage once it has run this long, '
+             'e.g. install_dependencies=900 (may be repeated)'
+    )
+    parser.add_argument(
+        '--history',
+        help='SQLite file with the stage durations of earlier deploys, used '
+             'to warn about slow stages '
+             '(default: <cache-dir>/deploy-history.sqlite3)'
+    )
+    parser.add_argument(
+        '--regression-factor',
+        type=float,
+        default=1.5,
+        help='Warn when a stage takes this many times its median duration '
+             'over recent deploys (default: 1.5)'
+    )
+    parser.add_argument(
+        '--report',
+        help='Where to write the JSON report with the wall time, CPU time '
+             'and peak memory of every stage and command '
+             '(default: <app-dir>/deploy-report.json)'
+    )
 
-    args = parser.parse_args()
-
-    return args.version
-
-
-def check_os():
+    args = parser.parse_args(argv)
+
+    if args.no_cache:
+        args.cache_dir = None
+    if args.app_dir is None:
+        args.app_dir = ('build-dir' if args.command == 'build'
+                        else 'project-dir')
+    if args.command == 'build':
+        if not args.version:
+            parser.error("--version is required")
+        if args.artifact is None:
+            args.artifact = re.sub(r"[^\w.-]", "_", args.version) + ".tar.gz"
+    elif args.command == 'agent':
+        if args.cache_dir is None:
+            parser.error("agent mode needs the cache directory")
+        if args.agent_socket is None:
+            args.agent_socket = os.path.join(args.cache_dir, "agent.sock")
+        if args.pool_size < 0 or args.pool_fingerprints < 1:
+            parser.error("--pool-size cannot be negative and "
+                         "--pool-fingerprints must be at least 1")
+    elif args.rollback:
+        args.releases = True
+    elif args.artifact:
+        args.artifact = os.path.abspath(args.artifact)
+        if not os.path.isfile(args.artifact):
+            parser.error(f"--artifact: no such file {args.artifact}")
+    elif not args.version:
+        parser.error("--version is required")
+    if args.keep_releases < 1:
+        parser.error("--keep-releases must be at least 1")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+    if args.index_workers < 0:
+        parser.error("--index-workers cannot be negative")
+    if args.sql_jobs < 1:
+        parser.error("--sql-jobs must be at least 1")
+    if args.sql_batch_rows < 1:
+        parser.error("--sql-batch-rows must be at least 1")
+    args.step_timeouts = {}
+    stage_names = {stage.name for stage in (
+        deployment_stages() + deployment_stages(artifact=True)
+        + deployment_stages(venv_pool=True) + build_stages())}
+    for value in args.step_timeout:
+        stage, _, seconds = value.partition('=')
+        try:
+            args.step_timeouts[stage] = float(seconds)
+        except ValueError:
+            parser.error(f"--step-timeout expects STAGE=SECONDS, got {value}")
+        if args.step_timeouts[stage] <= 0:
+            parser.error("--step-timeout must be positive")
+        if stage not in stage_names:
+            parser.error(f"--step-timeout: unknown stage '{stage}'")
+    if args.resume and args.cache_dir is None:
+        parser.error("--resume needs the cache directory for its checkpoint")
+    if args.regression_factor <= 1:
+        parser.error("--regression-factor must be greater than 1")
+    if args.history is None and args.cache_dir is not None:
+        args.history = os.path.join(args.cache_dir,
+                                    "deploy-history.sqlite3")
+    if args.ready_url is None and not args.no_ready_check:
+        args.ready_url = f"http://127.0.0.1:{args.port}/"
+    if args.instances < 1:
+        parser.error("--instances must be at least 1")
+    if args.port + args.instances - 1 > 65535:
+        parser.error("--port and --instances go past port 65535")
+    if args.upstream_conf is None:
+        args.upstream_conf = os.path.join(args.app_dir,
+                                          "nginx-upstream.conf")
+    if args.ready_timeout <= 0:
+        parser.error("--ready-timeout must be positive")
+    if args.report is None:
+        args.report = os.path.join(args.app_dir, "deploy-report.json")
+
+    return args
+
+
+class Capabilities:
+    """The OS type and the tool versions found by probe_capabilities()
+
+    `tools` maps every PROBES name to {"path", "ok", "version"}, or to None
+    when the binary is not on PATH.
+    """
+
+    def __init__(self, os_type, tools):
+        self.os_type = os_type
+        self.tools = tools
+
+    def version(self, name):
+        """The version of a tool as a tuple of ints, or None if unknown"""
+        tool = self.tools.get(name)
+        if not tool or not tool["version"]:
+            return None
+        return tuple(int(part) for part in tool["version"].split("."))
+
+    def satisfies(self, name, minimum):
+        """Whether a tool is known to be at least the given version"""
+        version = self.version(name)
+        return version is not None and version >= tuple(minimum)
+
+    def __repr__(self):
+        return json.dumps({"os": self.os_type, "tools": self.tools},
+                          sort_keys=True)
+
+
+def check_os(info=None):
     """Specifies the type of operating system"""
     try:
-        info = platform.freedesktop_os_release()
+        if info is None:
+            info = platform.freedesktop_os_release()
         distro_id = info['ID']
         distro_like = info.get('ID_LIKE', '')
         if distro_id in ['debian', 'ubuntu', 'rhel']:
@@ -63,52 +844,415 @@ def check_os():
         return "unsupported"
 
 
-def check_prerequisites():
-    """Checks for Python and MySQL"""
+@contextlib.contextmanager
+def tracked_process(args, **kwargs):
+    """Starts a process that cancel_commands() is able to terminate"""
+    if _cancel_event.is_set():
+        raise StageCancelled(args[0])
+
+    started = time.perf_counter()
+    with MeasuredPopen(args, **kwargs) as process:
+        with _active_processes_lock:
+            _active_processes.add(process)
+        try:
+            yield process
+        finally:
+            with _active_processes_lock:
+                _active_processes.discard(process)
+    metrics.record_command(args, time.perf_counter() - started,
+                           process.returncode, process.rusage)
+
+    if _cancel_event.is_set():
+        raise StageCancelled(args[0])
+
+
+def step_time_left():
+    """Seconds left before the current stage's --step-timeout, or None"""
+    timeout = _step_timeouts.get(getattr(_stage_state, "name", None))
+    if timeout is None:
+        return None
+    return max(0.0, timeout - (time.perf_counter() - _stage_state.started))
+
+
+def run_command(args, capture_output=False, input=None, timeout=None,
+                **kwargs):
+    """Run a command like subprocess.run(), but allow fail-fast cancellation
+
+    A command that outlives `timeout` (by default what is left of the step
+    timeout) is killed and returned with a negative return code.
+    """
+    if capture_output:
+        kwargs['stdout'] = subprocess.PIPE
+        kwargs['stderr'] = subprocess.PIPE
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    if timeout is None:
+        timeout = step_time_left()
+
+    with tracked_process(args, **kwargs) as process:
+        try:
+            stdout, stderr = process.communicate(input, timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            stdout, stderr = process.communicate()
+            print(f"Error: '{command_label(args)}' timed out "
+                  f"after {timeout:.0f}s")
+
+    return subprocess.CompletedProcess(args, process.returncode,
+                                       stdout, stderr)
+
+
+def stream_command(args, tail_lines=STREAM_TAIL_LINES, echo=True,
+                   timeout=None, **kwargs):
+    """Run a command, printing its output line by line as it arrives
+
+    stdout and stderr are merged. Only the last `tail_lines` lines are
+    kept, and returned as the stdout of the CompletedProcess for error
+    messages, so memory use does not grow with the output. `echo` may be
+    a predicate choosing which lines are printed. A command that outlives
+    `timeout` (by default what is left of the step timeout) is killed.
+    """
+    if timeout is None:
+        timeout = step_time_left()
+    name = getattr(_stage_state, "name", None)
+    prefix = f"[{name}] " if name else ""
+    tail = collections.deque(maxlen=tail_lines)
+    timed_out = threading.Event()
+
+    with tracked_process(args, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, text=True,
+                         errors="replace", **kwargs) as process:
+        def expire():
+            timed_out.set()
+            process.kill()
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            for line in iter(lambda: process.stdout.readline(STREAM_MAX_LINE),
+                             ""):
+                line = line.rstrip("\n")
+                tail.append(line)
+                if echo is True or (callable(echo) and echo(line)):
+                    print(prefix + line, flush=True)
+            process.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    if timed_out.is_set():
+        print(f"Error: '{command_label(args)}' timed out after {timeout:.0f}s")
+    return subprocess.CompletedProcess(args, process.returncode,
+                                       "\n".join(tail), None)
+
+
+def cancel_commands():
+    """Terminate every running command and refuse to start new ones"""
+    _cancel_event.set()
+    with _active_processes_lock:
+        processes = list(_active_processes)
+    for process in processes:
+        try:
+            process.terminate()
+        except OSError:
+            pass
+
+
+def check_stage_graph(stages, context):
+    """Make sure every stage input is provided and there are no cycles"""
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Stage names must be unique")
+
+    available = set(context)
+    finished = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [stage for stage in remaining
+                 if available.issuperset(stage.inputs)
+                 and finished.issuperset(stage.after)]
+        if not ready:
+            blocked = ', '.join(stage.name for stage in remaining)
+            raise ValueError(f"Unsatisfiable stage dependencies: {blocked}")
+        for stage in ready:
+            remaining.remove(stage)
+            available.update(stage.outputs)
+            finished.add(stage.name)
+
+
+def stage_fingerprint(stage, context, upstream, salt=""):
+    """Hashes a stage's inputs and the fingerprints of the stages it follows
+
+    Secret inputs count as an HMAC keyed with the checkpoint's random salt,
+    so a changed password invalidates the stage without the password (or
+    an unsalted hash of it) being written to disk. Chaining the upstream
+    fingerprints means a stage is invalidated whenever anything before it
+    ran again with different inputs.
+    """
+    digest = hashlib.sha256(stage.name.encode())
+    for name in stage.inputs:
+        value = context[name]
+        if name in SECRET_INPUTS:
+            value = hmac.new(salt.encode(), json.dumps(
+                value, default=str).encode(), hashlib.sha256).hexdigest()
+        digest.update(json.dumps([name, value], default=str).encode())
+    for fingerprint in sorted(upstream):
+        digest.update(fingerprint.encode())
+    return digest.hexdigest()
+
+
+def resumable_outputs(entry, fingerprint):
+    """Returns the recorded outputs of a checkpointed stage, or None
+
+    The entry is stale when the fingerprint differs or a directory or file
+    the stage produced has disappeared since.
+    """
+    if not entry or entry.get("fingerprint") != fingerprint:
+        return None
+    outputs = entry.get("outputs", {})
+    if not all(os.path.exists(outputs[name])
+               for name in entry.get("paths", [])):
+        return None
+    return outputs
+
+
+def run_stages(stages, context, jobs=4, checkpoint=None, resume=False):
+    """Run stages concurrently as soon as their inputs are available
+
+    The first failing stage cancels the rest: stages that have not started
+    are dropped and commands of running stages are terminated. The original
+    error is re-raised once every running stage has stopped.
+
+    With a checkpoint file, every finished stage is recorded there with its
+    fingerprint (see stage_fingerprint()) and outputs. With resume, stages
+    whose recorded fingerprint still matches are skipped and their outputs
+    are taken from the checkpoint, as long as every stage they follow was
+    skipped as well; a rerun starts at the first failed or invalidated
+    stage and redoes everything after it.
+    """
+    check_stage_graph(stages, context)
+    _cancel_event.clear()
+
+    state = read_json_file(checkpoint) if checkpoint and resume else {}
+    recorded = state.get("stages", {})
+    salt = state.get("salt") or secrets.token_hex(16)
+    saved = {}
+    producers = {output: stage.name for stage in stages
+                 for output in stage.outputs}
+    fingerprints = {}
+    resumed = set()
+
+    pending = list(stages)
+    running = {}
+    finished = set()
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while running or (pending and failure is None):
+            progress = failure is None
+            while progress:
+                progress = False
+                for stage in list(pending):
+                    if not (all(name in context for name in stage.inputs)
+                            and finished.issuperset(stage.after)):
+                        continue
+                    pending.remove(stage)
+                    upstream = {producers[name] for name in stage.inputs
+                                if name in producers} | set(stage.after)
+                    fingerprint = stage_fingerprint(
+                        stage, context,
+                        [fingerprints[name] for name in upstream], salt)
+                    fingerprints[stage.name] = fingerprint
+                    outputs = None
+                    if upstream.issubset(resumed):
+                        outputs = resumable_outputs(
+                            recorded.get(stage.name), fingerprint)
+                    if outputs is None:
+                        future = executor.submit(stage.run, dict(context))
+                        running[future] = stage
+                        continue
+                    print(f"Resuming: stage '{stage.name}' is unchanged "
+                          "since the last run, skipping it")
+                    metrics.record_stage(stage.name, 0.0, 0.0, "resumed")
+                    context.update(outputs)
+                    finished.add(stage.name)
+                    resumed.add(stage.name)
+                    saved[stage.name] = recorded[stage.name]
+                    progress = True
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                if future.cancelled():
+                    continue
+                try:
+                    outputs = future.result()
+                    context.update(outputs)
+                    finished.add(stage.name)
+                    if checkpoint:
+                        saved[stage.name] = {
+                            "fingerprint": fingerprints[stage.name],
+                            "outputs": outputs,
+                            "paths": [name for name, value in outputs.items()
+                                      if isinstance(value, str)
+                                      and os.path.exists(value)],
+                        }
+                        write_json_file(checkpoint, {"salt": salt,
+                                                     "stages": saved})
+                except StageCancelled:
+                    pass
+                except BaseException as error:
+                    if failure is None:
+                        failure = error
+                        print(f"Error: stage '{stage.name}' failed, "
+                              "cancelling remaining stages")
+                        for other in running:
+                            other.cancel()
+                        cancel_commands()
+
+    if failure is not None:
+        raise failure
+    return context
+
+
+def file_key(path):
+    """Identifies a file by its resolved path, mtime and inode"""
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return path, f"{path}:{stat.st_mtime_ns}:{stat.st_ino}"
+
+
+def os_release(cache):
+    """Reads os-release, or takes it from the cache if the file is unchanged"""
+    for path in OS_RELEASE_FILES:
+        if os.path.exists(path):
+            _, key = file_key(path)
+            entry = cache.get("os-release")
+            if entry and entry.get("key") == key:
+                return entry["info"]
+            try:
+                info = platform.freedesktop_os_release()
+            except (OSError, AttributeError):
+                return {}
+            cache["os-release"] = {"key": key, "info": info}
+            return info
+    return {}
+
+
+def probe_capabilities(cache_dir=None):
+    """Finds the OS type and the versions of the tools the deploy needs
+
+    Results are cached in <cache-dir>/probes.json, keyed by the resolved
+    path, mtime and inode of each binary, so a tool is only run again after
+    it was upgraded or replaced. Probes that are not cached run in parallel.
+    """
+    cache_path = os.path.join(cache_dir, "probes.json") if cache_dir else None
+    cache = read_json_file(cache_path) if cache_path else {}
+    before = json.dumps(cache, sort_keys=True)
+
+    tools = {}
+    uncached = {}
+    for name, (_, binary, arguments, _) in PROBES.items():
+        found = shutil.which(binary)
+        if found is None:
+            tools[name] = None
+            continue
+        path, key = file_key(found)
+        key += ":" + " ".join(arguments)
+        entry = cache.get(name)
+        if entry and entry.get("key") == key:
+            tools[name] = entry["tool"]
+        else:
+            uncached[name] = (key, path, arguments)
+
+    if uncached:
+        with ThreadPoolExecutor(max_workers=len(uncached)) as executor:
+            futures = {name: executor.submit(stage_bound(run_command),
+                                             [path] + arguments,
+                                             capture_output=True, text=True)
+                       for name, (_, path, arguments) in uncached.items()}
+        for name, future in futures.items():
+            key, path, _ = uncached[name]
+            result = future.result()
+            version = re.search(r"\d+(?:\.\d+)+", result.stdout)
+            tools[name] = {
+                "path": path,
+                "ok": result.returncode == 0,
+                "version": version.group(0) if version else None,
+            }
+            if result.returncode == 0:
+                cache[name] = {"key": key, "tool": tools[name]}
+
+    os_type = check_os(os_release(cache))
+    if cache_path and json.dumps(cache, sort_keys=True) != before:
+        write_json_file(cache_path, cache)
+    return Capabilities(os_type, tools)
+
+
+def check_prerequisites(capabilities, required=tuple(PROBES)):
+    """Checks for Python 3.7+, MySQL 8.0+, Git, venv and pip
+
+    `required` names the PROBES that matter for this run, e.g. building an
+    artifact needs no MySQL, and deploying one needs neither Git nor the
+    venv module, as the artifact brings its virtualenv.
+    """
     if sys.version_info < (3, 7):
         print("Error: Python 3.7+ required")
         sys.exit(1)
 
-    try:
-        result = subprocess.run(["mysql", "--version"],
-                                capture_output=True,
-                                text=True)
-        if result.returncode != 0:
-            print("Error: MySQL required")
+    for name in required:
+        description, binary, _, minimum = PROBES[name]
+        tool = capabilities.tools.get(name)
+        if tool is None:
+            print(f"Error: {description} is not installed")
             sys.exit(1)
-    except FileNotFoundError:
-        print("Error: MySQL is not installed")
-        sys.exit(1)
-
-    text = result.stdout
-    version = re.search(r'(\d+\.\d+\.\d+)', text)
-
-    if version:
-        version_str = version.group(0)
-        major_minor = '.'.join(version_str.split('.')[:2])
-        if float(major_minor) < 8.0:
-            print(f"Error: MySQL 8.0+ required, found version {major_minor}")
+        if not tool["ok"]:
+            print(f"Error: {description} check failed ({tool['path']})")
             sys.exit(1)
-    else:
-        print("Error: Could not determine MySQL version")
-
-    print("Prerequisites check passed (MySQL check skipped for testing)")
-
-    try:
-        result = subprocess.run(["git", "--version"],
-                                capture_output=True,
-                                text=True)
-        if result.returncode != 0:
-            print("Error: Git command failed")
+        if minimum is None:
+            continue
+        minimum_text = ".".join(str(part) for part in minimum)
+        if capabilities.version(name) is None:
+            print(f"Warning: Could not determine the {description} version")
+        elif not capabilities.satisfies(name, minimum):
+            print(f"Error: {description} {minimum_text}+ required, "
+                  f"found version {tool['version']}")
             sys.exit(1)
-    except FileNotFoundError:
-        print("Error: Git is not installed")
-        sys.exit(1)
 
+    print("Prerequisites check passed")
+
+
+def create_directory(app_dir="project-dir", incremental=False, releases=False,
+                     version=None):
+    """Creating a working directory - for a virtual environment
+
+    In release mode a new directory releases/<version>-<timestamp> is
+    created next to the ones of earlier deploys and returned instead.
+    """
+    if releases:
+        name = re.sub(r"[^\w.-]", "_", version) + time.strftime(
+            "-%Y%m%d%H%M%S")
+        release_dir = os.path.join(os.path.abspath(app_dir), "releases",
+                                   name)
+        os.makedirs(os.path.dirname(release_dir), exist_ok=True)
+        suffix = 0
+        while True:
+            try:
+                os.mkdir(release_dir + (f".{suffix}" if suffix else ""))
+                break
+            except FileExistsError:
+                suffix += 1
+        release_dir += f".{suffix}" if suffix else ""
+        print(f"Release directory {release_dir} created")
+        return release_dir
 
-def create_directory(app_dir="project-dir"):
-    """Creating a working directory - for a virtual environment"""
     if os.path.exists(app_dir):
+        if incremental:
+            print("Reusing existing deployment directory")
+            return app_dir
         print("Removing old deployment directory...")
         shutil.rmtree(app_dir)
 
@@ -117,15 +1261,72 @@ def create_directory(app_dir="project-dir"):
     return app_dir
 
 
-def create_virtualenv(app_dir):
+def interpreter_fingerprint(python="python3"):
+    """Identifies the base interpreter by its resolved path, size and mtime"""
+    path = shutil.which(python)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def read_json_file(path):
+    """Reads a JSON state file, or returns {} if it is missing or broken"""
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json_file(path, data):
+    """Atomically replaces a JSON state file"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    partial = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(partial, 'w') as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+    os.replace(partial, path)
+
+
+def state_file(cache_dir, kind, name):
+    """Returns the path of a JSON state file kept in the cache directory"""
+    safe_name = re.sub(r"[^\w.-]", "_", name)
+    return os.path.join(cache_dir, kind, f"{safe_name}.json")
+
+
+def read_venv_fingerprint(venv_path):
+    """Reads what a virtualenv was built from, or {} if unknown"""
+    return read_json_file(os.path.join(venv_path, "deploy-fingerprint.json"))
+
+
+def write_venv_fingerprint(venv_path, fingerprint):
+    """Records what a virtualenv was built from"""
+    write_json_file(os.path.join(venv_path, "deploy-fingerprint.json"),
+                    fingerprint)
+
+
+def create_virtualenv(app_dir, incremental=False):
     """Creating virtualenv - an isolated Python environment"""
     venv_path = os.path.join(app_dir, "venv")
+    activate_script = os.path.join(venv_path, "bin", "activate")
+    interpreter = interpreter_fingerprint()
+
+    if os.path.isdir(venv_path):
+        fingerprint = read_venv_fingerprint(venv_path)
+        if (incremental and os.path.exists(activate_script)
+                and fingerprint.get("interpreter") == interpreter):
+            print("Reusing existing virtual environment")
+            return venv_path
+        print("Removing outdated virtual environment...")
+        shutil.rmtree(venv_path)
+
     print("Creating virtual environment...")
 
     try:
-        result = subprocess.run(["python3", "-m", "venv", venv_path],
-                                capture_output=True,
-                                text=True)
+        result = run_command(["python3", "-m", "venv", venv_path],
+                             capture_output=True,
+                             text=True)
         if result.returncode != 0:
             print("Error: Failed to create virtual environment")
             sys.exit(1)
@@ -134,63 +1335,747 @@ def create_virtualenv(app_dir):
         print(result.stderr)
         sys.exit(1)
 
-    activate_script = os.path.join(venv_path, "bin", "activate")
     if not os.path.exists(activate_script):
         print("Error: Virtual environment was not created properly")
         sys.exit(1)
 
+    write_venv_fingerprint(venv_path, {"interpreter": interpreter})
     print("Virtual environment created")
     return venv_path
 
 
-def pull_code(app_dir, version):
-    """Downloading code - git clone of a specific version"""
-    repo_url = "https://github.com/Manisha-Bayya/simple-django-project.git"
-    code_dir = os.path.join(app_dir, "simple-django-project")
-
-    result = subprocess.run(["git",
-                             "clone",
-                             "--branch",
-                             version,
-                             repo_url,
-                             code_dir],
-                            capture_output=True,
-                            text=True)
+def git_command(args, error):
+    """Runs a git command and stops the deployment if it fails"""
+    result = run_command(["git"] + args, capture_output=True, text=True)
     if result.returncode != 0:
-        print(
-            f"Error: Failed to clone repository (version '{version}' not found?)")
+        print(f"Error: {error}")
+        print(f"Git error: {result.stderr}")
+        sys.exit(1)
+    return result
+
+
+def update_mirror(repo_url, cache_dir):
+    """Creates or incrementally fetches a bare mirror of the repository"""
+    name = hashlib.sha256(repo_url.encode()).hexdigest()[:16]
+    mirror = os.path.join(cache_dir, "git", f"{name}.git")
+
+    if os.path.isdir(mirror):
+        print("Updating local repository mirror...")
+        git_command(["--git-dir", mirror, "fetch", "--quiet", "--prune",
+                     "origin"],
+                    f"Failed to update repository mirror {mirror}")
+        return mirror
+
+    print("Creating local repository mirror...")
+    os.makedirs(os.path.dirname(mirror), exist_ok=True)
+    partial = f"{mirror}.tmp-{os.getpid()}-{threading.get_ident()}"
+    result = run_command(["git", "clone", "--quiet", "--mirror", repo_url,
+                          partial], capture_output=True, text=True)
+    if result.returncode != 0:
+        shutil.rmtree(partial, ignore_errors=True)
+        print("Error: Failed to clone repository")
         print(f"Git error: {result.stderr}")
         sys.exit(1)
+
+    try:
+        os.rename(partial, mirror)
+    except OSError:
+        # Another deploy finished the same mirror first
+        shutil.rmtree(partial, ignore_errors=True)
+    return mirror
+
+
+def checkout_version(code_dir, version, error, keep=()):
+    """Checks out a branch, tag or commit, discarding local edits
+
+    When the checkout is already at that commit, the paths in `keep` are
+    left as they are, so a rendered settings.py is not rewritten (and a
+    running server does not reload) on a redeploy of the same version.
+    """
+    for ref in (f"refs/remotes/origin/{version}", version):
+        result = run_command(["git", "-C", code_dir, "rev-parse", "--verify",
+                              "--quiet", f"{ref}^{{commit}}"],
+                             capture_output=True,
+                             text=True)
+        if result.returncode == 0:
+            break
+    else:
+        print(f"Error: {error}")
+        sys.exit(1)
+
+    commit = result.stdout.strip()
+    keep = [path for path in keep
+            if os.path.exists(os.path.join(code_dir, path))]
+    head = run_command(["git", "-C", code_dir, "rev-parse", "--verify",
+                        "--quiet", "HEAD"],
+                       capture_output=True,
+                       text=True)
+    if keep and head.returncode == 0 and head.stdout.strip() == commit:
+        git_command(["-C", code_dir, "checkout", "--quiet", commit, "--",
+                     "."] + [f":(exclude){path}" for path in keep], error)
+    else:
+        git_command(["-C", code_dir, "checkout", "--quiet", "--force",
+                     "--detach", commit], error)
+    return commit
+
+
+def pull_code(app_dir, version, repo_url=REPO_URL, cache_dir=None,
+              clone_mode="mirror", capabilities=None):
+    """Downloading code - git clone of a specific version
+
+    In mirror mode the clone is made from a local mirror (hard links, no
+    network), so only new objects are downloaded by the mirror fetch.
+    Shallow mode fetches only the requested branch, tag or full commit hash.
+    An existing checkout (incremental deploys) is fetched and switched to
+    the version instead of being cloned again. Partial clones need Git
+    2.19+ (see probe_capabilities()); older versions get a full clone.
+    """
+    code_dir = os.path.join(app_dir, "simple-django-project")
+    error = f"Failed to clone repository (version '{version}' not found?)"
+    existing = os.path.isdir(os.path.join(code_dir, ".git"))
+    if (clone_mode == "partial" and capabilities is not None
+            and not capabilities.satisfies("git", (2, 19))):
+        print("Warning: --clone-mode partial needs Git 2.19+, "
+              "making a full clone instead")
+        clone_mode = "full"
+
+    if clone_mode == "shallow":
+        if not existing:
+            git_command(["init", "--quiet", code_dir], error)
+            git_command(["-C", code_dir, "remote", "add", "origin",
+                         repo_url], error)
+        git_command(["-C", code_dir, "fetch", "--quiet", "--depth", "1",
+                     "origin", version], error)
+        checkout_version(code_dir, "FETCH_HEAD", error,
+                         keep=(SETTINGS_FILE,))
+        return code_dir
+
+    if clone_mode == "mirror" and cache_dir:
+        mirror = update_mirror(repo_url, cache_dir)
+        if existing:
+            git_command(["-C", code_dir, "fetch", "--quiet", "--prune",
+                         "--tags", mirror,
+                         "+refs/heads/*:refs/remotes/origin/*"], error)
+        else:
+            git_command(["clone", "--quiet", "--no-checkout", mirror,
+                         code_dir], error)
+            git_command(["-C", code_dir, "remote", "set-url", "origin",
+                         repo_url], error)
+    elif existing:
+        git_command(["-C", code_dir, "fetch", "--quiet", "--prune", "--tags",
+                     "origin"], error)
+    else:
+        clone = ["clone", "--quiet", "--no-checkout"]
+        if clone_mode == "partial":
+            clone.append("--filter=blob:none")
+        git_command(clone + [repo_url, code_dir], error)
+
+    commit = checkout_version(code_dir, version, error,
+                              keep=(SETTINGS_FILE,))
+    print(f"Checked out {version} ({commit[:12]})")
     return code_dir
 
 
-def install_dependencies(venv_path, code_dir):
-    """Installing dependencies - pip install -r requirements.txt"""
+def file_sha256(path):
+    """Returns the SHA-256 hex digest of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def interpreter_abi(python_path):
+    """Returns the ABI tag of an interpreter
+
+    For example cpython-311-x86_64-linux-gnu.
+    """
+    result = run_command([python_path, "-c",
+                          "import sys, sysconfig; "
+                          "print(sysconfig.get_config_var('SOABI') "
+                          "or sys.implementation.cache_tag)"],
+                         capture_output=True,
+                         text=True)
+    if result.returncode != 0:
+        print("Error: Could not determine the virtualenv interpreter ABI")
+        print(result.stderr)
+        sys.exit(1)
+    return result.stdout.strip()
+
+
+def wheelhouse_path(cache_dir, requirements_path, abi):
+    """Returns the wheel cache directory for a requirements file and ABI"""
+    digest = hashlib.sha256()
+    digest.update(file_sha256(requirements_path).encode())
+    digest.update(abi.encode())
+    return os.path.join(cache_dir, "wheels", digest.hexdigest()[:32])
+
+
+def build_wheelhouse(pip_path, requirements_path, wheel_dir):
+    """Downloads and builds wheels for every requirement into wheel_dir"""
+    print("Building wheels for requirements.txt...")
+    partial = f"{wheel_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+    result = stream_command([pip_path, "wheel", "--wheel-dir", partial,
+                             "-r", requirements_path])
+    if result.returncode != 0:
+        shutil.rmtree(partial, ignore_errors=True)
+        print("Error: Failed to build wheels for dependencies")
+        print(result.stdout)
+        sys.exit(1)
+
+    try:
+        os.rename(partial, wheel_dir)
+    except OSError:
+        # Another deploy finished the same wheelhouse first
+        shutil.rmtree(partial, ignore_errors=True)
+
+
+def install_dependencies(venv_path, code_dir, cache_dir=None, offline=False,
+                         incremental=False):
+    """Installing dependencies - pip install -r requirements.txt
+
+    With a cache directory, wheels are built once per requirements.txt hash
+    and interpreter ABI; later deploys install those wheels directly, with
+    no index access, dependency resolution or build step. Incremental
+    deploys skip the step when the virtualenv was already populated from
+    the same requirements.txt.
+    """
     pip_path = os.path.join(venv_path, "bin", "pip")
+    python_path = os.path.join(venv_path, "bin", "python3")
     requirements_path = os.path.join(code_dir, "requirements.txt")
 
     if not os.path.exists(requirements_path):
         print("Error: requirements.txt not found")
         sys.exit(1)
 
-    result = subprocess.run([pip_path, "install", "-r",
-                            requirements_path],
-                            capture_output=True,
-                            text=True)
-    if result.returncode != 0:
-        print("Error: Failed to install dependencies")
-        print(result.stderr)
+    requirements_hash = file_sha256(requirements_path)
+    fingerprint = read_venv_fingerprint(venv_path)
+    if incremental and fingerprint.get("requirements") == requirements_hash:
+        print("Dependencies unchanged, skipping installation")
+        return
+    fingerprint.pop("requirements", None)
+    write_venv_fingerprint(venv_path, fingerprint)
+
+    if not cache_dir:
+        if offline:
+            print("Error: Offline mode needs the wheel cache (--cache-dir)")
+            sys.exit(1)
+        command = [pip_path, "install", "-r", requirements_path]
+    else:
+        wheel_dir = wheelhouse_path(cache_dir, requirements_path,
+                                    interpreter_abi(python_path))
+        if not os.path.isdir(wheel_dir):
+            if offline:
+                print("Error: No cached wheels for this requirements.txt "
+                      f"(offline mode, expected {wheel_dir})")
+                sys.exit(1)
+            os.makedirs(os.path.dirname(wheel_dir), exist_ok=True)
+            build_wheelhouse(pip_path, requirements_path, wheel_dir)
+        else:
+            print("Installing dependencies from cached wheels...")
+
+        wheels = sorted(os.path.join(wheel_dir, name)
+                        for name in os.listdir(wheel_dir)
+                        if name.endswith(".whl"))
+        command = [pip_path, "install", "--no-index", "--no-deps"] + wheels
+        if not wheels:
+            command = None
+
+    if command:
+        result = stream_command(command)
+        if result.returncode != 0:
+            print("Error: Failed to install dependencies")
+            print(result.stdout)
+            sys.exit(1)
+
+    fingerprint["requirements"] = requirements_hash
+    write_venv_fingerprint(venv_path, fingerprint)
+
+
+def pool_entry(pool_dir, requirements_path):
+    """Returns the pool directory for a requirements.txt and marks it used
+
+    Pool entries are keyed by the requirements.txt hash and the base
+    interpreter; each keeps a copy of requirements.txt so the agent can
+    build more virtualenvs for it later.
+    """
+    digest = hashlib.sha256(file_sha256(requirements_path).encode())
+    digest.update(str(interpreter_fingerprint()).encode())
+    entry = os.path.join(pool_dir, digest.hexdigest()[:32])
+    os.makedirs(entry, exist_ok=True)
+    copy = os.path.join(entry, "requirements.txt")
+    if not os.path.exists(copy):
+        shutil.copyfile(requirements_path, f"{copy}.tmp-{os.getpid()}")
+        os.replace(f"{copy}.tmp-{os.getpid()}", copy)
+    with open(os.path.join(entry, "last-used"), "w") as file:
+        file.write(str(time.time()))
+    return entry
+
+
+def claim_virtualenv(app_dir, code_dir, pool_dir, cache_dir=None,
+                     offline=False, incremental=False):
+    """Takes a populated virtualenv for requirements.txt from the pool
+
+    A ready virtualenv is claimed by renaming it, so concurrent deploys
+    never get the same one, and is moved into app_dir. Without a ready
+    one the virtualenv is created and populated as usual.
+    """
+    venv_path = os.path.join(app_dir, "venv")
+    requirements_path = os.path.join(code_dir, "requirements.txt")
+    if not os.path.exists(requirements_path):
+        print("Error: requirements.txt not found")
         sys.exit(1)
+    entry = pool_entry(pool_dir, requirements_path)
+
+    fingerprint = read_venv_fingerprint(venv_path)
+    if (incremental and fingerprint.get("requirements")
+            == file_sha256(requirements_path)
+            and fingerprint.get("interpreter") == interpreter_fingerprint()):
+        print("Reusing existing virtual environment")
+        return venv_path
+
+    for name in sorted(os.listdir(entry)):
+        if not name.startswith("ready-"):
+            continue
+        claimed = os.path.join(entry, f"claimed-{os.getpid()}-{name[6:]}")
+        try:
+            os.rename(os.path.join(entry, name), claimed)
+        except FileNotFoundError:
+            continue
+        with open(os.path.join(claimed, "origin")) as file:
+            origin = file.read()
+        if os.path.exists(venv_path):
+            shutil.rmtree(venv_path)
+        shutil.move(os.path.join(claimed, "venv"), venv_path)
+        shutil.rmtree(claimed)
+        relocate_virtualenv(venv_path, origin)
+        print("Claimed a warm virtual environment from the pool")
+        return venv_path
+
+    print("No warm virtual environment for this requirements.txt")
+    create_virtualenv(app_dir)
+    install_dependencies(venv_path, code_dir, cache_dir, offline)
+    return venv_path
 
 
-def db_setting(code_dir):
-    """Database Setup - Import world.sql into MySQL"""
-    print("=== DB SETTING FUNCTION CALLED ===")
-    print("Setting up database...")
+def build_pool_virtualenv(entry, cache_dir=None, offline=False):
+    """Creates and populates one spare virtualenv in a pool entry"""
+    building = tempfile.mkdtemp(prefix="building-", dir=entry)
+    venv_path = create_virtualenv(building)
+    install_dependencies(venv_path, entry, cache_dir, offline)
+    with open(os.path.join(building, "origin"), "w") as file:
+        file.write(os.path.abspath(venv_path))
+    name = os.path.basename(building).replace("building-", "ready-", 1)
+    os.rename(building, os.path.join(entry, name))
+
+
+def refill_pool(pool_dir, size=1, keep=3, cache_dir=None, offline=False):
+    """Tops up the warm virtualenvs of the most recently used fingerprints
+
+    Entries beyond the `keep` most recently used ones are removed together
+    with their virtualenvs.
+    """
+    os.makedirs(pool_dir, exist_ok=True)
+    entries = [os.path.join(pool_dir, name) for name in os.listdir(pool_dir)
+               if os.path.exists(os.path.join(pool_dir, name, "last-used"))]
+    entries.sort(key=lambda entry: -os.path.getmtime(
+        os.path.join(entry, "last-used")))
+    for entry in entries[keep:]:
+        print(f"Dropping unused virtualenv pool {os.path.basename(entry)}")
+        shutil.rmtree(entry, ignore_errors=True)
+    for entry in entries[:keep]:
+        ready = [name for name in os.listdir(entry)
+                 if name.startswith("ready-")]
+        for _ in range(size - len(ready)):
+            print(f"Building a warm virtualenv for {os.path.basename(entry)}")
+            build_pool_virtualenv(entry, cache_dir, offline)
+
+
+def prompt_db_credentials(db_user=None, db_name=None):
+    """Asks for the MySQL credentials before the stages start running
+
+    $DEPLOY_DB_USER, $DEPLOY_DB_PASSWORD and $DEPLOY_DB_NAME (or the given
+    values) are used instead of asking, for deploys without a terminal.
+    """
+    db_user = db_user or os.environ.get("DEPLOY_DB_USER") or (
+        input("Enter MySQL username (default: root): ") or "root")
+    db_password = os.environ.get("DEPLOY_DB_PASSWORD")
+    if db_password is None:
+        db_password = getpass.getpass("Enter MySQL password: ")
+    db_name = db_name or os.environ.get("DEPLOY_DB_NAME") or (
+        input("Enter database name (default: world): ") or "world")
+    return db_user, db_password, db_name
+
+
+def iter_sql_statements(lines):
+    """Splits a SQL dump into statements without loading it into memory
+
+    Quoted strings and comments may span lines. Plain comments are dropped,
+    MySQL versioned comments (/*!40101 ... */) are kept because dumps use
+    them as statements. DELIMITER blocks are not supported.
+    """
+    statement = []
+    quote = None
+    in_comment = False
+
+    for line in lines:
+        pos = 0
+        length = len(line)
+        while pos < length:
+            if in_comment:
+                end = line.find("*/", pos)
+                if end < 0:
+                    break
+                pos = end + 2
+                in_comment = False
+                continue
+
+            if quote:
+                match = _SQL_QUOTE_REST[quote].match(line, pos)
+                if match is None:
+                    statement.append(line[pos:])
+                    break
+                statement.append(line[pos:match.end()])
+                pos = match.end()
+                quote = None
+
+            # Fast path: whole statements without comments on this line
+            match = _SQL_STATEMENT.match(line, pos)
+            while match:
+                statement.append(match.group())
+                text = "".join(statement).strip()
+                statement = []
+                if text != ";":
+                    yield text
+                pos = match.end()
+                match = _SQL_STATEMENT.match(line, pos)
+
+            segment = pos
+            while True:
+                match = _SQL_TOKEN.search(line, pos)
+                if match is None:
+                    statement.append(line[segment:])
+                    pos = length
+                    break
+                token, start, pos = match.group(), match.start(), match.end()
+
+                if token[0] in "'\"`" and len(token) > 1:
+                    continue
+                if token == ";":
+                    statement.append(line[segment:pos])
+                    text = "".join(statement).strip()
+                    statement = []
+                    segment = pos
+                    if text != ";":
+                        yield text
+                elif token == "--" and line[pos:pos + 1] not in (
+                        "", " ", "\t", "\r", "\n"):
+                    continue
+                elif token in ("--", "#"):
+                    statement.append(line[segment:start] + "\n")
+                    pos = length
+                    break
+                elif token == "/*" and line[pos:pos + 1] != "!":
+                    statement.append(line[segment:start])
+                    in_comment = True
+                    break
+                elif token in ("/*", "*/"):
+                    continue
+                else:
+                    statement.append(line[segment:])
+                    quote = token
+                    pos = length
+                    break
+
+    text = "".join(statement).strip()
+    if text:
+        yield text
+
+
+def coalesce_inserts(statements, max_bytes=SQL_MAX_STATEMENT_BYTES):
+    """Merges consecutive INSERTs into one table into multi-row INSERTs
+
+    Yields (statement, rows) pairs; rows is 0 for anything but INSERTs.
+    """
+    prefix = None
+    values = []
+    size = 0
+    rows = 0
+
+    for statement in statements:
+        match = _SQL_INSERT_PREFIX.match(statement)
+        body = statement[match.end():].rstrip(";").rstrip() if match else ""
+        if not body.endswith(")") or _SQL_ON_DUPLICATE.search(body):
+            if values:
+                yield prefix + ",".join(values) + ";", rows
+                prefix, values, size, rows = None, [], 0, 0
+            yield statement, 0
+            continue
+
+        head = statement[:match.end()]
+        if values and (head != prefix or size + len(body) > max_bytes):
+            yield prefix + ",".join(values) + ";", rows
+            values, size, rows = [], 0, 0
+        prefix = head
+        values.append(body)
+        size += len(body) + 1
+        rows += body.count("),(") + 1
+
+    if values:
+        yield prefix + ",".join(values) + ";", rows
+
+
+def import_sql_dump(sql_file, command, batch_rows=SQL_BATCH_ROWS,
+                    progress_interval=5.0):
+    """Streams a SQL dump into the mysql client in batched transactions
+
+    Unique and foreign key checks are disabled while loading and a COMMIT
+    is sent every batch_rows rows. Only the last lines of the client's
+    error output are kept. The client is killed, and the import fails,
+    when the step timeout runs out. Returns (statements, rows, seconds).
+    """
+    started = time.monotonic()
+    last_report = started
+    statements = rows = pending = 0
+    errors = collections.deque(maxlen=20)
+    timeout = step_time_left()
+    timed_out = threading.Event()
+
+    with open(sql_file, encoding="utf-8", errors="surrogateescape") as dump, \
+            tracked_process(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True,
+                            encoding="utf-8",
+                            errors="surrogateescape") as process:
+        def expire():
+            timed_out.set()
+            process.kill()
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, expire)
+            timer.daemon = True
+            timer.start()
+        reader = threading.Thread(target=errors.extend,
+                                  args=(process.stderr,), daemon=True)
+        reader.start()
+        try:
+            process.stdin.write(BULK_LOAD_PRELUDE)
+            for statement, count in coalesce_inserts(
+                    iter_sql_statements(dump)):
+                process.stdin.write(statement)
+                process.stdin.write("\n")
+                statements += 1
+                rows += count
+                pending += count
+                if pending >= batch_rows:
+                    process.stdin.write("COMMIT;\n")
+                    pending = 0
+
+                now = time.monotonic()
+                if now - last_report >= progress_interval:
+                    rate = rows / (now - started)
+                    print(f"Imported {rows} rows ({rate:.0f} rows/sec)...")
+                    last_report = now
+            process.stdin.write(BULK_LOAD_EPILOGUE)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+        if timer is not None:
+            timer.cancel()
+        reader.join()
+
+    if timed_out.is_set():
+        print(f"Error: '{command_label(command)}' timed out "
+              f"after {timeout:.0f}s")
+    if timed_out.is_set() or process.returncode != 0:
+        print("Error: Failed to import database")
+        print("".join(errors))
+        sys.exit(1)
 
-    db_user = input("Enter MySQL username (default: root): ") or "root"
-    db_password = getpass.getpass("Enter MySQL password: ")
-    db_name = input("Enter database name (default: world): ") or "world"
+    return statements, rows, time.monotonic() - started
+
+
+def split_sql_dump(sql_file, work_dir):
+    """Splits a dump into a DDL file, one data file per table and a post file
+
+    SET and USE statements are repeated at the top of every file so each
+    file can be loaded in its own session. LOCK TABLES statements are
+    dropped, ALTER TABLE statements other than DISABLE/ENABLE KEYS (added
+    constraints and indexes) go to the post file. Returns (ddl_path,
+    table_paths sorted largest first, post_path or None).
+    """
+    prelude = []
+    tables = {}
+    ddl_path = os.path.join(work_dir, "ddl.sql")
+    post_path = os.path.join(work_dir, "post.sql")
+    post = None
+    seen_data = False
+
+    def open_segment(path):
+        segment = open(path, "w", encoding="utf-8",
+                       errors="surrogateescape")
+        segment.writelines(statement + "\n" for statement in prelude)
+        return segment
+
+    with open(sql_file, encoding="utf-8", errors="surrogateescape") as dump, \
+            open(ddl_path, "w", encoding="utf-8",
+                 errors="surrogateescape") as ddl:
+        try:
+            for statement in iter_sql_statements(dump):
+                match = _SQL_TABLE_STATEMENT.match(statement)
+                verb = table = ""
+                if match:
+                    verb = " ".join(match.group(1).upper().split())
+                    table = match.group(2)
+
+                if verb in ("SET", "USE"):
+                    prelude.append(statement)
+                    targets = [ddl, post] + list(tables.values())
+                elif verb in ("LOCK TABLES", "UNLOCK TABLES"):
+                    targets = []
+                elif (verb.endswith("INTO") or (
+                        verb == "ALTER TABLE"
+                        and _SQL_KEYS_TOGGLE.search(statement))):
+                    if table not in tables:
+                        path = os.path.join(work_dir,
+                                            f"table-{len(tables)}.sql")
+                        tables[table] = open_segment(path)
+                    seen_data = True
+                    targets = [tables[table]]
+                elif verb in ("CREATE TABLE", "DROP TABLE") or not seen_data:
+                    targets = [ddl]
+                else:
+                    if post is None:
+                        post = open_segment(post_path)
+                    targets = [post]
+
+                for target in targets:
+                    if target is not None:
+                        target.write(statement)
+                        target.write("\n")
+        finally:
+            for segment in list(tables.values()) + [post]:
+                if segment is not None:
+                    segment.close()
+
+    table_paths = sorted((segment.name for segment in tables.values()),
+                         key=os.path.getsize, reverse=True)
+    return ddl_path, table_paths, post_path if post is not None else None
+
+
+def import_sql_dump_parallel(sql_file, command, batch_rows=SQL_BATCH_ROWS,
+                             jobs=4):
+    """Imports a dump with one session per table, jobs sessions at a time
+
+    Table definitions are applied first, then the tables' data is loaded
+    concurrently, then constraints and any remaining statements.
+    Returns (statements, rows, seconds).
+    """
+    started = time.monotonic()
+    statements = rows = 0
+
+    with tempfile.TemporaryDirectory(prefix="deploy-sql-") as work_dir:
+        ddl_path, table_paths, post_path = split_sql_dump(sql_file, work_dir)
+        print(f"Split world.sql into {len(table_paths)} table segments")
+
+        count, _, _ = import_sql_dump(ddl_path, command, batch_rows)
+        statements += count
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(stage_bound(import_sql_dump), path,
+                                       command, batch_rows)
+                       for path in table_paths]
+            try:
+                for future in as_completed(futures):
+                    count, table_rows, _ = future.result()
+                    statements += count
+                    rows += table_rows
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        if post_path:
+            count, post_rows, _ = import_sql_dump(post_path, command,
+                                                  batch_rows)
+            statements += count
+            rows += post_rows
+
+    return statements, rows, time.monotonic() - started
+
+
+def mysql_command(db_user, db_password, db_name, *options):
+    """Builds the mysql client command line for the application database"""
+    command = ["mysql", f"-u{db_user}"]
+    if db_password:
+        command.append(f"-p{db_password}")
+    command.extend(options)
+    command.append(db_name)
+    return command
+
+
+def mysql_query(db_user, db_password, db_name, query):
+    """Runs a query in batch mode and returns its output, or None on error"""
+    try:
+        result = run_command(mysql_command(db_user, db_password, db_name,
+                                           "-N", "-B", "-e", query),
+                             capture_output=True,
+                             text=True)
+    except FileNotFoundError:
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout
+
+
+def dump_tables(sql_file):
+    """Returns the names of the tables a dump creates"""
+    tables = []
+    with open(sql_file, encoding="utf-8", errors="surrogateescape") as dump:
+        for line in dump:
+            if "CREATE" not in line and "create" not in line:
+                continue
+            match = _SQL_CREATE_TABLE.search(line)
+            if match and match.group(1) not in tables:
+                tables.append(match.group(1))
+    return tables
+
+
+def database_state(db_user, db_password, db_name, tables):
+    """Fingerprints the data and columns of the given tables
+
+    Uses CHECKSUM TABLE, which scans the tables but costs far less than
+    re-importing them. Returns None when the state cannot be read.
+    """
+    if not tables:
+        return None
+    names = ", ".join(f"`{table}`" for table in tables)
+    quoted = ", ".join(f"'{table}'" for table in tables)
+    output = mysql_query(
+        db_user, db_password, db_name,
+        f"CHECKSUM TABLE {names}; "
+        "SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE "
+        "FROM information_schema.COLUMNS "
+        f"WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({quoted}) "
+        "ORDER BY TABLE_NAME, ORDINAL_POSITION;")
+    if output is None or "NULL" in output:
+        return None
+    return hashlib.sha256(output.encode()).hexdigest()
+
+
+def db_setting(code_dir, db_user, db_password, db_name,
+               batch_rows=SQL_BATCH_ROWS, sql_jobs=1, cache_dir=None,
+               force_import=False):
+    """Database Setup - Import world.sql into MySQL
+
+    With sql_jobs above 1 the tables are loaded over several connections.
+    With a cache directory, the SHA-256 of world.sql and the state of its
+    tables after the import are recorded, and the import is skipped while
+    both still match.
+    """
+    print("Setting up database...")
 
     sql_file = os.path.join(code_dir, "world.sql")
 
@@ -198,33 +2083,95 @@ def db_setting(code_dir):
         print("Error: world.sql not found")
         sys.exit(1)
 
+    snapshot_path = None
+    if cache_dir:
+        snapshot_path = state_file(cache_dir, "db-snapshots", db_name)
+        dump_hash = file_sha256(sql_file)
+        tables = dump_tables(sql_file)
+        snapshot = read_json_file(snapshot_path)
+        if (not force_import and snapshot.get("dump_sha256") == dump_hash
+                and snapshot.get("tables") == tables
+                and snapshot.get("state") is not None
+                and snapshot.get("state") == database_state(
+                    db_user, db_password, db_name, tables)):
+            print("world.sql unchanged and database matches the last "
+                  "import, skipping database import")
+            return
+
+    command = mysql_command(db_user, db_password, db_name)
     try:
-        result = subprocess.run([
-            "mysql",
-            f"-u{db_user}",
-            f"-p{db_password}",
-            db_name
-        ], stdin=open(sql_file),
-            capture_output=True,
-            text=True)
-
-        if result.returncode != 0:
-            print("Error: Failed to import database")
-            print(result.stderr)
-            sys.exit(1)
-
-        print("Database imported successfully!")
+        if sql_jobs > 1:
+            statements, rows, seconds = import_sql_dump_parallel(
+                sql_file, command, batch_rows, sql_jobs)
+        else:
+            statements, rows, seconds = import_sql_dump(
+                sql_file, command, batch_rows)
+        rate = rows / seconds if seconds else rows
+        print(f"Database imported successfully! {statements} statements, "
+              f"{rows} rows in {seconds:.1f}s ({rate:.0f} rows/sec)")
+        if snapshot_path:
+            write_json_file(snapshot_path, {
+                "dump_sha256": dump_hash,
+                "tables": tables,
+                "state": database_state(db_user, db_password, db_name,
+                                        tables),
+            })
     except FileNotFoundError:
         print("Warning: MySQL not installed, skipping database import")
         print(
             "On production, this would run: mysql -u{user} -p {db} < world.sql")
 
-    return db_user, db_password
 
-
-def application_configuration(code_dir, db_user, db_password):
-    """Application Configuration - settings.py Editing"""
-    settings_path = os.path.join(code_dir, "panorbit", "settings.py")
+def load_settings_profile(path=None):
+    """Reads a settings profile (JSON) on top of DEFAULT_SETTINGS_PROFILE"""
+    profile = dict(DEFAULT_SETTINGS_PROFILE)
+    if path is None:
+        return profile
+    try:
+        with open(path) as file:
+            overrides = json.load(file)
+    except (OSError, ValueError) as error:
+        print(f"Error: Could not read settings profile {path}: {error}")
+        sys.exit(1)
+    unknown = sorted(set(overrides) - set(profile))
+    if unknown:
+        print(f"Error: Unknown settings profile keys: {', '.join(unknown)}")
+        sys.exit(1)
+    profile.update(overrides)
+    return profile
+
+
+def settings_template(code_dir, settings_path):
+    """Returns settings.py as it was before deploy.py edited it
+
+    The committed version is used when the code is a git checkout;
+    otherwise (e.g. an unpacked artifact) a copy is kept next to the file
+    the first time it is rendered.
+    """
+    relative = os.path.relpath(settings_path, code_dir)
+    if os.path.isdir(os.path.join(code_dir, ".git")):
+        result = run_command(["git", "-C", code_dir, "show",
+                              f"HEAD:{relative}"],
+                             capture_output=True, text=True)
+        if result.returncode == 0:
+            return result.stdout
+    template = os.path.join(os.path.dirname(settings_path),
+                            ".settings.py.template")
+    if not os.path.exists(template):
+        shutil.copyfile(settings_path, template)
+    with open(template) as file:
+        return file.read()
+
+
+def application_configuration(code_dir, db_user, db_password, profile=None):
+    """Application Configuration - settings.py rendering
+
+    Fills in the database credentials and appends the performance settings
+    of the profile (see DEFAULT_SETTINGS_PROFILE). The file is replaced
+    atomically, and left alone when the result is identical, so a running
+    server does not reload for nothing.
+    """
+    settings_path = os.path.join(code_dir, SETTINGS_FILE)
     db_host = "localhost"
     db_port = "3306"
 
@@ -233,8 +2180,7 @@ def application_configuration(code_dir, db_user, db_password):
         sys.exit(1)
 
     try:
-        with open(settings_path, 'r') as file:
-            data = file.read()
+        data = settings_template(code_dir, settings_path)
     except Exception as e:
         print(f"Error reading settings.py: {e}")
         sys.exit(1)
@@ -243,13 +2189,183 @@ def application_configuration(code_dir, db_user, db_password):
     data = data.replace('<mysql-password>', db_password)
     data = data.replace('<mysql-host>', db_host)
     data = data.replace('<mysql-port>', db_port)
-    with open(settings_path, 'w') as file:
-        file.write(data)
+    if RENDERED_SETTINGS_MARKER in data:
+        data = data[:data.index(RENDERED_SETTINGS_MARKER)]
+    data = data.rstrip() + "\n\n\n" + RENDERED_SETTINGS.format(
+        static_root=static_root(code_dir),
+        **(profile or load_settings_profile()))
+
+    rendered = data.encode()
+    if file_sha256(settings_path) == hashlib.sha256(rendered).hexdigest():
+        print("Application configuration unchanged, settings.py left as is")
+        return
+    partial = f"{settings_path}.tmp-{os.getpid()}"
+    with open(partial, 'wb') as file:
+        file.write(rendered)
+    shutil.copymode(settings_path, partial)
+    os.replace(partial, settings_path)
     print("Application configuration updated successfully!")
 
 
-def run_migrations(venv_path, code_dir):
-    """Starting migrations - manage.py migrate"""
+def settings_module(code_dir):
+    """Reads DJANGO_SETTINGS_MODULE from the project's manage.py"""
+    try:
+        with open(os.path.join(code_dir, "manage.py")) as file:
+            match = _DJANGO_SETTINGS.search(file.read())
+    except OSError:
+        match = None
+    return match.group(1) if match else "panorbit.settings"
+
+
+def management_command(name, *args, critical=True, **options):
+    """Describes a manage.py command for run_management_commands()"""
+    return {"name": name, "args": list(args), "options": options,
+            "critical": critical}
+
+
+def run_management_commands(venv_path, code_dir, commands):
+    """Runs manage.py commands with call_command() in one Django process
+
+    Django and the project settings are imported once for all commands.
+    A failing critical command stops the remaining ones. Returns a list of
+    {"command", "ok", "error", "seconds"} dicts, one per command that ran.
+    """
+    python_path = os.path.join(venv_path, "bin", "python3")
+    started = time.monotonic()
+    result = stream_command([python_path, "-c", MANAGEMENT_RUNNER,
+                             settings_module(code_dir), json.dumps(commands)],
+                            cwd=code_dir,
+                            echo=lambda line: bool(line.strip()) and not
+                            line.startswith(MANAGEMENT_RESULT_MARKER))
+
+    results = None
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith(MANAGEMENT_RESULT_MARKER):
+            try:
+                results = json.loads(line[len(MANAGEMENT_RESULT_MARKER):])
+            except json.JSONDecodeError as error:
+                print("Error: Could not read the results of the management "
+                      f"commands: {error}")
+                sys.exit(1)
+            break
+    if results is None:
+        print("Error: Failed to start Django for management commands")
+        print(result.stdout)
+        sys.exit(1)
+
+    for entry in results:
+        if entry["ok"]:
+            print(f"{entry['command']} finished in {entry['seconds']:.1f}s")
+        elif any(command["name"] == entry["command"] and command["critical"]
+                 for command in commands):
+            print(f"Error: {entry['command']} failed")
+            print(entry["error"])
+    print(f"Management commands took {time.monotonic() - started:.1f}s "
+          "including Django startup")
+    return results
+
+
+def migration_files_fingerprint(code_dir):
+    """Hashes every models.py and migrations/*.py file of the project"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(code_dir):
+        dirs[:] = sorted(name for name in dirs
+                         if name not in (".git", "venv", "__pycache__",
+                                         "node_modules"))
+        in_migrations = os.path.basename(root) == "migrations"
+        for name in sorted(files):
+            if name == "models.py" or (in_migrations
+                                       and name.endswith(".py")):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, code_dir).encode())
+                digest.update(file_sha256(path).encode())
+    return digest.hexdigest()
+
+
+def applied_migrations_fingerprint(db_user, db_password, db_name):
+    """Hashes the django_migrations table, or None if it cannot be read"""
+    output = mysql_query(db_user, db_password, db_name,
+                         "SELECT app, name FROM django_migrations "
+                         "ORDER BY app, name;")
+    if output is None:
+        return None
+    return hashlib.sha256(output.encode()).hexdigest()
+
+
+def search_index_fingerprint(code_dir):
+    """Hashes the search index definitions (search_indexes.py, templates)"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(code_dir):
+        dirs[:] = sorted(name for name in dirs
+                         if name not in (".git", "venv", "__pycache__",
+                                         "node_modules"))
+        in_templates = f"{os.sep}search{os.sep}indexes" in root + os.sep
+        for name in sorted(files):
+            if name == "search_indexes.py" or in_templates:
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, code_dir).encode())
+                digest.update(file_sha256(path).encode())
+    return digest.hexdigest()
+
+
+def search_index_location(code_dir):
+    """Identifies the checkout the search index was last built for
+
+    File-based backends such as Whoosh keep the index inside the project,
+    so a fresh checkout (a deploy without --incremental, or a new release)
+    starts with an empty index. A random ID is kept next to the code
+    directory; it disappears with that directory, which forces a rebuild.
+    """
+    marker = os.path.join(os.path.dirname(os.path.abspath(code_dir)),
+                          ".search-index-id")
+    try:
+        with open(marker) as file:
+            token = file.read().strip()
+    except FileNotFoundError:
+        token = ""
+    if not token:
+        token = secrets.token_hex(16)
+        with open(marker, "w") as file:
+            file.write(token)
+    return f"{os.path.realpath(code_dir)}:{token}"
+
+
+def search_index_command(index_state, schema, now, workers=0,
+                         batch_size=None, full_reindex=False, location=None):
+    """Chooses between a full rebuild_index and an incremental update_index
+
+    update_index is limited to records changed since the last successful
+    index run (plus an hour of margin). A full rebuild is used on the first
+    run, when the index definitions changed, when the index was built for
+    another checkout (see search_index_location()) or when asked for.
+    """
+    options = {"workers": workers}
+    if batch_size:
+        options["batchsize"] = batch_size
+
+    updated_at = index_state.get("updated_at")
+    if (full_reindex or updated_at is None
+            or index_state.get("schema") != schema
+            or index_state.get("location") != location):
+        return management_command("rebuild_index", critical=False,
+                                  interactive=False, **options)
+
+    age = int((now - updated_at) // 3600) + 1
+    return management_command("update_index", critical=False, age=age,
+                              **options)
+
+
+def run_migrations(venv_path, code_dir, db_user=None, db_password=None,
+                   db_name=None, cache_dir=None, force_migrate=False,
+                   index_workers=0, index_batch_size=None,
+                   full_reindex=False):
+    """Starting migrations - manage.py migrate
+
+    With a cache directory, makemigrations and migrate are skipped while
+    the project's models/migration files and the applied-migration table
+    are the same as after the last successful run, and the search index is
+    updated incrementally instead of being rebuilt.
+    """
     python_path = os.path.join(venv_path, "bin", "python3")
 
     if not os.path.exists(python_path):
@@ -262,68 +2378,1325 @@ def run_migrations(venv_path, code_dir):
         print("Error: manage.py not found")
         sys.exit(1)
 
-    result = subprocess.run([python_path, manage_path, "makemigrations"],
-                            capture_output=True,
-                            text=True)
-    if result.returncode != 0:
-        print("Error: makemigrations failed")
-        print(result.stderr)
+    state_path = index_path = None
+    if cache_dir and db_name:
+        state_path = state_file(cache_dir, "migrations", db_name)
+        index_path = state_file(cache_dir, "search-index", db_name)
+        files = migration_files_fingerprint(code_dir)
+
+    state = read_json_file(state_path) if state_path else {}
+    index_state = read_json_file(index_path) if index_path else {}
+    index_schema = search_index_fingerprint(code_dir)
+    index_location = search_index_location(code_dir) if index_path else None
+    index_started = time.time()
+    commands = [search_index_command(index_state, index_schema,
+                                     index_started, index_workers,
+                                     index_batch_size, full_reindex,
+                                     index_location)]
+    if (state_path and not force_migrate and state.get("files") == files
+            and state.get("applied") is not None
+            and state.get("applied") == applied_migrations_fingerprint(
+                db_user, db_password, db_name)):
+        print("Migrations unchanged, skipping makemigrations and migrate")
+    else:
+        commands[:0] = [
+            management_command("makemigrations", interactive=False),
+            management_command("migrate", interactive=False),
+        ]
+
+    results = run_management_commands(venv_path, code_dir, commands)
+    failed = {result["command"] for result in results if not result["ok"]}
+
+    if "makemigrations" in failed or "migrate" in failed:
         sys.exit(1)
+    if "migrate" in (result["command"] for result in results) and state_path:
+        write_json_file(state_path, {
+            "files": files,
+            "applied": applied_migrations_fingerprint(
+                db_user, db_password, db_name),
+        })
+
+    index_name = commands[-1]["name"]
+    if index_name in failed:
+        print(f"Warning: {index_name} failed (non-critical)")
+    else:
+        if index_path:
+            write_json_file(index_path, {"schema": index_schema,
+                                         "location": index_location,
+                                         "updated_at": index_started})
+        if index_name == "rebuild_index":
+            print("Search index rebuilt successfully")
+        else:
+            print("Search index updated successfully")
 
-    result = subprocess.run([python_path, manage_path, "migrate"],
-                            capture_output=True,
-                            text=True)
-    if result.returncode != 0:
-        print("Error: migrate failed")
-        print(result.stderr)
+    print("Migrations completed successfully!")
+
+
+def static_root(code_dir):
+    """Where collectstatic puts the static files: next to the code"""
+    return os.path.join(os.path.dirname(os.path.abspath(code_dir)), "static")
+
+
+def compressed_static(data, digest, suffix, compress, cache_dir=None):
+    """Compresses data, or takes the result for this digest from the cache"""
+    cached = None
+    if cache_dir:
+        cached = os.path.join(cache_dir, "static", digest[:2],
+                              digest + suffix)
+        try:
+            with open(cached, "rb") as file:
+                return file.read(), True
+        except OSError:
+            pass
+    result = compress(data)
+    if cached:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        partial = f"{cached}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(partial, "wb") as file:
+            file.write(result)
+        os.replace(partial, cached)
+    return result, False
+
+
+def gzip_compress(data):
+    """Gzips data with a zero mtime, so equal content compresses equally
+
+    gzip.compress() only takes mtime from Python 3.8 on.
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9,
+                       mtime=0) as file:
+        file.write(data)
+    return buffer.getvalue()
+
+
+def compress_static_file(path, cache_dir=None):
+    """Writes path.gz, and path.br when brotli is installed
+
+    A compressed copy is only kept when it is smaller than the file.
+    Returns how many copies had to be compressed (not found in the cache).
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+    encoders = [(".gz", gzip_compress)]
+    if brotli is not None:
+        encoders.append((".br", lambda data: brotli.compress(data)))
+
+    compressed = 0
+    for suffix, compress in encoders:
+        result, hit = compressed_static(data, digest, suffix, compress,
+                                        cache_dir)
+        compressed += not hit
+        if len(result) < len(data):
+            with open(path + suffix, "wb") as file:
+                file.write(result)
+            shutil.copystat(path, path + suffix)
+    return compressed
+
+
+def compress_static(root, cache_dir=None, jobs=None):
+    """Pre-compresses the text-like static files in parallel
+
+    The front web server can then send them as they are (nginx
+    gzip_static/brotli_static) instead of compressing on every request.
+    Files whose content was compressed in an earlier deploy are taken from
+    <cache-dir>/static instead of being compressed again.
+    """
+    paths = []
+    for current, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(current, name)
+            if (name.lower().endswith(STATIC_COMPRESSIBLE)
+                    and os.path.getsize(path) >= STATIC_MIN_SIZE):
+                paths.append(path)
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        compressed = sum(executor.map(
+            lambda path: compress_static_file(path, cache_dir), paths))
+    formats = "gzip and brotli" if brotli is not None else "gzip"
+    print(f"Pre-compressed {len(paths)} static files ({formats}), "
+          f"{compressed} new compressions")
+    return paths
+
+
+def collect_static(venv_path, code_dir, cache_dir=None):
+    """Collects the static files with content-hashed names and compresses them
+
+    collectstatic uses ManifestStaticFilesStorage (see
+    application_configuration()), which adds the content hash to every
+    file name, so the files can be cached forever by browsers.
+    """
+    print("Collecting static files...")
+    results = run_management_commands(venv_path, code_dir, [
+        management_command("collectstatic", interactive=False, verbosity=0),
+    ])
+    if not all(result["ok"] for result in results):
         sys.exit(1)
+    root = static_root(code_dir)
+    if os.path.isdir(root):
+        compress_static(root, cache_dir)
+    return root
+
 
-    result = subprocess.run([python_path, manage_path, "rebuild_index"],
-                            capture_output=True,
-                            text=True)
+def compile_bytecode(venv_path, code_dir):
+    """Precompiles the virtualenv and the code, so workers start warm
+
+    compileall uses one process per CPU. Files that do not compile (e.g.
+    templates for other Python versions shipped in some packages) only
+    produce a warning, as they are never imported.
+    """
+    print("Compiling bytecode...")
+    python_path = os.path.join(venv_path, "bin", "python3")
+    result = run_command([python_path, "-m", "compileall", "-q", "-j", "0",
+                          "-x", r"/\.git/", venv_path, code_dir],
+                         capture_output=True, text=True)
     if result.returncode != 0:
-        print("Warning: rebuild_index failed (non-critical)")
-    else:
-        print("Search index rebuilt successfully")
+        print("Warning: Some files could not be compiled")
 
-    print("Migrations completed successfully!")
 
+def profile_imports(venv_path, code_dir, importtime=False, limit=15):
+    """Reports the imports that dominate Django startup (-X importtime)
 
-def start_server(venv_path, code_dir):
-    """The Runserver - manage.py Runserver"""
+    Starts a fresh interpreter that only runs django.setup(), prints the
+    slowest imports by cumulative time and adds the full list to the deploy
+    report. Does nothing unless importtime is set.
+    """
+    if not importtime:
+        return None
     python_path = os.path.join(venv_path, "bin", "python3")
-    manage_path = os.path.join(code_dir, "manage.py")
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module(code_dir))
+    started = time.perf_counter()
+    result = run_command([python_path, "-X", "importtime", "-c",
+                          "import django; django.setup()"],
+                         cwd=code_dir, env=env, capture_output=True,
+                         text=True)
+    seconds = time.perf_counter() - started
+    if result.returncode != 0:
+        print("Warning: Django did not start, no import time report")
+        print(result.stderr[-2000:])
+        return None
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = _IMPORT_TIME.match(line)
+        if match:
+            imports.append({"module": match.group(4),
+                            "depth": len(match.group(3)) // 2,
+                            "self_us": int(match.group(1)),
+                            "cumulative_us": int(match.group(2))})
+    imports.sort(key=lambda entry: -entry["cumulative_us"])
+    metrics.add("import_times", {"startup_seconds": round(seconds, 4),
+                                 "imports": imports})
+
+    print(f"Django startup took {seconds:.2f}s; slowest imports:")
+    print(f"{'Module':<48}{'Self (ms)':>12}{'Total (ms)':>12}")
+    for entry in imports[:limit]:
+        print(f"{entry['module']:<48}{entry['self_us'] / 1000:>12.1f}"
+              f"{entry['cumulative_us'] / 1000:>12.1f}")
+    return imports
+
+
+def default_workers():
+    """Returns the default number of server workers: 2 x usable CPUs + 1"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return 2 * cpus + 1
+
+
+def install_server(venv_path, server="runserver", offline=False):
+    """Installs gunicorn into the virtualenv when it is the chosen server"""
+    if server != "gunicorn":
+        return
+    if os.path.exists(os.path.join(venv_path, "bin", "gunicorn")):
+        return
+    if offline:
+        print("Error: gunicorn is not installed (offline mode)")
+        sys.exit(1)
+
+    print("Installing gunicorn...")
+    result = stream_command([os.path.join(venv_path, "bin", "pip"), "install",
+                             "gunicorn"])
+    if result.returncode != 0:
+        print("Error: Failed to install gunicorn")
+        print(result.stdout)
+        sys.exit(1)
+
+
+def running_master(pid_file):
+    """Returns the PID of a live gunicorn master from pid_file, or None"""
+    try:
+        with open(pid_file) as file:
+            pid = int(file.read().strip())
+        with open(f"/proc/{pid}/cmdline", "rb") as file:
+            cmdline = file.read()
+    except (OSError, ValueError):
+        return None
+    return pid if b"gunicorn" in cmdline else None
+
+
+def gunicorn_command(venv_path, code_dir, port=8001, workers=None,
+                     threads=1, max_requests=1000, pid_file="gunicorn.pid"):
+    """Builds the command line of a pre-fork gunicorn server"""
+    wsgi_module = settings_module(code_dir).rsplit(".", 1)[0] + ".wsgi"
+    jitter = max(1, max_requests // 10) if max_requests else 0
+    return [
+        os.path.join(venv_path, "bin", "python3"),
+        os.path.join(venv_path, "bin", "gunicorn"),
+        "--chdir", code_dir,
+        "--bind", f"0.0.0.0:{port}",
+        "--workers", str(workers or default_workers()),
+        "--threads", str(threads),
+        "--max-requests", str(max_requests),
+        "--max-requests-jitter", str(jitter),
+        "--graceful-timeout", "30",
+        "--pid", os.path.abspath(pid_file),
+        f"{wsgi_module}:application",
+    ]
+
+
+def list_releases(app_dir):
+    """Returns the release directories, oldest first"""
+    releases_dir = os.path.join(os.path.abspath(app_dir), "releases")
+    try:
+        names = os.listdir(releases_dir)
+    except FileNotFoundError:
+        return []
+    names.sort(key=lambda name: name.rsplit("-", 1)[-1])
+    return [os.path.join(releases_dir, name) for name in names]
+
+
+def current_release(app_dir):
+    """Returns the release the current symlink points to, or None"""
+    current = os.path.join(os.path.abspath(app_dir), "current")
+    if not os.path.islink(current):
+        return None
+    return os.path.realpath(current)
+
+
+def check_release(venv_path, code_dir):
+    """Readiness check of a built release before it is switched to"""
+    print("Checking the new release...")
+    results = run_management_commands(venv_path, code_dir,
+                                      [management_command("check")])
+    if not all(result["ok"] for result in results):
+        print("Error: The new release failed its checks, "
+              "the current release keeps serving")
+        sys.exit(1)
+
+
+def activate_release(app_dir, release_dir):
+    """Atomically points the current symlink at release_dir"""
+    app_dir = os.path.abspath(app_dir)
+    current = os.path.join(app_dir, "current")
+    partial = f"{current}.tmp-{os.getpid()}"
+    os.symlink(os.path.relpath(release_dir, app_dir), partial)
+    os.replace(partial, current)
+    print(f"Switched current release to {os.path.basename(release_dir)}")
+
+
+def prune_releases(app_dir, keep=5):
+    """Removes the oldest releases, keeping keep of them and the current"""
+    current = current_release(app_dir)
+    releases = list_releases(app_dir)
+    for release in releases[:max(0, len(releases) - keep)]:
+        if os.path.realpath(release) != current:
+            print(f"Removing old release {os.path.basename(release)}")
+            shutil.rmtree(release, ignore_errors=True)
+
+
+def rollback_release(app_dir):
+    """Switches current back to the release deployed before it"""
+    current = current_release(app_dir)
+    releases = [os.path.realpath(release)
+                for release in list_releases(app_dir)]
+    if current not in releases or releases.index(current) == 0:
+        print("Error: There is no earlier release to roll back to")
+        sys.exit(1)
+    activate_release(app_dir, releases[releases.index(current) - 1])
+
+
+def handoff_server(pid, pid_file, timeout=60):
+    """Replaces a running gunicorn master with one for the new release
+
+    SIGUSR2 makes the old master start a new master from the same command
+    line, which resolves the current symlink again. Once the new master
+    has written its PID file the old one gets SIGTERM and stops after its
+    workers finish their requests.
+    """
+    os.kill(pid, signal.SIGUSR2)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        new_pid = running_master(pid_file)
+        if new_pid is not None and new_pid != pid:
+            os.kill(pid, signal.SIGTERM)
+            print(f"Handed over from gunicorn master {pid} to {new_pid}")
+            return
+        time.sleep(0.2)
+    print("Error: The new gunicorn master did not start, "
+          f"master {pid} keeps serving")
+    sys.exit(1)
+
+
+def port_in_use(port):
+    """Tells whether another process already listens on a TCP port"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            probe.bind(("", port))
+        except OSError:
+            return True
+    return False
+
+
+def start_server(venv_path, code_dir, server="runserver", port=8001,
+                 workers=None, threads=1, max_requests=1000,
+                 pid_file="gunicorn.pid", releases=False, detach=False,
+                 cpus=None, log_name="server.log"):
+    """The Runserver - manage.py Runserver or a gunicorn process pool
+
+    If a gunicorn master from an earlier deploy is still running, it is
+    sent SIGHUP instead: it starts workers with the new code and stops the
+    old ones once they have finished their requests. In release mode the
+    master itself is replaced (see handoff_server()), so the new release's
+    virtualenv is used as well.
+
+    With `cpus`, the server (and every process it forks) is pinned to
+    that set of CPUs.
+
+    A new server is only started on a free port: otherwise it could not
+    listen, and the readiness check would measure the previous server.
+
+    Returns the started process, or None when a running master took over.
+    A server started in the foreground is waited for with wait_for_servers().
+    """
+    if server == "gunicorn":
+        pid = running_master(pid_file)
+        if pid is not None and releases:
+            handoff_server(pid, pid_file)
+            return None
+        if pid is not None:
+            os.kill(pid, signal.SIGHUP)
+            print(f"Reloaded running gunicorn master {pid} gracefully")
+            return None
+
+        command = gunicorn_command(venv_path, code_dir, port, workers,
+                                   threads, max_requests, pid_file)
+        print(f"Starting gunicorn on port {port} with "
+              f"{command[command.index('--workers') + 1]} workers...")
+    else:
+        python_path = os.path.join(venv_path, "bin", "python3")
+        manage_path = os.path.join(code_dir, "manage.py")
+        command = [python_path, manage_path, "runserver", f"0:{port}"]
+        print(f"Starting Django server on port {port}...")
+
+    if port_in_use(port):
+        print(f"Error: Port {port} is already in use, the new server could "
+              "not listen on it; stop the previous server first")
+        sys.exit(1)
+
+    if cpus:
+        print(f"Pinning the server on port {port} to CPUs "
+              f"{','.join(map(str, sorted(cpus)))}")
+    preexec_fn = (functools.partial(os.sched_setaffinity, 0, cpus)
+                  if cpus else None)
+
+    if detach:
+        log_path = os.path.join(os.path.dirname(os.path.abspath(code_dir)),
+                                log_name)
+        with open(log_path, "ab") as log:
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                                       stdout=log, stderr=subprocess.STDOUT,
+                                       start_new_session=True,
+                                       preexec_fn=preexec_fn)
+        print(f"Server running in the background (PID {process.pid}), "
+              f"output in {log_path}")
+        return process
 
-    print("Starting Django server on port 8001...")
     print("Press Ctrl+C to stop the server")
     print("-" * 50)
 
-    subprocess.run([python_path, manage_path, "runserver", "0:8001"])
+    return subprocess.Popen(command, preexec_fn=preexec_fn)
 
 
-def main():
-    """Main deployment workflow"""
-    version = parse_arguments()
-    print(f"Deploying version: {version}")
+def cpu_sets(count):
+    """Splits the usable CPUs into `count` sets of neighbouring CPUs
 
-    os_type = check_os()
-    print(f"Detected OS: {os_type}")
+    With more instances than CPUs, the instances share CPUs round-robin.
+    Returns None for every instance where CPU affinity is not supported.
+    """
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return [None] * count
+    if count >= len(cpus):
+        return [{cpus[index % len(cpus)]} for index in range(count)]
+    size, extra = divmod(len(cpus), count)
+    sets = []
+    start = 0
+    for index in range(count):
+        end = start + size + (index < extra)
+        sets.append(set(cpus[start:end]))
+        start = end
+    return sets
+
+
+def instance_pid_file(pid_file, port):
+    """Returns the gunicorn PID file of the instance on `port`"""
+    root, ext = os.path.splitext(pid_file)
+    return f"{root}-{port}{ext}"
+
+
+def start_instances(venv_path, code_dir, args, releases=False):
+    """Starts --instances servers on consecutive ports from --port
+
+    With a single instance this is start_server() as before. With more,
+    each instance has its own PID file and log, is pinned to its own set
+    of CPUs (unless --no-cpu-pinning) and by default gets 2 x its CPUs + 1
+    gunicorn workers. Returns a list of {"port", "cpus", "pid_file",
+    "process"} dicts.
+    """
+    if args.instances == 1:
+        process = start_server(venv_path, code_dir, args.server, args.port,
+                               args.workers, args.threads, args.max_requests,
+                               args.pid_file, releases=releases,
+                               detach=args.detach)
+        return [{"port": args.port, "cpus": None, "pid_file": args.pid_file,
+                 "process": process}]
+
+    if args.no_cpu_pinning:
+        sets = [None] * args.instances
+    else:
+        sets = cpu_sets(args.instances)
+    instances = []
+    for index, cpus in enumerate(sets):
+        port = args.port + index
+        workers = args.workers
+        if workers is None and cpus:
+            workers = 2 * len(cpus) + 1
+        pid_file = instance_pid_file(args.pid_file, port)
+        process = start_server(venv_path, code_dir, args.server, port,
+                               workers, args.threads, args.max_requests,
+                               pid_file, releases=releases,
+                               detach=args.detach, cpus=cpus,
+                               log_name=f"server-{port}.log")
+        instances.append({"port": port,
+                          "cpus": sorted(cpus) if cpus else None,
+                          "pid_file": pid_file, "process": process})
+    return instances
+
+
+def write_upstream_config(path, ports, name="django"):
+    """Writes an nginx upstream block balancing over the local instances"""
+    servers = "".join(f"    server 127.0.0.1:{port} max_fails=3 "
+                      f"fail_timeout=10s;\n" for port in ports)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    partial = f"{path}.tmp-{os.getpid()}"
+    with open(partial, "w") as file:
+        file.write(f"# Written by deploy.py, do not edit\n"
+                   f"upstream {name} {{\n"
+                   f"    least_conn;\n"
+                   f"{servers}"
+                   f"    keepalive 32;\n"
+                   f"}}\n")
+    os.replace(partial, path)
+    print(f"Wrote the load balancer upstream for {len(ports)} instances "
+          f"to {path}")
+
+
+def wait_for_servers(processes):
+    """Keeps the deploy running while foreground servers run"""
+    for process in processes:
+        while True:
+            try:
+                process.wait()
+                break
+            except KeyboardInterrupt:
+                process.terminate()
+
+
+def http_get(url, timeout=5):
+    """Requests a URL; returns (status, seconds to first byte, seconds)"""
+    started = time.perf_counter()
+    try:
+        response = urllib.request.urlopen(url, timeout=timeout)
+    except urllib.error.HTTPError as error:
+        response = error
+    first_byte = time.perf_counter() - started
+    with response:
+        response.read()
+    return response.getcode(), first_byte, time.perf_counter() - started
+
+
+def wait_until_ready(url, started, process=None, timeout=60, interval=0.1):
+    """Polls a URL until the server answers with a status below 500
+
+    Returns {"url", "status", "startup_seconds", "first_byte_seconds"},
+    the time since `started` (a perf_counter() value taken when the server
+    was launched) and the time to first byte of the first answer, or None
+    if the server exited or did not answer within the timeout.
+
+    Without a process (a running gunicorn master took over, see
+    start_server()) the answer may come from workers of the previous
+    deploy, so startup_seconds is None: there is no cold start to measure.
+    """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process is not None and process.poll() is not None:
+            return None
+        try:
+            status, first_byte, _ = http_get(url, timeout=interval + 5)
+        except (OSError, urllib.error.URLError):
+            time.sleep(interval)
+            continue
+        if status < 500:
+            startup = None
+            if process is not None:
+                startup = round(time.perf_counter() - started, 4)
+            return {"url": url, "status": status,
+                    "startup_seconds": startup,
+                    "first_byte_seconds": round(first_byte, 4)}
+        time.sleep(interval)
+    return None
+
+
+def warm_up(base_url, paths):
+    """Requests each hot URL once, so lazy imports and caches are warm"""
+    results = []
+    for path in paths:
+        url = urllib.parse.urljoin(base_url, path)
+        try:
+            status, first_byte, seconds = http_get(url)
+        except (OSError, urllib.error.URLError) as error:
+            print(f"Warning: Warm-up request to {url} failed: {error}")
+            continue
+        results.append({"url": url, "status": status,
+                        "first_byte_seconds": round(first_byte, 4),
+                        "seconds": round(seconds, 4)})
+        print(f"Warmed up {url}: {status} in {seconds * 1000:.0f} ms")
+    return results
+
+
+def ready_message(ready):
+    """Describes the first answer of a server, with its startup time"""
+    answer = (f"HTTP {ready['status']}, first byte in "
+              f"{ready['first_byte_seconds'] * 1000:.0f} ms")
+    if ready["startup_seconds"] is None:
+        return (f"answering ({answer}); startup time not measured, as the "
+                "running gunicorn master took over")
+    return f"ready after {ready['startup_seconds']:.2f}s ({answer})"
+
+
+def check_readiness(url, warm_urls, started, process=None, timeout=60):
+    """Waits for the new server to answer, then warms it up
+
+    The startup latency and the warm-up timings go into the deploy
+    report. A server that does not become ready fails the deploy.
+    """
+    print(f"Waiting for {url} to answer...")
+    ready = wait_until_ready(url, started, process, timeout)
+    if ready is None:
+        print(f"Error: The server did not answer on {url} "
+              f"within {timeout:.0f}s")
+        if process is not None:
+            process.terminate()
+        sys.exit(1)
+    print(f"Server {ready_message(ready)}")
+    ready["warm_up"] = warm_up(url, warm_urls)
+    metrics.add("startup", ready)
+    return ready
+
+
+def instance_url(url, base_port, port):
+    """Points a URL on --port at the instance listening on `port`"""
+    parts = urllib.parse.urlsplit(url)
+    if parts.port != base_port:
+        return url
+    host = parts.hostname
+    if ":" in host:
+        host = f"[{host}]"
+    return urllib.parse.urlunsplit(parts._replace(netloc=f"{host}:{port}"))
+
+
+def check_instances_ready(instances, url, base_port, warm_urls, started,
+                          timeout=60):
+    """Waits for all instances to answer, then warms up each of them
+
+    The instances are polled at the same time, so each one's startup time
+    is measured from the common start. Their measurements go into the
+    deploy report under `instances`; if any instance does not become
+    ready, all of them are stopped and the deploy fails.
+    """
+    urls = [instance_url(url, base_port, instance["port"])
+            for instance in instances]
+    print(f"Waiting for {len(instances)} instances to answer...")
+    with ThreadPoolExecutor(max_workers=len(instances)) as pool:
+        results = list(pool.map(
+            stage_bound(lambda item: wait_until_ready(
+                item[0], started, item[1]["process"], timeout)),
+            zip(urls, instances)))
+
+    failed = [instance["port"] for instance, ready in zip(instances, results)
+              if ready is None]
+    if failed:
+        print(f"Error: The instances on ports "
+              f"{', '.join(map(str, failed))} did not answer within "
+              f"{timeout:.0f}s")
+        for instance in instances:
+            if instance["process"] is not None:
+                instance["process"].terminate()
+        sys.exit(1)
+
+    report = []
+    for instance, ready in zip(instances, results):
+        print(f"Instance on port {instance['port']} {ready_message(ready)}")
+        ready["warm_up"] = warm_up(ready["url"], warm_urls)
+        report.append({"port": instance["port"], "cpus": instance["cpus"],
+                       **ready})
+    metrics.add("instances", report)
+    return report
+
+
+def artifact_entries(root, top, exclude=()):
+    """Lists (archive name, path) of a directory tree, parents first"""
+    entries = [(top, os.path.join(root, top))]
+    for current, dirs, files in os.walk(os.path.join(root, top)):
+        dirs[:] = sorted(name for name in dirs if name not in exclude)
+        for name in dirs + sorted(files):
+            path = os.path.join(current, name)
+            entries.append((os.path.relpath(path, root), path))
+    return entries
+
+
+def package_artifact(app_dir, venv_path, code_dir, version, artifact_path):
+    """Packs the code and the populated virtualenv into a release artifact
+
+    It runs after compile_bytecode(), so the bytecode is included and hosts
+    do not compile it on first start. The manifest lists the SHA-256 of
+    every file and the target of every symlink; it is the first member of
+    the archive, so it can be read without unpacking the rest.
+    """
+    python_path = os.path.join(venv_path, "bin", "python3")
+    root = os.path.dirname(os.path.abspath(venv_path))
+    entries = (artifact_entries(root, os.path.basename(venv_path))
+               + artifact_entries(root, os.path.basename(code_dir),
+                                  exclude=(".git",)))
+    files = {}
+    for name, path in entries:
+        if os.path.islink(path):
+            files[name] = {"link": os.readlink(path)}
+        elif os.path.isfile(path):
+            files[name] = {"sha256": file_sha256(path)}
+    commit = git_command(["-C", code_dir, "rev-parse", "HEAD"],
+                         "Could not determine the built commit")
+    manifest = {
+        "version": version,
+        "commit": commit.stdout.strip(),
+        "created_at": time.time(),
+        "abi": interpreter_abi(python_path),
+        "venv": os.path.basename(venv_path),
+        "code": os.path.basename(code_dir),
+        "build_venv_path": os.path.abspath(venv_path),
+        "files": files,
+    }
+
+    print(f"Writing release artifact {artifact_path}...")
+    partial = f"{artifact_path}.tmp-{os.getpid()}"
+    with tarfile.open(partial, "w:gz") as tar:
+        data = json.dumps(manifest, indent=2, sort_keys=True).encode()
+        info = tarfile.TarInfo(ARTIFACT_MANIFEST)
+        info.size = len(data)
+        info.mtime = int(manifest["created_at"])
+        tar.addfile(info, io.BytesIO(data))
+        for name, path in entries:
+            tar.add(path, arcname=name, recursive=False)
+    os.replace(partial, artifact_path)
+    print(f"Built {version} ({manifest['commit'][:12]}), "
+          f"{len(files)} files, {os.path.getsize(artifact_path)} bytes")
+    return os.path.abspath(artifact_path)
+
+
+def read_artifact_manifest(artifact_path):
+    """Reads the manifest from the first member of a release artifact"""
+    try:
+        with tarfile.open(artifact_path, "r:gz") as tar:
+            member = tar.next()
+            if member is None or member.name != ARTIFACT_MANIFEST:
+                raise ValueError("the manifest is missing")
+            return json.load(tar.extractfile(member))
+    except (OSError, ValueError, tarfile.TarError) as error:
+        print(f"Error: {artifact_path} is not a release artifact: {error}")
+        sys.exit(1)
+
+
+def check_artifact_members(members, manifest):
+    """Refuses archive members that are not safe, plain and in the manifest"""
+    tops = (manifest["venv"], manifest["code"])
+    links = set()
+    for member in members:
+        parts = member.name.split("/")
+        if (os.path.isabs(member.name) or ".." in parts
+                or parts[0] not in tops):
+            return f"unexpected path {member.name}"
+        if not (member.isfile() or member.isdir() or member.issym()):
+            return f"unsupported member type of {member.name}"
+        if any("/".join(parts[:end]) in links for end in range(1, len(parts))):
+            return f"{member.name} is below a symlink"
+        if not member.isdir() and member.name not in manifest["files"]:
+            return f"{member.name} is not in the manifest"
+        if member.issym():
+            links.add(member.name)
+    return None
+
+
+def relocate_virtualenv(venv_path, build_venv_path):
+    """Rewrites the virtualenv path in scripts and pyvenv.cfg after a move"""
+    old = build_venv_path.encode()
+    new = os.path.abspath(venv_path).encode()
+    if old == new:
+        return
+    bin_dir = os.path.join(venv_path, "bin")
+    paths = [os.path.join(bin_dir, name) for name in os.listdir(bin_dir)]
+    paths.append(os.path.join(venv_path, "pyvenv.cfg"))
+    for path in paths:
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, "rb") as file:
+            data = file.read()
+        if old in data and b"\0" not in data:
+            with open(path, "r+b") as file:
+                file.write(data.replace(old, new))
+                file.truncate()
+
+
+def unpack_artifact(artifact_path, app_dir):
+    """Unpacks a release artifact into app_dir and verifies it
+
+    Every file is checked against the SHA-256 in the manifest and the
+    virtualenv interpreter must have the ABI it was built for. Scripts in
+    the virtualenv are then pointed at its new location.
+    """
+    manifest = read_artifact_manifest(artifact_path)
+    print(f"Unpacking release artifact {manifest['version']} "
+          f"({manifest['commit'][:12]})...")
+    with tarfile.open(artifact_path, "r:gz") as tar:
+        members = tar.getmembers()[1:]
+        problem = check_artifact_members(members, manifest)
+        if problem:
+            print(f"Error: Refusing to unpack {artifact_path}: {problem}")
+            sys.exit(1)
+        if hasattr(tarfile, "tar_filter"):
+            tar.extractall(app_dir, members, filter="tar")
+        else:
+            tar.extractall(app_dir, members)
+
+    files = manifest["files"]
+    hashed = sorted(name for name in files if "sha256" in files[name])
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        digests = dict(zip(hashed, executor.map(
+            lambda name: file_sha256(os.path.join(app_dir, name)), hashed)))
+    for name, entry in files.items():
+        path = os.path.join(app_dir, name)
+        if "link" in entry:
+            ok = os.path.islink(path) and os.readlink(path) == entry["link"]
+        else:
+            ok = digests[name] == entry["sha256"]
+        if not ok:
+            print(f"Error: {name} does not match the artifact manifest")
+            sys.exit(1)
 
-    check_prerequisites()
+    venv_path = os.path.join(app_dir, manifest["venv"])
+    code_dir = os.path.join(app_dir, manifest["code"])
+    python_path = os.path.join(venv_path, "bin", "python3")
+    if (not os.path.exists(python_path)
+            or interpreter_abi(python_path) != manifest["abi"]):
+        print(f"Error: The artifact needs a {manifest['abi']} interpreter "
+              "at the same path as on the build host")
+        sys.exit(1)
+    relocate_virtualenv(venv_path, manifest["build_venv_path"])
+    print(f"Verified {len(files)} files")
+    return venv_path, code_dir
+
+
+def build_stages():
+    """Declares the steps of building a release artifact"""
+    build = ("create_directory", "create_virtualenv", "pull_code",
+             "install_dependencies", "install_server", "compile_bytecode")
+    return [stage for stage in deployment_stages() if stage.name in build] + [
+        Stage("package_artifact", package_artifact,
+              inputs=["app_dir", "venv_path", "code_dir", "version",
+                      "artifact"],
+              outputs=["artifact_path"], after=["compile_bytecode"]),
+    ]
+
+
+def deployment_stages(artifact=False, venv_pool=False):
+    """Declares the deployment steps and what each of them depends on
+
+    With an artifact, unpacking it replaces creating the virtualenv,
+    cloning and installing the dependencies. With a virtualenv pool, a
+    warm virtualenv is claimed once the code (and so requirements.txt) is
+    there, instead of being created and populated.
+    """
+    if venv_pool and not artifact:
+        installed = "claim_virtualenv"
+        code_stages = [
+            Stage("pull_code", pull_code,
+                  inputs=["app_dir", "version", "repo_url", "cache_dir",
+                          "clone_mode", "capabilities"],
+                  outputs=["code_dir"]),
+            Stage("claim_virtualenv", claim_virtualenv,
+                  inputs=["app_dir", "code_dir", "venv_pool", "cache_dir",
+                          "offline", "incremental"],
+                  outputs=["venv_path"]),
+            Stage("compile_bytecode", compile_bytecode,
+                  inputs=["venv_path", "code_dir"],
+                  after=["claim_virtualenv", "install_server"]),
+        ]
+    elif artifact:
+        installed = "unpack_artifact"
+        code_stages = [
+            Stage("unpack_artifact", unpack_artifact,
+                  inputs=["artifact", "app_dir"],
+                  outputs=["venv_path", "code_dir"]),
+        ]
+    else:
+        installed = "install_dependencies"
+        code_stages = [
+            Stage("create_virtualenv", create_virtualenv,
+                  inputs=["app_dir", "incremental"], outputs=["venv_path"]),
+            Stage("pull_code", pull_code,
+                  inputs=["app_dir", "version", "repo_url", "cache_dir",
+                          "clone_mode", "capabilities"],
+                  outputs=["code_dir"]),
+            Stage("install_dependencies", install_dependencies,
+                  inputs=["venv_path", "code_dir", "cache_dir", "offline",
+                          "incremental"]),
+            Stage("compile_bytecode", compile_bytecode,
+                  inputs=["venv_path", "code_dir"],
+                  after=["install_dependencies", "install_server"]),
+        ]
+    return [
+        Stage("create_directory", create_directory,
+              inputs=["target_dir", "incremental", "releases", "version"],
+              outputs=["app_dir"]),
+    ] + code_stages + [
+        Stage("install_server", install_server,
+              inputs=["venv_path", "server", "offline"],
+              after=[installed]),
+        Stage("db_setting", db_setting,
+              inputs=["code_dir", "db_user", "db_password", "db_name",
+                      "sql_batch_rows", "sql_jobs", "cache_dir",
+                      "force_import"]),
+        Stage("application_configuration", application_configuration,
+              inputs=["code_dir", "db_user", "db_password",
+                      "settings_profile"]),
+        Stage("run_migrations", run_migrations,
+              inputs=["venv_path", "code_dir", "db_user", "db_password",
+                      "db_name", "cache_dir", "force_migrate",
+                      "index_workers", "index_batch_size", "full_reindex"],
+              after=[installed, "db_setting",
+                     "application_configuration"]),
+        Stage("collect_static", collect_static,
+              inputs=["venv_path", "code_dir", "cache_dir"],
+              outputs=["static_root"],
+              after=[installed, "application_configuration"]),
+        Stage("profile_imports", profile_imports,
+              inputs=["venv_path", "code_dir", "importtime"],
+              after=["run_migrations"]),
+    ]
+
+
+def serve_release(args):
+    """Starts or hands over the server for the current release"""
+    current = os.path.join(os.path.abspath(args.app_dir), "current")
+    return start_instances(os.path.join(current, "venv"),
+                           os.path.join(current, "simple-django-project"),
+                           args, releases=True)
+
+
+def write_report(path):
+    """Writes the JSON metrics report and prints the per-stage summary"""
+    write_json_file(path, metrics.report())
+    print("-" * 50)
+    print(metrics.summary())
+    print(f"Deploy report written to {path}")
+
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deploys (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    version TEXT,
+    wall_seconds REAL NOT NULL,
+    fingerprints TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stage_runs (
+    deploy_id INTEGER NOT NULL REFERENCES deploys (id),
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    wall_seconds REAL NOT NULL,
+    cpu_seconds REAL,
+    max_rss_kb INTEGER
+);
+CREATE INDEX IF NOT EXISTS stage_runs_by_stage
+    ON stage_runs (stage, status, deploy_id);
+"""
 
-    app_dir = create_directory()
-    venv_path = create_virtualenv(app_dir)
-    code_dir = pull_code(app_dir, version)
 
-    install_dependencies(venv_path, code_dir)
+def deploy_fingerprints(context):
+    """What this deploy was built from, as far as the stages got"""
+    fingerprints = {"interpreter": interpreter_fingerprint()}
+    if context.get("commit"):
+        fingerprints["commit"] = context["commit"]
+    code_dir = context.get("code_dir")
+    if code_dir and os.path.isdir(code_dir):
+        # Without its own .git, git would answer for an enclosing repository
+        if ("commit" not in fingerprints
+                and os.path.exists(os.path.join(code_dir, ".git"))):
+            try:
+                result = run_command(
+                    ["git", "-C", code_dir, "rev-parse", "HEAD"],
+                    capture_output=True, text=True)
+            except OSError:
+                result = None
+            if result is not None and result.returncode == 0:
+                fingerprints["commit"] = result.stdout.strip()
+        requirements_path = os.path.join(code_dir, "requirements.txt")
+        if os.path.exists(requirements_path):
+            fingerprints["requirements"] = file_sha256(requirements_path)
+        fingerprints["migrations"] = migration_files_fingerprint(code_dir)
+    return fingerprints
+
+
+def record_deploy(history_path, version, fingerprints, report, window=10,
+                  factor=1.5, min_seconds=1.0):
+    """Stores a deploy in the history and returns the stages that regressed
+
+    A successful stage has regressed when it took more than `factor` times
+    its median duration over the last `window` successful runs, and at
+    least `min_seconds` longer, so jitter in quick stages is ignored. At
+    least three earlier runs are needed before a stage is judged.
+    """
+    os.makedirs(os.path.dirname(history_path) or ".", exist_ok=True)
+    regressions = []
+    connection = sqlite3.connect(history_path, timeout=30)
+    try:
+        with connection:
+            connection.executescript(HISTORY_SCHEMA)
+            for stage in report["stages"]:
+                if stage["status"] != "ok":
+                    continue
+                durations = [row[0] for row in connection.execute(
+                    "SELECT wall_seconds FROM stage_runs "
+                    "WHERE stage = ? AND status = 'ok' "
+                    "ORDER BY deploy_id DESC LIMIT ?",
+                    (stage["name"], window))]
+                if len(durations) < 3:
+                    continue
+                median = statistics.median(durations)
+                seconds = stage["wall_seconds"]
+                if seconds > median * factor and \
+                        seconds - median >= min_seconds:
+                    regressions.append((stage["name"], seconds, median,
+                                        len(durations)))
+
+            deploy_id = connection.execute(
+                "INSERT INTO deploys (started_at, version, wall_seconds, "
+                "fingerprints) VALUES (?, ?, ?, ?)",
+                (report["started_at"], version, report["wall_seconds"],
+                 json.dumps(fingerprints, sort_keys=True))).lastrowid
+            connection.executemany(
+                "INSERT INTO stage_runs (deploy_id, stage, status, "
+                "wall_seconds, cpu_seconds, max_rss_kb) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(deploy_id, stage["name"], stage["status"],
+                  stage["wall_seconds"], stage["cpu_seconds"],
+                  stage["max_rss_kb"]) for stage in report["stages"]])
+    finally:
+        connection.close()
+    return regressions
+
+
+def report_regressions(regressions):
+    """Prints a warning for every stage that was slower than usual"""
+    for name, seconds, median, runs in regressions:
+        print(f"Warning: stage '{name}' took {seconds:.1f}s, "
+              f"{seconds / median:.1f}x its median of {median:.1f}s "
+              f"over the last {runs} deploys")
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    """Runs one deploy request and streams its output back to the client
+
+    The request is a JSON line with the command-line arguments, working
+    directory and MySQL credentials. Deploys run one at a time, each in a
+    fresh deploy.py process that claims its virtualenv from the pool.
+    """
+
+    def handle(self):
+        agent = self.server
+        request = json.loads(self.rfile.readline())
+        argv = request["argv"] + ["--venv-pool", agent.pool_dir, "--detach",
+                                  "--cache-dir", agent.cache_dir]
+        env = dict(os.environ,
+                   DEPLOY_DB_USER=request["db_user"],
+                   DEPLOY_DB_PASSWORD=request["db_password"],
+                   DEPLOY_DB_NAME=request["db_name"])
+        with agent.deploy_lock:
+            with subprocess.Popen([sys.executable,
+                                   os.path.abspath(__file__)] + argv,
+                                  cwd=request["cwd"], env=env,
+                                  stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT) as process:
+                for line in process.stdout:
+                    self.wfile.write(line)
+                    self.wfile.flush()
+        self.wfile.write(f"{AGENT_EXIT_MARKER}{process.returncode}\n"
+                         .encode())
+        agent.refill.set()
+
+
+class DeployAgent(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    """Unix socket server that runs deploys with warm virtualenvs"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool_dir, cache_dir):
+        self.pool_dir = pool_dir
+        self.cache_dir = cache_dir
+        self.deploy_lock = threading.Lock()
+        self.refill = threading.Event()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        os.makedirs(os.path.dirname(os.path.abspath(socket_path)),
+                    exist_ok=True)
+        old_umask = os.umask(0o077)
+        try:
+            super().__init__(socket_path, AgentHandler)
+        finally:
+            os.umask(old_umask)
+
+
+def run_agent(args):
+    """Serves deploy requests and keeps the virtualenv pool warm"""
+    pool_dir = os.path.join(args.cache_dir, "venv-pool")
+    os.makedirs(pool_dir, exist_ok=True)
+    for entry in os.listdir(pool_dir):
+        for name in os.listdir(os.path.join(pool_dir, entry)):
+            if name.startswith(("building-", "claimed-")):
+                shutil.rmtree(os.path.join(pool_dir, entry, name),
+                              ignore_errors=True)
+
+    agent = DeployAgent(args.agent_socket, pool_dir, args.cache_dir)
+
+    def keep_warm():
+        while True:
+            try:
+                refill_pool(pool_dir, args.pool_size, args.pool_fingerprints,
+                            args.cache_dir, args.offline)
+            except (OSError, SystemExit) as error:
+                print(f"Warning: could not refill the virtualenv pool: "
+                      f"{error}")
+            agent.refill.wait(300)
+            agent.refill.clear()
+
+    threading.Thread(target=keep_warm, daemon=True).start()
+    print(f"Deploy agent listening on {args.agent_socket}")
+    try:
+        agent.serve_forever()
+    finally:
+        agent.server_close()
+        os.unlink(args.agent_socket)
+
+
+def deploy_via_agent(socket_path, argv, args):
+    """Sends a deploy to the agent, prints its output, returns its status"""
+    forwarded = []
+    arguments = iter(argv)
+    for arg in arguments:
+        if arg == "--agent-socket":
+            next(arguments, None)
+        elif not arg.startswith("--agent-socket="):
+            forwarded.append(arg)
+    db_user, db_password, db_name = prompt_db_credentials(args.db_user,
+                                                          args.db_name)
+    request = {"argv": forwarded, "cwd": os.getcwd(), "db_user": db_user,
+               "db_password": db_password, "db_name": db_name}
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except OSError as error:
+            print(f"Error: No deploy agent at {socket_path}: {error}")
+            return 1
+        client.sendall(json.dumps(request).encode() + b"\n")
+        for line in client.makefile("r", errors="replace"):
+            if line.startswith(AGENT_EXIT_MARKER):
+                return int(line[len(AGENT_EXIT_MARKER):])
+            print(line, end="", flush=True)
+    print("Error: The deploy agent closed the connection")
+    return 1
+
+
+def build_release(args):
+    """Builds a release artifact that deploys without network access"""
+    print(f"Building version: {args.version}")
+    capabilities = probe_capabilities(args.cache_dir)
+    check_prerequisites(capabilities, required=("git", "venv", "pip"))
+
+    context = {
+        "version": args.version,
+        "target_dir": args.app_dir,
+        "incremental": args.incremental,
+        "releases": False,
+        "repo_url": args.repo_url,
+        "cache_dir": args.cache_dir,
+        "clone_mode": args.clone_mode,
+        "offline": args.offline,
+        "server": args.server,
+        "artifact": args.artifact,
+        "capabilities": capabilities,
+    }
+    _step_timeouts.clear()
+    _step_timeouts.update(args.step_timeouts)
+    metrics.reset()
+    try:
+        run_stages(build_stages(), context, jobs=args.jobs)
+    finally:
+        write_report(args.report)
 
-    db_user, db_password = db_setting(code_dir)
 
-    application_configuration(code_dir, db_user, db_password)
+def main():
+    """Main deployment workflow"""
+    args = parse_arguments()
+
+    if args.rollback:
+        # No readiness check: a rollback returns to a release that already
+        # served traffic, and there is nothing left to fall back to if it
+        # answered slowly, so the restored server is never stopped here
+        rollback_release(args.app_dir)
+        servers = serve_release(args)
+        if args.instances > 1:
+            write_upstream_config(args.upstream_conf,
+                                  [server["port"] for server in servers])
+        if not args.detach:
+            wait_for_servers([server["process"] for server in servers
+                              if server["process"] is not None])
+        return
+
+    if args.command == 'build':
+        build_release(args)
+        return
+    if args.command == 'agent':
+        run_agent(args)
+        return
+    if args.agent_socket:
+        sys.exit(deploy_via_agent(args.agent_socket, sys.argv[1:], args))
+
+    if args.artifact:
+        manifest = read_artifact_manifest(args.artifact)
+        args.version = args.version or manifest["version"]
+        if manifest["version"] != args.version:
+            print(f"Error: The artifact contains version "
+                  f"{manifest['version']}, not {args.version}")
+            sys.exit(1)
 
-    run_migrations(venv_path, code_dir)
+    print(f"Deploying version: {args.version}")
+    settings_profile = load_settings_profile(args.settings_profile)
 
-    start_server(venv_path, code_dir)
+    capabilities = probe_capabilities(args.cache_dir)
+    print(f"Detected OS: {capabilities.os_type}")
+    if args.artifact:
+        check_prerequisites(capabilities, required=("mysql",))
+    else:
+        check_prerequisites(capabilities)
+
+    db_user, db_password, db_name = prompt_db_credentials(args.db_user,
+                                                          args.db_name)
+
+    context = {
+        "version": args.version,
+        "target_dir": args.app_dir,
+        "incremental": args.incremental,
+        "releases": args.releases,
+        "repo_url": args.repo_url,
+        "cache_dir": args.cache_dir,
+        "clone_mode": args.clone_mode,
+        "offline": args.offline,
+        "sql_batch_rows": args.sql_batch_rows,
+        "sql_jobs": args.sql_jobs,
+        "force_import": args.force_import,
+        "force_migrate": args.force_migrate,
+        "index_workers": args.index_workers,
+        "index_batch_size": args.index_batch_size,
+        "full_reindex": args.full_reindex,
+        "server": args.server,
+        "db_user": db_user,
+        "db_password": db_password,
+        "db_name": db_name,
+        "capabilities": capabilities,
+        "artifact": args.artifact,
+        "importtime": args.importtime,
+        "venv_pool": args.venv_pool,
+        "settings_profile": settings_profile,
+    }
+    if args.artifact:
+        context["commit"] = manifest["commit"]
+    checkpoint = None
+    if args.cache_dir:
+        checkpoint = state_file(args.cache_dir, "checkpoints",
+                                os.path.abspath(args.app_dir))
+
+    _step_timeouts.clear()
+    _step_timeouts.update(args.step_timeouts)
+    metrics.reset()
+    try:
+        run_stages(deployment_stages(bool(args.artifact),
+                                     bool(args.venv_pool)), context,
+                   jobs=args.jobs,
+                   checkpoint=checkpoint, resume=args.resume)
+        if args.releases:
+            with measure_stage("activate_release"):
+                check_release(context["venv_path"], context["code_dir"])
+                activate_release(args.app_dir, context["app_dir"])
+                prune_releases(args.app_dir, args.keep_releases)
+        started = time.perf_counter()
+        if args.releases:
+            servers = serve_release(args)
+        else:
+            servers = start_instances(context["venv_path"],
+                                      context["code_dir"], args)
+        if args.ready_url:
+            with measure_stage("readiness"):
+                if len(servers) == 1:
+                    check_readiness(args.ready_url, args.warm_url, started,
+                                    servers[0]["process"],
+                                    args.ready_timeout)
+                else:
+                    check_instances_ready(servers, args.ready_url, args.port,
+                                          args.warm_url, started,
+                                          args.ready_timeout)
+        if len(servers) > 1:
+            write_upstream_config(args.upstream_conf,
+                                  [server["port"] for server in servers])
+    finally:
+        write_report(args.report)
+        if args.history:
+            try:
+                report_regressions(record_deploy(
+                    args.history, args.version, deploy_fingerprints(context),
+                    metrics.report(), factor=args.regression_factor))
+            except sqlite3.Error as error:
+                print(f"Warning: could not update deploy history: {error}")
+
+    if not args.detach:
+        wait_for_servers([server["process"] for server in servers
+                          if server["process"] is not None])
 
     print("All prerequisites checked successfully!")
 
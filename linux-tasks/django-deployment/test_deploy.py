@@ -0,0 +1,1863 @@
+"""
+Unit tests for deploy module.
+"""
+
+import gzip
+import http.server
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+from deploy import (Stage, run_stages, run_command, check_stage_graph,
+                    pull_code, update_mirror, install_dependencies,
+                    wheelhouse_path,
+                    create_virtualenv, interpreter_fingerprint,
+                    write_venv_fingerprint, file_sha256,
+                    iter_sql_statements, coalesce_inserts, import_sql_dump,
+                    split_sql_dump, import_sql_dump_parallel, db_setting,
+                    run_migrations, run_management_commands,
+                    management_command, search_index_command,
+                    search_index_location,
+                    gunicorn_command, start_server, default_workers,
+                    create_directory, activate_release, current_release,
+                    rollback_release, prune_releases, list_releases,
+                    handoff_server, command_label,
+                    write_report, record_deploy, stream_command,
+                    parse_arguments, probe_capabilities, Capabilities,
+                    check_prerequisites, package_artifact, unpack_artifact,
+                    read_artifact_manifest, compile_bytecode,
+                    profile_imports, metrics, pool_entry, claim_virtualenv,
+                    refill_pool, DeployAgent, deploy_via_agent,
+                    compress_static, compress_static_file, collect_static,
+                    application_configuration, load_settings_profile,
+                    wait_until_ready, warm_up, check_readiness,
+                    cpu_sets, start_instances, write_upstream_config,
+                    instance_url, measure_stage)
+from bench_deploy import (main as bench_main, compare_baseline, make_project,
+                          install_stubs, run_deploy)
+
+
+WORLD_DUMP = """\
+SET NAMES utf8;
+DROP TABLE IF EXISTS `city`;
+CREATE TABLE `city` (id int, country char(3));
+CREATE TABLE `country` (code char(3));
+LOCK TABLES `city` WRITE;
+INSERT INTO `city` VALUES (1,'AFG');
+INSERT INTO `city` VALUES (2,'AFG');
+UNLOCK TABLES;
+INSERT INTO `country` VALUES ('AFG');
+ALTER TABLE `city` ADD CONSTRAINT fk FOREIGN KEY (country)
+    REFERENCES country (code);
+"""
+FAKE_MYSQL_SESSIONS = ("import os, shutil, sys; shutil.copyfileobj("
+                       "sys.stdin, open(os.path.join(sys.argv[1], "
+                       "str(os.getpid())), 'w'))")
+FAKE_MYSQL_CLIENT = """\
+import os, sys
+with open(os.environ["FAKE_MYSQL_LOG"], "a") as log:
+    if "-e" in sys.argv:
+        log.write("query\\n")
+        print("world.city\\t" + os.environ.get("FAKE_MYSQL_CHECKSUM", "42"))
+    else:
+        sys.stdin.read()
+        log.write("import\\n")
+"""
+FAKE_CALL_COMMAND = """\
+import os
+
+
+class CommandError(Exception):
+    pass
+
+
+def call_command(name, *args, **options):
+    with open(os.environ["FAKE_DJANGO_LOG"], "a") as log:
+        log.write(name + "\\n")
+    if name in os.environ.get("FAKE_DJANGO_PARTIAL", "").split():
+        print(name + " done", end="", flush=True)
+    if name in os.environ.get("FAKE_DJANGO_FAIL", "").split():
+        raise CommandError(name + " exploded")
+"""
+FAKE_GUNICORN_MASTER = """\
+import os, signal, subprocess, sys, time
+pid_file = sys.argv[1]
+
+
+def reexec(signum, frame):
+    os.rename(pid_file, pid_file + ".oldbin")
+    child = subprocess.Popen([sys.executable, "-c",
+                              "import time; time.sleep(30)", "gunicorn"])
+    with open(pid_file, "w") as file:
+        file.write(str(child.pid))
+
+
+signal.signal(signal.SIGUSR2, reexec)
+with open(pid_file, "w") as file:
+    file.write(str(os.getpid()))
+print("ready", flush=True)
+time.sleep(30)
+"""
+FAKE_MYSQL = ("import shutil, sys; "
+              "shutil.copyfileobj(sys.stdin, open(sys.argv[1], 'w')); "
+              "sys.exit(int(sys.argv[2]))")
+
+
+def git(*args):
+    """Run git with a fixed identity and return its output."""
+    return subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+         *args],
+        check=True, capture_output=True, text=True).stdout.strip()
+
+
+def install_fake(bin_dir, name, source):
+    """Write an executable Python script called name into bin_dir."""
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, name)
+    with open(path, "w") as file:
+        file.write(f"#!{sys.executable}\n{source}")
+    os.chmod(path, 0o755)
+    return path
+
+
+def make_fake_django(root):
+    """Create a venv whose Django only logs the commands it is given."""
+    site = os.path.join(root, "site")
+    management = os.path.join(site, "django", "core", "management")
+    os.makedirs(management)
+    with open(os.path.join(site, "django", "__init__.py"), "w") as file:
+        file.write("def setup():\n    pass\n")
+    open(os.path.join(site, "django", "core", "__init__.py"), "w").close()
+    with open(os.path.join(management, "__init__.py"), "w") as file:
+        file.write(FAKE_CALL_COMMAND)
+
+    venv = os.path.join(root, "venv")
+    os.makedirs(os.path.join(venv, "bin"))
+    os.symlink(sys.executable, os.path.join(venv, "bin", "python3"))
+    return venv, site
+
+
+def make_upstream(root):
+    """Create a bare repository with a master branch and a v1 tag."""
+    work = os.path.join(root, "work")
+    upstream = os.path.join(root, "upstream.git")
+    git("init", "--quiet", "--initial-branch", "master", work)
+    for name in ("first", "second"):
+        with open(os.path.join(work, "version.txt"), "w") as file:
+            file.write(name)
+        git("-C", work, "add", "version.txt")
+        git("-C", work, "commit", "--quiet", "-m", name)
+    git("-C", work, "tag", "v1")
+    git("clone", "--quiet", "--bare", work, upstream)
+    return work, upstream
+
+
+class TestRunStages(unittest.TestCase):
+    """Test cases for the deployment stage scheduler."""
+
+    def test_outputs_flow_into_dependent_stages(self):
+        """Test that a stage receives the outputs of earlier stages."""
+        stages = [
+            Stage("double", lambda x: x * 2, inputs=["x"], outputs=["y"]),
+            Stage("pair", lambda y: (y, y + 1), inputs=["y"],
+                  outputs=["a", "b"]),
+        ]
+        context = run_stages(stages, {"x": 2})
+        self.assertEqual((context["a"], context["b"]), (4, 5))
+
+    def test_independent_stages_overlap(self):
+        """Test that independent stages run at the same time."""
+        barrier = threading.Barrier(2, timeout=5)
+        stages = [
+            Stage("first", barrier.wait),
+            Stage("second", barrier.wait),
+        ]
+        run_stages(stages, {}, jobs=2)
+
+    def test_after_orders_stages(self):
+        """Test that 'after' delays a stage until another has finished."""
+        order = []
+        stages = [
+            Stage("late", lambda: order.append("late"), after=["early"]),
+            Stage("early", lambda: order.append("early")),
+        ]
+        run_stages(stages, {})
+        self.assertEqual(order, ["early", "late"])
+
+    def test_failure_skips_dependent_stages(self):
+        """Test that a failing stage stops stages waiting on it."""
+        ran = []
+
+        def fail():
+            sys.exit(1)
+
+        stages = [
+            Stage("fail", fail, outputs=["value"]),
+            Stage("next", ran.append, inputs=["value"]),
+        ]
+        with self.assertRaises(SystemExit):
+            run_stages(stages, {})
+        self.assertEqual(ran, [])
+
+    def test_failure_terminates_running_commands(self):
+        """Test that a failing stage kills commands of running siblings."""
+        def fail():
+            time.sleep(0.2)
+            raise RuntimeError("boom")
+
+        def slow():
+            run_command([sys.executable, "-c", "import time; time.sleep(30)"])
+
+        started = time.monotonic()
+        stages = [Stage("fail", fail), Stage("slow", slow)]
+        with self.assertRaises(RuntimeError):
+            run_stages(stages, {}, jobs=2)
+        self.assertLess(time.monotonic() - started, 10)
+
+    def test_missing_input_is_rejected(self):
+        """Test that a graph with an unknown input is refused."""
+        stages = [Stage("orphan", print, inputs=["nothing"])]
+        with self.assertRaises(ValueError):
+            check_stage_graph(stages, {})
+
+
+class TestCheckpoints(unittest.TestCase):
+    """Test cases for resuming stages from a checkpoint file."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.checkpoint = os.path.join(self.tmp.name, "checkpoint.json")
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def stages(self, fail=False):
+        def build(version):
+            self.calls.append("build")
+            path = os.path.join(self.tmp.name, f"build-{version}")
+            os.makedirs(path, exist_ok=True)
+            return path
+
+        def configure(build_dir, password):
+            self.calls.append("configure")
+            return f"{build_dir}/settings"
+
+        def migrate(settings):
+            self.calls.append("migrate")
+            if fail:
+                raise RuntimeError("migration failed")
+
+        return [
+            Stage("build", build, inputs=["version"], outputs=["build_dir"]),
+            Stage("configure", configure, inputs=["build_dir", "db_password"],
+                  outputs=["settings"]),
+            Stage("migrate", migrate, inputs=["settings"]),
+        ]
+
+    def run_deploy(self, fail=False, resume=True, version="v1",
+                   password="secret"):
+        self.calls.clear()
+        with mock.patch("builtins.print"):
+            return run_stages(self.stages(fail),
+                              {"version": version, "db_password": password},
+                              checkpoint=self.checkpoint, resume=resume)
+
+    def test_resume_starts_at_failed_stage(self):
+        """Test that only the failed stage runs again on resume."""
+        with self.assertRaises(RuntimeError):
+            self.run_deploy(fail=True)
+        self.assertEqual(self.calls, ["build", "configure", "migrate"])
+        context = self.run_deploy()
+        self.assertEqual(self.calls, ["migrate"])
+        self.assertTrue(context["settings"].endswith("build-v1/settings"))
+
+    def test_changed_input_invalidates_later_stages(self):
+        """Test that a changed input reruns its stage and what follows."""
+        self.run_deploy()
+        self.run_deploy(version="v2")
+        self.assertEqual(self.calls, ["build", "configure", "migrate"])
+
+    def test_changed_secret_invalidates_stage(self):
+        """Test that a corrected password reruns the stages that use it."""
+        with self.assertRaises(RuntimeError):
+            self.run_deploy(fail=True)
+        self.run_deploy(password="corrected")
+        self.assertEqual(self.calls, ["configure", "migrate"])
+
+    def test_missing_output_path_invalidates_stage(self):
+        """Test that a stage reruns when the directory it made is gone."""
+        self.run_deploy()
+        os.rmdir(os.path.join(self.tmp.name, "build-v1"))
+        self.run_deploy()
+        self.assertEqual(self.calls, ["build", "configure", "migrate"])
+
+    def test_without_resume_everything_runs(self):
+        """Test that a normal run ignores and replaces the checkpoint."""
+        self.run_deploy()
+        self.run_deploy(resume=False)
+        self.assertEqual(self.calls, ["build", "configure", "migrate"])
+
+    def test_secrets_are_not_recorded(self):
+        """Test that secret inputs never reach the checkpoint file."""
+        self.run_deploy()
+        with open(self.checkpoint) as file:
+            self.assertNotIn("secret", file.read())
+
+
+class TestDeployMetrics(unittest.TestCase):
+    """Test cases for the per-stage and per-command metrics."""
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_command_usage_is_attributed_to_its_stage(self):
+        """Test that a command's CPU time and peak RSS count for its stage."""
+        def allocate():
+            run_command([sys.executable, "-c",
+                         "b = bytearray(64 * 1024 * 1024); sum(range(10**6))"])
+
+        run_stages([Stage("allocate", allocate),
+                    Stage("idle", time.sleep, inputs=["delay"])],
+                   {"delay": 0.1}, jobs=2)
+        report = metrics.report()
+        stages = {stage["name"]: stage for stage in report["stages"]}
+        self.assertEqual(stages["allocate"]["status"], "ok")
+        self.assertGreater(stages["allocate"]["max_rss_kb"], 64 * 1024)
+        self.assertGreater(stages["allocate"]["cpu_seconds"], 0)
+        self.assertEqual(stages["idle"]["commands"], 0)
+        self.assertGreaterEqual(stages["idle"]["wall_seconds"], 0.1)
+        [command] = report["commands"]
+        self.assertEqual(command["stage"], "allocate")
+        self.assertEqual(command["returncode"], 0)
+
+    def test_failed_stage_is_reported(self):
+        """Test that a failing stage is recorded with its status."""
+        def fail():
+            sys.exit(1)
+
+        with self.assertRaises(SystemExit):
+            run_stages([Stage("fail", fail)], {})
+        self.assertEqual(metrics.report()["stages"][0]["status"], "failed")
+
+    def test_command_label_hides_password(self):
+        """Test that mysql passwords never reach the report."""
+        label = command_label(["/usr/bin/mysql", "-uroot", "-psecret", "db"])
+        self.assertEqual(label, "mysql -uroot -p*** db")
+
+    def test_report_is_written_as_json(self):
+        """Test that the report file and the summary table are produced."""
+        run_stages([Stage("noop", lambda: None)], {})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "app", "deploy-report.json")
+            with mock.patch("builtins.print") as printed:
+                write_report(path)
+            with open(path) as file:
+                report = json.load(file)
+        self.assertEqual(report["stages"][0]["name"], "noop")
+        output = "\n".join(str(call.args[0]) for call in
+                           printed.call_args_list)
+        self.assertIn("noop", output)
+        self.assertIn("Total", output)
+
+
+class TestStreamCommand(unittest.TestCase):
+    """Test cases for the streaming subprocess runner."""
+
+    def test_only_the_tail_is_kept(self):
+        """Test that output is streamed but only the last lines are kept."""
+        with mock.patch("builtins.print") as printed:
+            result = stream_command(
+                [sys.executable, "-c",
+                 "import sys\nfor i in range(1000): print(i)\n"
+                 "print('oops', file=sys.stderr)"], tail_lines=3)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, "998\n999\noops")
+        self.assertEqual(printed.call_count, 1001)
+
+    def test_echo_predicate_hides_lines(self):
+        """Test that lines rejected by the echo predicate are not printed."""
+        with mock.patch("builtins.print") as printed:
+            result = stream_command(
+                [sys.executable, "-c", "print('shown'); print('@@hidden')"],
+                echo=lambda line: not line.startswith("@@"))
+        printed.assert_called_once_with("shown", flush=True)
+        self.assertIn("@@hidden", result.stdout)
+
+    def test_step_timeout_kills_command(self):
+        """Test that a command is stopped when its stage runs too long."""
+        results = []
+
+        def slow():
+            results.append(stream_command(
+                [sys.executable, "-c", "import time; time.sleep(30)"]))
+
+        started = time.monotonic()
+        with mock.patch.dict("deploy._step_timeouts", {"slow": 0.5}), \
+                mock.patch("builtins.print"):
+            run_stages([Stage("slow", slow)], {})
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertLess(results[0].returncode, 0)
+
+    def test_step_timeout_option(self):
+        """Test parsing and validation of --step-timeout."""
+        args = parse_arguments(["--version", "v1", "--step-timeout",
+                                "install_dependencies=90"])
+        self.assertEqual(args.step_timeouts, {"install_dependencies": 90.0})
+        with mock.patch("sys.stderr"), self.assertRaises(SystemExit):
+            parse_arguments(["--version", "v1", "--step-timeout", "nope=1"])
+
+
+class TestDeployHistory(unittest.TestCase):
+    """Test cases for the deploy history and regression warnings."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.history = os.path.join(self.tmp.name, "deploy-history.sqlite3")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def deploy(self, status="ok", **durations):
+        report = {
+            "started_at": time.time(),
+            "wall_seconds": sum(durations.values()),
+            "stages": [{"name": name, "status": status, "wall_seconds": value,
+                        "cpu_seconds": 0.0, "max_rss_kb": 0}
+                       for name, value in durations.items()],
+        }
+        return record_deploy(self.history, "v1", {"commit": "abc"}, report)
+
+    def test_slow_stage_is_flagged(self):
+        """Test that a stage far above its median is reported."""
+        for seconds in (10, 11, 9):
+            self.assertEqual(self.deploy(pip=seconds, git=2.0), [])
+        [(name, seconds, median, runs)] = self.deploy(pip=40, git=2.1)
+        self.assertEqual((name, seconds, median, runs), ("pip", 40, 10, 3))
+
+    def test_too_little_history_is_not_judged(self):
+        """Test that a stage needs three earlier runs to be compared."""
+        self.deploy(pip=10)
+        self.deploy(pip=10)
+        self.assertEqual(self.deploy(pip=100), [])
+
+    def test_small_absolute_changes_are_ignored(self):
+        """Test that quick stages do not warn about jitter."""
+        for _ in range(3):
+            self.deploy(check=0.1)
+        self.assertEqual(self.deploy(check=0.5), [])
+
+    def test_failed_runs_do_not_count(self):
+        """Test that failed stages are stored but not used as a baseline."""
+        for _ in range(3):
+            self.deploy(status="failed", pip=1)
+        self.assertEqual(self.deploy(pip=30), [])
+        connection = sqlite3.connect(self.history)
+        try:
+            rows = connection.execute(
+                "SELECT COUNT(*) FROM stage_runs").fetchone()[0]
+        finally:
+            connection.close()
+        self.assertEqual(rows, 4)
+
+
+FAKE_PROBE = """\
+import os, sys, time
+with open(os.environ["FAKE_PROBE_LOG"], "a") as log:
+    log.write(os.path.basename(sys.argv[0]) + "\\n")
+time.sleep(float(os.environ.get("FAKE_PROBE_DELAY", "0")))
+print(os.environ.get("FAKE_PROBE_VERSION", "8.0.36"))
+"""
+
+
+class TestProbeCapabilities(unittest.TestCase):
+    """Test cases for the cached prerequisite probes."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bin_dir = os.path.join(self.tmp.name, "bin")
+        self.cache = os.path.join(self.tmp.name, "cache")
+        self.log = os.path.join(self.tmp.name, "probes.log")
+        for name in ("mysql", "git", "python3"):
+            install_fake(self.bin_dir, name, FAKE_PROBE)
+        self.env = mock.patch.dict(os.environ, {
+            "PATH": self.bin_dir, "FAKE_PROBE_LOG": self.log})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def probed(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as file:
+            probed = file.read().split()
+        os.remove(self.log)
+        return sorted(probed)
+
+    def test_probes_are_cached_until_the_binary_changes(self):
+        """Test that only a replaced binary is probed again."""
+        capabilities = probe_capabilities(self.cache)
+        self.assertEqual(self.probed(), ["git", "mysql", "python3",
+                                         "python3"])
+        self.assertEqual(capabilities.version("mysql"), (8, 0, 36))
+
+        probe_capabilities(self.cache)
+        self.assertEqual(self.probed(), [])
+
+        os.remove(os.path.join(self.bin_dir, "mysql"))
+        install_fake(self.bin_dir, "mysql", FAKE_PROBE)
+        os.environ["FAKE_PROBE_VERSION"] = "8.4.0"
+        capabilities = probe_capabilities(self.cache)
+        self.assertEqual(self.probed(), ["mysql"])
+        self.assertEqual(capabilities.version("mysql"), (8, 4, 0))
+
+    def test_uncached_probes_run_in_parallel(self):
+        """Test that probes do not wait for each other."""
+        os.environ["FAKE_PROBE_DELAY"] = "0.5"
+        started = time.monotonic()
+        probe_capabilities(None)
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_missing_tool(self):
+        """Test that a binary missing from PATH is reported as None."""
+        os.remove(os.path.join(self.bin_dir, "git"))
+        self.assertIsNone(probe_capabilities(None).tools["git"])
+
+
+class TestCheckPrerequisites(unittest.TestCase):
+    """Test cases for the minimum version checks."""
+
+    def capabilities(self, **versions):
+        tools = {name: {"path": name, "ok": True, "version": "99.0"}
+                 for name in ("mysql", "git", "venv", "pip")}
+        for name, version in versions.items():
+            tools[name] = version and {"path": name, "ok": True,
+                                       "version": version}
+        return Capabilities("debian", tools)
+
+    def test_recent_versions_pass(self):
+        """Test that recent enough tools pass the check."""
+        with mock.patch("builtins.print"):
+            check_prerequisites(self.capabilities(mysql="8.0.36",
+                                                  pip="23.2.1"))
+
+    def test_old_versions_fail(self):
+        """Test that MySQL below 8.0 and pip below 19.0 are refused."""
+        for versions in ({"mysql": "5.7.44"}, {"pip": "18.1"}):
+            with mock.patch("builtins.print"), \
+                    self.assertRaises(SystemExit):
+                check_prerequisites(self.capabilities(**versions))
+
+    def test_missing_venv_fails(self):
+        """Test that a python3 without venv/ensurepip is refused."""
+        with mock.patch("builtins.print") as printed, \
+                self.assertRaises(SystemExit):
+            check_prerequisites(self.capabilities(venv=None))
+        self.assertIn("python3-venv", printed.call_args.args[0])
+
+
+class TestReleaseArtifact(unittest.TestCase):
+    """Test cases for building and unpacking release artifacts offline."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.build = os.path.join(self.root, "build")
+        self.venv = os.path.join(self.build, "venv")
+        os.makedirs(os.path.join(self.venv, "bin"))
+        os.makedirs(os.path.join(self.venv, "lib"))
+        os.symlink(sys.executable, os.path.join(self.venv, "bin", "python3"))
+        with open(os.path.join(self.venv, "bin", "tool"), "w") as file:
+            file.write(f"#!{self.venv}/bin/python3\nprint('tool')\n")
+        os.chmod(os.path.join(self.venv, "bin", "tool"), 0o755)
+        with open(os.path.join(self.venv, "lib", "module.py"), "w") as file:
+            file.write("VALUE = 1\n")
+        self.code = os.path.join(self.build, "simple-django-project")
+        git("init", "--quiet", self.code)
+        with open(os.path.join(self.code, "manage.py"), "w") as file:
+            file.write("print('manage')\n")
+        git("-C", self.code, "add", "manage.py")
+        git("-C", self.code, "commit", "--quiet", "-m", "initial")
+        self.artifact = os.path.join(self.root, "v1.tar.gz")
+        self.target = os.path.join(self.root, "deploy")
+        os.makedirs(self.target)
+        with mock.patch("builtins.print"):
+            compile_bytecode(self.venv, self.code)
+            package_artifact(self.build, self.venv, self.code, "v1",
+                             self.artifact)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def unpack(self):
+        with mock.patch("builtins.print"):
+            return unpack_artifact(self.artifact, self.target)
+
+    def rewrite_artifact(self, change):
+        """Rebuild the artifact, letting change() alter member contents."""
+        with tarfile.open(self.artifact, "r:gz") as tar:
+            members = [(member, tar.extractfile(member).read()
+                        if member.isfile() else None)
+                       for member in tar.getmembers()]
+        with tarfile.open(self.artifact, "w:gz") as tar:
+            for member, data in members:
+                data = change(member, data)
+                if data is not None:
+                    member.size = len(data)
+                    tar.addfile(member, io.BytesIO(data))
+                else:
+                    tar.addfile(member)
+
+    def test_round_trip_relocates_virtualenv(self):
+        """Test that an unpacked venv works from its new location."""
+        venv_path, code_dir = self.unpack()
+        self.assertEqual(read_artifact_manifest(self.artifact)["version"],
+                         "v1")
+        tool = os.path.join(venv_path, "bin", "tool")
+        with open(tool) as file:
+            self.assertEqual(file.readline().strip(),
+                             f"#!{venv_path}/bin/python3")
+        self.assertEqual(subprocess.run([tool], capture_output=True,
+                                        text=True).stdout, "tool\n")
+        self.assertTrue(os.path.exists(os.path.join(code_dir, "manage.py")))
+        self.assertFalse(os.path.exists(os.path.join(code_dir, ".git")))
+        self.assertTrue(os.listdir(os.path.join(venv_path, "lib",
+                                                "__pycache__")))
+
+    def test_modified_file_is_rejected(self):
+        """Test that a file that does not match its hash stops the deploy."""
+        def change(member, data):
+            if member.name.endswith("manage.py"):
+                return b"print('evil')\n"
+            return data
+
+        self.rewrite_artifact(change)
+        with self.assertRaises(SystemExit):
+            self.unpack()
+
+    def test_path_outside_target_is_rejected(self):
+        """Test that members escaping the target directory are refused."""
+        def change(member, data):
+            if member.name.endswith("manage.py"):
+                member.name = "../manage.py"
+            return data
+
+        self.rewrite_artifact(change)
+        with self.assertRaises(SystemExit):
+            self.unpack()
+        self.assertFalse(os.path.exists(os.path.join(self.root,
+                                                     "manage.py")))
+
+    def test_deploy_without_git(self):
+        """Test that an artifact deploys and is recorded without Git."""
+        repository = make_project(self.root, sql_rows=10, static_files=2)
+        bin_dir = install_stubs(self.root)
+        env = {
+            "PATH": bin_dir + os.pathsep + os.environ["PATH"],
+            "BENCH_REAL_GIT": shutil.which("git"),
+            "BENCH_PIP_STUB": os.path.join(bin_dir, "pip"),
+            "BENCH_FAKE_DJANGO": os.path.join(self.root, "fake-django"),
+            "DEPLOY_DB_PASSWORD": "secret",
+        }
+        status = run_deploy(["build", "--version", "v1", "--repo-url",
+                             repository, "--app-dir",
+                             os.path.join(self.root, "release"),
+                             "--artifact", self.artifact, "--no-cache"],
+                            env, self.root)[0]
+        self.assertEqual(status, 0)
+        no_git = os.path.join(self.root, "no-git")
+        os.makedirs(no_git)
+        os.symlink(os.path.join(bin_dir, "mysql"),
+                   os.path.join(no_git, "mysql"))
+        env["PATH"] = no_git
+        history = os.path.join(self.root, "history.sqlite3")
+        status, _, _, output = run_deploy(
+            ["--artifact", self.artifact, "--app-dir", self.target,
+             "--no-cache", "--db-user", "root", "--db-name", "world",
+             "--detach", "--no-ready-check", "--history", history],
+            env, self.root)
+        self.assertEqual(status, 0, output)
+        connection = sqlite3.connect(history)
+        try:
+            [(fingerprints,)] = connection.execute(
+                "SELECT fingerprints FROM deploys").fetchall()
+        finally:
+            connection.close()
+        self.assertEqual(json.loads(fingerprints)["commit"],
+                         read_artifact_manifest(self.artifact)["commit"])
+
+
+class TestStartupProfiling(unittest.TestCase):
+    """Test cases for bytecode precompilation and import profiling."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.venv, self.site = make_fake_django(self.tmp.name)
+        self.code = os.path.join(self.tmp.name, "code")
+        os.makedirs(os.path.join(self.code, ".git"))
+        for path in ("app/views.py", ".git/hook.py"):
+            path = os.path.join(self.code, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as file:
+                file.write("import json\n")
+        metrics.reset()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_code_is_compiled_except_git(self):
+        """Test that the project is precompiled, skipping .git."""
+        with mock.patch("builtins.print"):
+            compile_bytecode(self.venv, self.code)
+        self.assertTrue(os.listdir(os.path.join(self.code, "app",
+                                                "__pycache__")))
+        self.assertFalse(os.path.exists(os.path.join(self.code, ".git",
+                                                     "__pycache__")))
+
+    def test_import_times_are_reported(self):
+        """Test that -X importtime output ends up in the deploy report."""
+        with mock.patch.dict(os.environ, {"PYTHONPATH": self.site}), \
+                mock.patch("builtins.print"):
+            imports = profile_imports(self.venv, self.code, True)
+        modules = [entry["module"] for entry in imports]
+        self.assertIn("django", modules)
+        self.assertEqual(metrics.report()["import_times"]["imports"],
+                         imports)
+
+    def test_profiling_is_optional(self):
+        """Test that nothing runs without --importtime."""
+        self.assertIsNone(profile_imports(self.venv, self.code))
+        self.assertNotIn("import_times", metrics.report())
+
+
+class TestVirtualenvPool(unittest.TestCase):
+    """Test cases for the agent's pool of warm virtualenvs."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.pool = os.path.join(self.tmp.name, "pool")
+        self.code = os.path.join(self.tmp.name, "code")
+        self.app = os.path.join(self.tmp.name, "app")
+        os.makedirs(self.code)
+        os.makedirs(self.app)
+        with open(os.path.join(self.code, "requirements.txt"), "w") as file:
+            file.write("Django==3.2\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def add_ready(self, entry, name="ready-1"):
+        origin = os.path.join(entry, "building-1", "venv")
+        ready = os.path.join(entry, name)
+        os.makedirs(os.path.join(ready, "venv", "bin"))
+        with open(os.path.join(ready, "venv", "bin", "tool"), "w") as file:
+            file.write(f"#!{origin}/bin/python3\n")
+        with open(os.path.join(ready, "origin"), "w") as file:
+            file.write(origin)
+
+    def test_ready_virtualenv_is_claimed(self):
+        """Test that a warm virtualenv is moved into place and relocated."""
+        entry = pool_entry(self.pool,
+                           os.path.join(self.code, "requirements.txt"))
+        self.add_ready(entry)
+        with mock.patch("builtins.print"):
+            venv_path = claim_virtualenv(self.app, self.code, self.pool)
+        with open(os.path.join(venv_path, "bin", "tool")) as file:
+            self.assertEqual(file.read(), f"#!{venv_path}/bin/python3\n")
+        self.assertEqual(sorted(os.listdir(entry)),
+                         ["last-used", "requirements.txt"])
+
+    def test_empty_pool_builds_virtualenv(self):
+        """Test that without a warm virtualenv one is created as usual."""
+        with mock.patch("deploy.create_virtualenv") as create, \
+                mock.patch("deploy.install_dependencies") as install, \
+                mock.patch("builtins.print"):
+            venv_path = claim_virtualenv(self.app, self.code, self.pool)
+        create.assert_called_once_with(self.app)
+        install.assert_called_once_with(venv_path, self.code, None, False)
+
+    def test_refill_keeps_recent_fingerprints_warm(self):
+        """Test that recent entries are topped up and old ones dropped."""
+        entries = []
+        for age in range(4):
+            entry = os.path.join(self.pool, f"entry{age}")
+            os.makedirs(entry)
+            used = os.path.join(entry, "last-used")
+            open(used, "w").close()
+            os.utime(used, (time.time() - age * 60,) * 2)
+            entries.append(entry)
+        self.add_ready(entries[0])
+
+        with mock.patch("deploy.build_pool_virtualenv") as build, \
+                mock.patch("builtins.print"):
+            refill_pool(self.pool, size=2, keep=2)
+        built = [call.args[0] for call in build.call_args_list]
+        self.assertEqual(built, [entries[0], entries[1], entries[1]])
+        self.assertEqual(sorted(os.listdir(self.pool)), ["entry0", "entry1"])
+
+
+class TestDeployAgent(unittest.TestCase):
+    """Test cases for sending deploys to the agent over its socket."""
+
+    def test_agent_needs_the_cache(self):
+        """Test that agent mode with --no-cache is a usage error."""
+        with mock.patch("sys.stderr"), \
+                self.assertRaises(SystemExit) as raised:
+            parse_arguments(["agent", "--no-cache"])
+        self.assertEqual(raised.exception.code, 2)
+
+    def test_output_and_status_are_relayed(self):
+        """Test that the client gets the deploy's output and exit code."""
+        with tempfile.TemporaryDirectory() as tmp:
+            socket_path = os.path.join(tmp, "agent.sock")
+            agent = DeployAgent(socket_path, os.path.join(tmp, "pool"), tmp)
+            thread = threading.Thread(target=agent.serve_forever)
+            thread.start()
+            try:
+                args = mock.Mock(db_user="root", db_name="world")
+                with mock.patch.dict(os.environ,
+                                     {"DEPLOY_DB_PASSWORD": "secret"}), \
+                        mock.patch("builtins.print") as printed:
+                    status = deploy_via_agent(
+                        socket_path, ["--agent-socket", socket_path,
+                                      "--version", "v1", "--jobs", "0"],
+                        args)
+            finally:
+                agent.shutdown()
+                agent.server_close()
+                thread.join()
+        self.assertEqual(status, 2)
+        output = "".join(call.args[0] for call in printed.call_args_list)
+        self.assertIn("--jobs must be at least 1", output)
+        self.assertTrue(agent.refill.is_set())
+
+
+class TestStaticFiles(unittest.TestCase):
+    """Test cases for collecting and pre-compressing static files."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.static = os.path.join(self.root, "static")
+        self.cache = os.path.join(self.root, "cache")
+        os.makedirs(os.path.join(self.static, "css"))
+        self.css = os.path.join(self.static, "css", "site.3f2a1b.css")
+        with open(self.css, "w") as file:
+            file.write("body { margin: 0; }\n" * 100)
+        with open(os.path.join(self.static, "tiny.js"), "w") as file:
+            file.write("x = 1;\n")
+        with open(os.path.join(self.static, "logo.png"), "wb") as file:
+            file.write(b"\x89PNG" * 200)
+        with open(os.path.join(self.static, "random.js"), "wb") as file:
+            file.write(os.urandom(4096))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_text_files_are_compressed(self):
+        """Test that only compressible files get a smaller .gz copy."""
+        with mock.patch("builtins.print"):
+            compress_static(self.static, self.cache)
+        with open(self.css, "rb") as original, \
+                gzip.open(self.css + ".gz") as compressed:
+            self.assertEqual(compressed.read(), original.read())
+        for name in ("tiny.js.gz", "logo.png.gz", "random.js.gz"):
+            self.assertFalse(os.path.exists(os.path.join(self.static, name)))
+
+    def test_unchanged_files_are_not_compressed_again(self):
+        """Test that a later deploy reuses compressions from the cache."""
+        self.assertGreater(compress_static_file(self.css, self.cache), 0)
+        os.remove(self.css + ".gz")
+        self.assertEqual(compress_static_file(self.css, self.cache), 0)
+        self.assertTrue(os.path.exists(self.css + ".gz"))
+
+    def test_settings_use_hashed_storage(self):
+        """Test that settings get STATIC_ROOT and the manifest storage once."""
+        code = os.path.join(self.root, "simple-django-project")
+        os.makedirs(os.path.join(code, "panorbit"))
+        settings = os.path.join(code, "panorbit", "settings.py")
+        with open(settings, "w") as file:
+            file.write("USER = '<mysql-user>'\n")
+        with mock.patch("builtins.print"):
+            application_configuration(code, "root", "secret")
+            application_configuration(code, "root", "secret")
+        with open(settings) as file:
+            data = file.read()
+        self.assertEqual(data.count("STATIC_ROOT ="), 1)
+        self.assertIn(repr(self.static), data)
+        self.assertIn("ManifestStaticFilesStorage", data)
+        compile(data, settings, "exec")
+
+    def test_collectstatic_runs_in_the_release(self):
+        """Test that collect_static runs collectstatic and compresses."""
+        venv, site = make_fake_django(self.root)
+        code = os.path.join(self.root, "simple-django-project")
+        os.makedirs(code)
+        log = os.path.join(self.root, "django.log")
+        with mock.patch.dict(os.environ, {"PYTHONPATH": site,
+                                          "FAKE_DJANGO_LOG": log}), \
+                mock.patch("builtins.print"):
+            root = collect_static(venv, code, self.cache)
+        self.assertEqual(root, self.static)
+        with open(log) as file:
+            self.assertEqual(file.read(), "collectstatic\n")
+        self.assertTrue(os.path.exists(self.css + ".gz"))
+
+
+SETTINGS = """\
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.mysql',
+        'USER': '<mysql-user>',
+        'PASSWORD': '<mysql-password>',
+    }
+}
+TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'DIRS': [],
+    'APP_DIRS': True,
+    'OPTIONS': {'context_processors': []},
+}]
+"""
+
+
+class TestSettingsRendering(unittest.TestCase):
+    """Test cases for rendering settings.py from a performance profile."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.code = os.path.join(self.tmp.name, "simple-django-project")
+        os.makedirs(os.path.join(self.code, "panorbit"))
+        self.settings = os.path.join(self.code, "panorbit", "settings.py")
+        with open(self.settings, "w") as file:
+            file.write(SETTINGS)
+        git("init", "--quiet", self.code)
+        git("-C", self.code, "add", "panorbit/settings.py")
+        git("-C", self.code, "commit", "--quiet", "-m", "settings")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def render(self, password="secret", profile=None):
+        with mock.patch("builtins.print") as printed:
+            application_configuration(self.code, "root", password, profile)
+        return printed.call_args.args[0]
+
+    def load(self, version=(4, 2, 0)):
+        namespace = {}
+        fake_django = types.SimpleNamespace(VERSION=version)
+        with open(self.settings) as file, \
+                mock.patch.dict(sys.modules, {"django": fake_django}):
+            exec(file.read(), namespace)
+        return namespace
+
+    def test_profile_is_applied(self):
+        """Test connection reuse, caches, sessions and template caching."""
+        self.render()
+        settings = self.load()
+        database = settings["DATABASES"]["default"]
+        self.assertEqual((database["USER"], database["PASSWORD"]),
+                         ("root", "secret"))
+        self.assertEqual(database["CONN_MAX_AGE"], 600)
+        self.assertTrue(database["CONN_HEALTH_CHECKS"])
+        self.assertIn("LocMemCache",
+                      settings["CACHES"]["default"]["BACKEND"])
+        self.assertEqual(settings["SESSION_ENGINE"],
+                         "django.contrib.sessions.backends.cached_db")
+        [template] = settings["TEMPLATES"]
+        self.assertNotIn("APP_DIRS", template)
+        self.assertEqual(template["OPTIONS"]["loaders"], [
+            ("django.template.loaders.cached.Loader",
+             ["django.template.loaders.filesystem.Loader",
+              "django.template.loaders.app_directories.Loader"])])
+        self.assertIn("staticfiles", settings["STORAGES"])
+        self.assertNotIn("STORAGES", self.load(version=(3, 2, 0)))
+
+    def test_identical_output_leaves_file_alone(self):
+        """Test that an unchanged rendering does not touch settings.py."""
+        self.render()
+        before = os.stat(self.settings).st_mtime_ns
+        time.sleep(0.01)
+        self.assertIn("unchanged", self.render())
+        self.assertEqual(os.stat(self.settings).st_mtime_ns, before)
+
+    def test_rerender_starts_from_committed_settings(self):
+        """Test that a new password and profile replace the old rendering."""
+        self.render()
+        self.render(password="changed",
+                    profile=dict(load_settings_profile(), conn_max_age=0))
+        settings = self.load()
+        self.assertEqual(settings["DATABASES"]["default"]["PASSWORD"],
+                         "changed")
+        self.assertEqual(settings["DATABASES"]["default"]["CONN_MAX_AGE"], 0)
+        with open(self.settings) as file:
+            self.assertEqual(file.read().count("Rendered by deploy.py"), 1)
+
+    def test_profile_file(self):
+        """Test that a profile file overrides defaults and is validated."""
+        path = os.path.join(self.tmp.name, "profile.json")
+        with open(path, "w") as file:
+            file.write('{"session_engine": '
+                       '"django.contrib.sessions.backends.cache"}')
+        profile = load_settings_profile(path)
+        self.assertEqual(profile["session_engine"],
+                         "django.contrib.sessions.backends.cache")
+        self.assertEqual(profile["conn_max_age"], 600)
+        with open(path, "w") as file:
+            file.write('{"conn_max_ages": 1}')
+        with mock.patch("builtins.print"), self.assertRaises(SystemExit):
+            load_settings_profile(path)
+
+
+class TestReadiness(unittest.TestCase):
+    """Test cases for waiting on the started server and warming it up."""
+
+    def setUp(self):
+        self.requests = []
+        requests = self.requests
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                self.send_response(404 if self.path == "/missing" else 200)
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_ready_server_is_measured(self):
+        """Test that startup time and time to first byte are reported."""
+        started = time.perf_counter() - 1
+        process = mock.Mock()
+        process.poll.return_value = None
+        ready = wait_until_ready(self.url, started, process, timeout=5)
+        self.assertEqual(ready["status"], 200)
+        self.assertGreaterEqual(ready["startup_seconds"], 1)
+        self.assertLess(ready["first_byte_seconds"], 1)
+
+    def test_exited_server_is_not_waited_for(self):
+        """Test that polling stops when the server process exits."""
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        ready = wait_until_ready("http://127.0.0.1:9/", time.perf_counter(),
+                                 process, timeout=30)
+        self.assertIsNone(ready)
+
+    def test_warm_up_requests_each_url(self):
+        """Test that hot URLs are requested once and client errors kept."""
+        with mock.patch("builtins.print"):
+            results = warm_up(self.url, ["/", "/missing", "api/items"])
+        self.assertEqual(self.requests, ["/", "/missing", "/api/items"])
+        self.assertEqual([result["status"] for result in results],
+                         [200, 404, 200])
+
+    def test_startup_goes_into_the_report(self):
+        """Test that the readiness results are added to the metrics."""
+        metrics.reset()
+        with mock.patch("builtins.print"):
+            check_readiness(self.url, ["/"], time.perf_counter(), timeout=5)
+        startup = metrics.report()["startup"]
+        self.assertEqual(startup["url"], self.url)
+        self.assertEqual(len(startup["warm_up"]), 1)
+
+    def test_taken_over_server_is_not_timed(self):
+        """Test that no startup time is reported without a new process."""
+        with mock.patch("builtins.print") as printed:
+            ready = check_readiness(self.url, [], time.perf_counter() - 1)
+        self.assertIsNone(ready["startup_seconds"])
+        self.assertIn("not measured", printed.call_args_list[-1].args[0])
+
+    def test_busy_port_is_refused(self):
+        """Test that no server is started on a port that is in use."""
+        with mock.patch("builtins.print"), \
+                mock.patch("subprocess.Popen") as popen, \
+                self.assertRaises(SystemExit):
+            start_server("venv", "code", port=self.server.server_port)
+        popen.assert_not_called()
+
+    def test_unready_server_fails_the_deploy(self):
+        """Test that a server that never answers is stopped and fails."""
+        process = mock.Mock()
+        process.poll.return_value = None
+        with mock.patch("builtins.print"), \
+                self.assertRaises(SystemExit):
+            check_readiness("http://127.0.0.1:9/", [], time.perf_counter(),
+                            process, timeout=0.3)
+        process.terminate.assert_called_once_with()
+
+
+class TestPullCode(unittest.TestCase):
+    """Test cases for pull_code against a local bare repository."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.work, self.upstream = make_upstream(self.root)
+        self.cache = os.path.join(self.root, "cache")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_version(self, code_dir):
+        with open(os.path.join(code_dir, "version.txt")) as file:
+            return file.read()
+
+    def test_mirror_clone_of_commit_hash(self):
+        """Test cloning a commit hash through the mirror cache."""
+        first = git("-C", self.work, "rev-parse", "HEAD~1")
+        code_dir = pull_code(os.path.join(self.root, "app"), first,
+                             self.upstream, self.cache, "mirror")
+        self.assertEqual(self.read_version(code_dir), "first")
+        self.assertEqual(git("-C", code_dir, "remote", "get-url", "origin"),
+                         self.upstream)
+
+    def test_mirror_is_fetched_incrementally(self):
+        """Test that a second deploy sees commits pushed after the first."""
+        pull_code(os.path.join(self.root, "app1"), "master",
+                  self.upstream, self.cache, "mirror")
+        with open(os.path.join(self.work, "version.txt"), "w") as file:
+            file.write("third")
+        git("-C", self.work, "commit", "--quiet", "-am", "third")
+        git("-C", self.work, "push", "--quiet", self.upstream, "master")
+
+        code_dir = pull_code(os.path.join(self.root, "app2"), "master",
+                             self.upstream, self.cache, "mirror")
+        self.assertEqual(self.read_version(code_dir), "third")
+
+    def test_shallow_clone_of_tag(self):
+        """Test that shallow mode fetches a single commit."""
+        code_dir = pull_code(os.path.join(self.root, "app"), "v1",
+                             "file://" + self.upstream, None, "shallow")
+        self.assertEqual(self.read_version(code_dir), "second")
+        self.assertEqual(git("-C", code_dir, "rev-list", "--count", "HEAD"),
+                         "1")
+
+    def test_old_git_gets_a_full_clone(self):
+        """Test that a partial clone falls back to a full one before 2.19."""
+        capabilities = Capabilities("debian", {"git": {
+            "path": "git", "ok": True, "version": "2.17.1"}})
+        with mock.patch("builtins.print") as printed:
+            code_dir = pull_code(os.path.join(self.root, "app"), "v1",
+                                 "file://" + self.upstream, None, "partial",
+                                 capabilities)
+        self.assertEqual(self.read_version(code_dir), "second")
+        with open(os.path.join(code_dir, ".git", "config")) as file:
+            self.assertNotIn("promisor", file.read())
+        self.assertIn("full clone", printed.call_args_list[0].args[0])
+
+    def test_existing_checkout_is_updated_in_place(self):
+        """Test that an incremental deploy fetches and resets the clone."""
+        app_dir = os.path.join(self.root, "app")
+        code_dir = pull_code(app_dir, "v1", self.upstream, self.cache,
+                             "mirror")
+        with open(os.path.join(code_dir, "version.txt"), "w") as file:
+            file.write("edited")
+        with open(os.path.join(self.work, "version.txt"), "w") as file:
+            file.write("third")
+        git("-C", self.work, "commit", "--quiet", "-am", "third")
+        git("-C", self.work, "push", "--quiet", self.upstream, "master")
+
+        pull_code(app_dir, "v1", self.upstream, self.cache, "mirror")
+        self.assertEqual(self.read_version(code_dir), "second")
+        pull_code(app_dir, "master", self.upstream, self.cache, "mirror")
+        self.assertEqual(self.read_version(code_dir), "third")
+
+    def test_redeploy_keeps_rendered_settings(self):
+        """Test that redeploying a version does not rewrite settings.py."""
+        os.makedirs(os.path.join(self.work, "panorbit"))
+        with open(os.path.join(self.work, "panorbit", "settings.py"),
+                  "w") as file:
+            file.write(SETTINGS)
+        git("-C", self.work, "add", "panorbit/settings.py")
+        git("-C", self.work, "commit", "--quiet", "-m", "settings")
+        git("-C", self.work, "push", "--quiet", self.upstream, "master")
+
+        for mode, url in (("mirror", self.upstream),
+                          ("shallow", "file://" + self.upstream)):
+            app_dir = os.path.join(self.root, mode)
+            mtimes = []
+            for _ in range(2):
+                with mock.patch("builtins.print"):
+                    code_dir = pull_code(app_dir, "master", url, self.cache,
+                                         mode)
+                    application_configuration(code_dir, "root", "secret")
+                settings = os.path.join(code_dir, "panorbit", "settings.py")
+                mtimes.append(os.stat(settings).st_mtime_ns)
+                time.sleep(0.01)
+            self.assertEqual(mtimes[0], mtimes[1], mode)
+            with open(settings) as file:
+                self.assertIn("Rendered by deploy.py", file.read())
+
+    def test_failed_mirror_clone_is_removed(self):
+        """Test that a failed first clone leaves no temporary mirror."""
+        with mock.patch("builtins.print"), self.assertRaises(SystemExit):
+            update_mirror(os.path.join(self.root, "missing.git"), self.cache)
+        self.assertEqual(os.listdir(os.path.join(self.cache, "git")), [])
+
+    def test_concurrent_mirror_clone_is_kept(self):
+        """Test that losing the race for the first clone is not an error."""
+        with mock.patch("builtins.print"), \
+                mock.patch("os.rename", side_effect=OSError):
+            mirror = update_mirror(self.upstream, self.cache)
+        self.assertTrue(mirror.endswith(".git"))
+        self.assertEqual(os.listdir(os.path.join(self.cache, "git")), [])
+
+    def test_unknown_version_exits(self):
+        """Test that a missing version stops the deployment."""
+        with self.assertRaises(SystemExit):
+            pull_code(os.path.join(self.root, "app"), "no-such-branch",
+                      self.upstream, None, "full")
+
+
+class TestWheelhouse(unittest.TestCase):
+    """Test cases for the content-addressed wheel cache."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.requirements = os.path.join(self.root, "requirements.txt")
+        with open(self.requirements, "w") as file:
+            file.write("Django==2.2\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_requirements_share_wheelhouse(self):
+        """Test that the key depends only on file content and ABI."""
+        first = wheelhouse_path("cache", self.requirements, "cpython-311")
+        second = wheelhouse_path("cache", self.requirements, "cpython-311")
+        self.assertEqual(first, second)
+
+    def test_key_changes_with_abi_and_content(self):
+        """Test that another ABI or requirement gets another wheelhouse."""
+        base = wheelhouse_path("cache", self.requirements, "cpython-311")
+        other_abi = wheelhouse_path("cache", self.requirements, "cpython-312")
+        with open(self.requirements, "a") as file:
+            file.write("mysqlclient==2.0\n")
+        other_content = wheelhouse_path("cache", self.requirements,
+                                        "cpython-311")
+        self.assertEqual(len({base, other_abi, other_content}), 3)
+
+    def test_offline_without_cached_wheels_fails_fast(self):
+        """Test that offline mode stops when the wheelhouse is missing."""
+        venv_bin = os.path.join(self.root, "venv", "bin")
+        os.makedirs(venv_bin)
+        os.symlink(sys.executable, os.path.join(venv_bin, "python3"))
+        with self.assertRaises(SystemExit):
+            install_dependencies(os.path.dirname(venv_bin), self.root,
+                                 os.path.join(self.root, "cache"),
+                                 offline=True)
+
+
+class TestIncrementalVirtualenv(unittest.TestCase):
+    """Test cases for reusing a virtualenv between deploys."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.venv = os.path.join(self.root, "venv")
+        os.makedirs(os.path.join(self.venv, "bin"))
+        open(os.path.join(self.venv, "bin", "activate"), "w").close()
+        with open(os.path.join(self.root, "requirements.txt"), "w") as file:
+            file.write("Django==2.2\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_matching_interpreter_reuses_virtualenv(self):
+        """Test that the venv is kept when the interpreter is unchanged."""
+        write_venv_fingerprint(self.venv,
+                               {"interpreter": interpreter_fingerprint()})
+        marker = os.path.join(self.venv, "marker")
+        open(marker, "w").close()
+        self.assertEqual(create_virtualenv(self.root, incremental=True),
+                         self.venv)
+        self.assertTrue(os.path.exists(marker))
+
+    def test_unchanged_requirements_skip_install(self):
+        """Test that pip is not run for an already populated venv."""
+        requirements = os.path.join(self.root, "requirements.txt")
+        write_venv_fingerprint(self.venv,
+                               {"requirements": file_sha256(requirements)})
+        install_dependencies(self.venv, self.root, incremental=True)
+
+    def test_changed_requirements_are_installed(self):
+        """Test that a changed requirements.txt is not skipped."""
+        write_venv_fingerprint(self.venv, {"requirements": "outdated"})
+        with self.assertRaises(FileNotFoundError):
+            install_dependencies(self.venv, self.root, incremental=True)
+
+
+class TestSqlImport(unittest.TestCase):
+    """Test cases for the streaming world.sql import."""
+
+    def test_statements_split_outside_quotes_and_comments(self):
+        """Test that ';' inside strings and comments does not split."""
+        dump = [
+            "-- comment; with semicolon\n",
+            "/*!40101 SET NAMES utf8 */;\n",
+            "INSERT INTO `t` VALUES (1,'a;b'),\n",
+            "(2,'it''s \\'quoted\\';');\n",
+            "/* block; comment */ DROP TABLE x;\n",
+        ]
+        self.assertEqual(list(iter_sql_statements(dump)), [
+            "/*!40101 SET NAMES utf8 */;",
+            "INSERT INTO `t` VALUES (1,'a;b'),\n"
+            "(2,'it''s \\'quoted\\';');",
+            "DROP TABLE x;",
+        ])
+
+    def test_single_row_inserts_are_merged(self):
+        """Test that consecutive INSERTs become one multi-row INSERT."""
+        statements = [
+            "INSERT INTO `city` VALUES (1,'Kabul');",
+            "INSERT INTO `city` VALUES (2,'Qandahar');",
+            "INSERT INTO `country` VALUES ('AFG');",
+            "COMMIT;",
+        ]
+        self.assertEqual(list(coalesce_inserts(statements)), [
+            ("INSERT INTO `city` VALUES (1,'Kabul'),(2,'Qandahar');", 2),
+            ("INSERT INTO `country` VALUES ('AFG');", 1),
+            ("COMMIT;", 0),
+        ])
+
+    def test_import_streams_batched_transactions(self):
+        """Test the statements a fake mysql client receives."""
+        with tempfile.TemporaryDirectory() as root:
+            sql_file = os.path.join(root, "world.sql")
+            received = os.path.join(root, "received.sql")
+            with open(sql_file, "w") as file:
+                file.write("CREATE TABLE `city` (id int);\n")
+                for row in range(5):
+                    file.write(f"INSERT INTO `city` VALUES ({row});\n")
+
+            statements, rows, _ = import_sql_dump(
+                sql_file, [sys.executable, "-c", FAKE_MYSQL, received, "0"],
+                batch_rows=2)
+            with open(received) as file:
+                sent = file.read()
+
+        self.assertEqual((statements, rows), (2, 5))
+        self.assertIn("SET foreign_key_checks=0;", sent)
+        self.assertIn("INSERT INTO `city` VALUES (0),(1),(2),(3),(4);\n"
+                      "COMMIT;", sent)
+
+    def test_failed_import_exits(self):
+        """Test that a failing client stops the deployment."""
+        with tempfile.TemporaryDirectory() as root:
+            sql_file = os.path.join(root, "world.sql")
+            with open(sql_file, "w") as file:
+                file.write("SELECT 1;\n")
+            with self.assertRaises(SystemExit):
+                import_sql_dump(sql_file, [sys.executable, "-c", FAKE_MYSQL,
+                                           os.devnull, "1"])
+
+    def test_step_timeout_stops_import(self):
+        """Test that a hanging client is killed and fails the import."""
+        with tempfile.TemporaryDirectory() as root:
+            sql_file = os.path.join(root, "world.sql")
+            with open(sql_file, "w") as file:
+                file.write("SELECT 1;\n")
+            started = time.monotonic()
+            with mock.patch.dict("deploy._step_timeouts",
+                                 {"db_setting": 0.5}), \
+                    mock.patch("builtins.print"), \
+                    self.assertRaises(SystemExit), \
+                    measure_stage("db_setting"):
+                import_sql_dump(sql_file, [sys.executable, "-c",
+                                           "import time; time.sleep(30)"])
+        self.assertLess(time.monotonic() - started, 10)
+
+
+class TestParallelSqlImport(unittest.TestCase):
+    """Test cases for the per-table parallel import."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.sql_file = os.path.join(self.root, "world.sql")
+        with open(self.sql_file, "w") as file:
+            file.write(WORLD_DUMP)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, path):
+        with open(path) as file:
+            return file.read()
+
+    def test_dump_is_split_by_table(self):
+        """Test which statements end up in which segment."""
+        ddl, tables, post = split_sql_dump(self.sql_file, self.root)
+        self.assertIn("CREATE TABLE `country`", self.read(ddl))
+        self.assertNotIn("INSERT", self.read(ddl))
+        self.assertEqual(len(tables), 2)
+        city = self.read(tables[0])
+        self.assertTrue(city.startswith("SET NAMES utf8;"))
+        self.assertNotIn("LOCK TABLES", city)
+        self.assertEqual(city.count("INSERT INTO `city`"), 2)
+        self.assertIn("ADD CONSTRAINT", self.read(post))
+
+    def test_each_table_gets_its_own_session(self):
+        """Test that DDL, both tables and constraints use 4 sessions."""
+        sessions = os.path.join(self.root, "sessions")
+        os.makedirs(sessions)
+        statements, rows, _ = import_sql_dump_parallel(
+            self.sql_file,
+            [sys.executable, "-c", FAKE_MYSQL_SESSIONS, sessions], jobs=2)
+        received = [self.read(os.path.join(sessions, name))
+                    for name in os.listdir(sessions)]
+        self.assertEqual(len(received), 4)
+        self.assertEqual(rows, 3)
+        self.assertTrue(all("SET foreign_key_checks=0;" in text
+                            for text in received))
+
+
+class TestDatabaseSnapshot(unittest.TestCase):
+    """Test cases for skipping an unchanged world.sql import."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        with open(os.path.join(self.root, "world.sql"), "w") as file:
+            file.write(WORLD_DUMP)
+        bin_dir = os.path.join(self.root, "bin")
+        install_fake(bin_dir, "mysql", FAKE_MYSQL_CLIENT)
+        self.log = os.path.join(self.root, "mysql.log")
+        self.env = mock.patch.dict(os.environ, {
+            "PATH": bin_dir + os.pathsep + os.environ["PATH"],
+            "FAKE_MYSQL_LOG": self.log,
+        })
+        self.env.start()
+        self.cache = os.path.join(self.root, "cache")
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def imports(self):
+        with open(self.log) as file:
+            return file.read().split().count("import")
+
+    def setting(self, **kwargs):
+        db_setting(self.root, "root", "secret", "world",
+                   cache_dir=self.cache, **kwargs)
+
+    def test_unchanged_dump_is_not_imported_again(self):
+        """Test that the second deploy skips the import."""
+        self.setting()
+        self.setting()
+        self.assertEqual(self.imports(), 1)
+
+    def test_changed_database_is_imported_again(self):
+        """Test that a different table checksum triggers the import."""
+        self.setting()
+        with mock.patch.dict(os.environ, {"FAKE_MYSQL_CHECKSUM": "7"}):
+            self.setting()
+        self.assertEqual(self.imports(), 2)
+
+    def test_force_import(self):
+        """Test that force_import ignores the snapshot."""
+        self.setting()
+        self.setting(force_import=True)
+        self.assertEqual(self.imports(), 2)
+
+    def test_parallel_sessions_count_towards_the_stage(self):
+        """Test that per-table sessions are attributed to db_setting."""
+        metrics.reset()
+        run_stages([Stage("db_setting", lambda: self.setting(sql_jobs=2))],
+                   {})
+        report = metrics.report()
+        self.assertEqual(self.imports(), 4)
+        self.assertEqual({command["stage"] for command in report["commands"]},
+                         {"db_setting"})
+        [stage] = report["stages"]
+        self.assertGreater(stage["max_rss_kb"], 0)
+
+
+class TestMigrationSkipping(unittest.TestCase):
+    """Test cases for skipping unchanged migrations."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.venv, site = make_fake_django(self.root)
+        self.code = os.path.join(self.root, "code")
+        os.makedirs(os.path.join(self.code, "world", "migrations"))
+        open(os.path.join(self.code, "manage.py"), "w").close()
+        self.model = os.path.join(self.code, "world", "models.py")
+        with open(self.model, "w") as file:
+            file.write("class City: pass\n")
+
+        bin_dir = os.path.join(self.root, "bin")
+        install_fake(bin_dir, "mysql", FAKE_MYSQL_CLIENT)
+        self.log = os.path.join(self.root, "django.log")
+        self.env = mock.patch.dict(os.environ, {
+            "PATH": bin_dir + os.pathsep + os.environ["PATH"],
+            "PYTHONPATH": site,
+            "FAKE_MYSQL_LOG": os.path.join(self.root, "mysql.log"),
+            "FAKE_DJANGO_LOG": self.log,
+        })
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def migrate(self, **kwargs):
+        run_migrations(self.venv, self.code, "root", "", "world",
+                       os.path.join(self.root, "cache"), **kwargs)
+        with open(self.log) as file:
+            return file.read().splitlines().count("migrate")
+
+    def test_unchanged_project_skips_migrate(self):
+        """Test that the second run only rebuilds the index."""
+        self.migrate()
+        self.assertEqual(self.migrate(), 1)
+
+    def test_second_run_updates_index_incrementally(self):
+        """Test that only the first run rebuilds the search index."""
+        self.migrate()
+        self.migrate()
+        with open(self.log) as file:
+            commands = file.read().splitlines()
+        self.assertEqual(commands[-1], "update_index")
+        self.assertEqual(commands.count("rebuild_index"), 1)
+
+    def test_changed_models_run_migrate(self):
+        """Test that editing models.py triggers migrations again."""
+        self.migrate()
+        with open(self.model, "a") as file:
+            file.write("class Country: pass\n")
+        self.assertEqual(self.migrate(), 2)
+
+    def test_force_migrate(self):
+        """Test that force_migrate ignores the recorded state."""
+        self.migrate()
+        self.assertEqual(self.migrate(force_migrate=True), 2)
+
+
+class TestManagementRunner(unittest.TestCase):
+    """Test cases for running management commands in one process."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.venv, site = make_fake_django(self.root)
+        self.log = os.path.join(self.root, "django.log")
+        self.env = mock.patch.dict(os.environ, {
+            "PYTHONPATH": site,
+            "FAKE_DJANGO_LOG": self.log,
+        })
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def test_commands_share_one_process(self):
+        """Test per-command status and timing for a successful run."""
+        results = run_management_commands(self.venv, self.root, [
+            management_command("makemigrations", interactive=False),
+            management_command("migrate"),
+        ])
+        self.assertEqual([r["command"] for r in results],
+                         ["makemigrations", "migrate"])
+        self.assertTrue(all(r["ok"] and r["seconds"] >= 0 for r in results))
+
+    def test_critical_failure_stops_remaining_commands(self):
+        """Test that commands after a failed critical one do not run."""
+        with mock.patch.dict(os.environ, {"FAKE_DJANGO_FAIL": "migrate"}):
+            results = run_management_commands(self.venv, self.root, [
+                management_command("migrate"),
+                management_command("rebuild_index"),
+            ])
+        self.assertEqual(len(results), 1)
+        self.assertIn("migrate exploded", results[0]["error"])
+
+    def test_non_critical_failure_continues(self):
+        """Test that a failing non-critical command is only reported."""
+        with mock.patch.dict(os.environ,
+                             {"FAKE_DJANGO_FAIL": "rebuild_index"}):
+            results = run_management_commands(self.venv, self.root, [
+                management_command("rebuild_index", critical=False),
+                management_command("check"),
+            ])
+        self.assertEqual([r["ok"] for r in results], [False, True])
+
+    def test_output_without_newline_keeps_results(self):
+        """Test that output lacking a final newline still yields results."""
+        with mock.patch.dict(os.environ, {"FAKE_DJANGO_PARTIAL": "check"}):
+            results = run_management_commands(self.venv, self.root, [
+                management_command("check"),
+            ])
+        self.assertEqual([r["ok"] for r in results], [True])
+
+
+class TestSearchIndexCommand(unittest.TestCase):
+    """Test cases for choosing between rebuild_index and update_index."""
+
+    def test_first_run_rebuilds(self):
+        """Test that without a previous run the index is rebuilt."""
+        command = search_index_command({}, "schema", 1000.0, workers=4)
+        self.assertEqual(command["name"], "rebuild_index")
+        self.assertEqual(command["options"]["workers"], 4)
+
+    def test_unchanged_schema_updates_recent_records(self):
+        """Test that the update covers the time since the last run."""
+        state = {"schema": "schema", "updated_at": 0.0}
+        command = search_index_command(state, "schema", 3 * 3600.0 + 5,
+                                       batch_size=500)
+        self.assertEqual(command["name"], "update_index")
+        self.assertEqual(command["options"]["age"], 4)
+        self.assertEqual(command["options"]["batchsize"], 500)
+
+    def test_changed_schema_rebuilds(self):
+        """Test that new index definitions force a full rebuild."""
+        state = {"schema": "old", "updated_at": 0.0}
+        command = search_index_command(state, "new", 60.0)
+        self.assertEqual(command["name"], "rebuild_index")
+
+    def test_fresh_checkout_rebuilds(self):
+        """Test that an index built for a removed checkout is rebuilt."""
+        with tempfile.TemporaryDirectory() as root:
+            app_dir = os.path.join(root, "project-dir")
+            code_dir = os.path.join(app_dir, "simple-django-project")
+            os.makedirs(code_dir)
+            location = search_index_location(code_dir)
+            self.assertEqual(search_index_location(code_dir), location)
+            state = {"schema": "schema", "updated_at": 0.0,
+                     "location": location}
+            command = search_index_command(state, "schema", 60.0,
+                                           location=location)
+            self.assertEqual(command["name"], "update_index")
+
+            shutil.rmtree(app_dir)
+            os.makedirs(code_dir)
+            command = search_index_command(
+                state, "schema", 60.0,
+                location=search_index_location(code_dir))
+        self.assertEqual(command["name"], "rebuild_index")
+
+
+class TestGunicornServer(unittest.TestCase):
+    """Test cases for the pre-fork server mode."""
+
+    def test_command_sizes_pool_and_recycles_workers(self):
+        """Test the gunicorn options derived from the arguments."""
+        command = gunicorn_command("venv", "code", port=9000, threads=4,
+                                   max_requests=500)
+        self.assertEqual(command[:2],
+                         [os.path.join("venv", "bin", "python3"),
+                          os.path.join("venv", "bin", "gunicorn")])
+        self.assertEqual(command[command.index("--workers") + 1],
+                         str(default_workers()))
+        self.assertEqual(command[command.index("--threads") + 1], "4")
+        self.assertEqual(command[command.index("--max-requests") + 1], "500")
+        self.assertIn("0.0.0.0:9000", command)
+        self.assertEqual(command[-1], "panorbit.wsgi:application")
+
+    def test_running_master_is_reloaded(self):
+        """Test that a redeploy sends SIGHUP instead of starting a server."""
+        master = subprocess.Popen([sys.executable, "-c",
+                                   "import time; print('ready', flush=True);"
+                                   " time.sleep(30)",
+                                   "gunicorn"],
+                                  stdout=subprocess.PIPE)
+        master.stdout.readline()
+        master.stdout.close()
+        with tempfile.TemporaryDirectory() as root:
+            pid_file = os.path.join(root, "gunicorn.pid")
+            with open(pid_file, "w") as file:
+                file.write(str(master.pid))
+            start_server("venv", "code", "gunicorn", pid_file=pid_file)
+        self.assertEqual(master.wait(timeout=10), -1)
+
+
+class TestInstances(unittest.TestCase):
+    """Test cases for running several instances on one host."""
+
+    def test_cpus_are_split_between_instances(self):
+        """Test that each instance gets its own neighbouring CPUs."""
+        with mock.patch("os.sched_getaffinity", create=True,
+                        return_value={0, 1, 2, 3, 4}):
+            self.assertEqual(cpu_sets(2), [{0, 1, 2}, {3, 4}])
+            self.assertEqual(cpu_sets(7), [{0}, {1}, {2}, {3}, {4},
+                                           {0}, {1}])
+
+    def test_instances_get_ports_pid_files_and_workers(self):
+        """Test the per-instance server options."""
+        args = parse_arguments(["--version", "v1", "--instances", "2",
+                                "--server", "gunicorn", "--port", "9000"])
+        with mock.patch("os.sched_getaffinity", create=True,
+                        return_value={0, 1, 2, 3}), \
+                mock.patch("deploy.start_server") as start:
+            instances = start_instances("venv", "code", args)
+        self.assertEqual([instance["port"] for instance in instances],
+                         [9000, 9001])
+        first, second = (call.args for call in start.call_args_list)
+        self.assertEqual(first[3:5], (9000, 5))
+        self.assertEqual(second[7], "gunicorn-9001.pid")
+        self.assertEqual(start.call_args_list[1].kwargs["cpus"], {2, 3})
+
+    @unittest.skipUnless(hasattr(os, "sched_setaffinity"),
+                         "CPU affinity is not supported")
+    def test_server_is_pinned(self):
+        """Test that the started server runs on its CPU set only."""
+        cpu = min(os.sched_getaffinity(0))
+        with tempfile.TemporaryDirectory() as root:
+            venv, code = make_fake_django(root)
+            with open(os.path.join(code, "manage.py"), "w") as file:
+                file.write("import os\n"
+                           "print(sorted(os.sched_getaffinity(0)))\n")
+            with mock.patch("builtins.print"):
+                process = start_server(venv, code, port=9000, detach=True,
+                                       cpus={cpu}, log_name="server-9000.log")
+            process.wait(timeout=30)
+            with open(os.path.join(root, "server-9000.log")) as file:
+                self.assertEqual(file.read().strip(), f"[{cpu}]")
+
+    def test_upstream_lists_every_instance(self):
+        """Test the load balancer upstream written for the instances."""
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "nginx-upstream.conf")
+            with mock.patch("builtins.print"):
+                write_upstream_config(path, [8001, 8002])
+            with open(path) as file:
+                config = file.read()
+        self.assertIn("upstream django {", config)
+        self.assertIn("server 127.0.0.1:8001 ", config)
+        self.assertIn("server 127.0.0.1:8002 ", config)
+
+    def test_ready_url_follows_the_instance_port(self):
+        """Test that only URLs on --port are moved to the instance's port."""
+        self.assertEqual(instance_url("http://127.0.0.1:8001/health", 8001,
+                                      8003), "http://127.0.0.1:8003/health")
+        self.assertEqual(instance_url("http://lb.local/", 8001, 8003),
+                         "http://lb.local/")
+
+
+class TestReleases(unittest.TestCase):
+    """Test cases for release directories and the current symlink."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app_dir = os.path.join(self.tmp.name, "project-dir")
+        self.releases = []
+        for stamp in ("20260101000000", "20260102000000", "20260103000000"):
+            release = os.path.join(self.app_dir, "releases", f"v1-{stamp}")
+            os.makedirs(release)
+            self.releases.append(release)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_new_release_directory_per_deploy(self):
+        """Test that the same version gets a fresh directory each time."""
+        first = create_directory(self.app_dir, releases=True, version="v2")
+        second = create_directory(self.app_dir, releases=True, version="v2")
+        self.assertNotEqual(first, second)
+        self.assertTrue(os.path.isdir(second))
+        self.assertEqual(list_releases(self.app_dir)[-1], second)
+
+    def test_activate_switches_symlink(self):
+        """Test that current points at the activated release."""
+        activate_release(self.app_dir, self.releases[0])
+        activate_release(self.app_dir, self.releases[2])
+        self.assertEqual(current_release(self.app_dir),
+                         os.path.realpath(self.releases[2]))
+
+    def test_rollback_to_previous_release(self):
+        """Test that rollback moves current one release back."""
+        activate_release(self.app_dir, self.releases[2])
+        rollback_release(self.app_dir)
+        self.assertEqual(current_release(self.app_dir),
+                         os.path.realpath(self.releases[1]))
+
+    def test_rollback_without_earlier_release_exits(self):
+        """Test that the oldest release cannot be rolled back."""
+        activate_release(self.app_dir, self.releases[0])
+        with self.assertRaises(SystemExit):
+            rollback_release(self.app_dir)
+
+    def test_prune_keeps_current_release(self):
+        """Test that pruning never removes the live release."""
+        activate_release(self.app_dir, self.releases[0])
+        prune_releases(self.app_dir, keep=1)
+        remaining = [os.path.realpath(path)
+                     for path in list_releases(self.app_dir)]
+        self.assertEqual(remaining,
+                         [os.path.realpath(self.releases[0]),
+                          os.path.realpath(self.releases[2])])
+
+    def test_handoff_replaces_master(self):
+        """Test that the old master is stopped once the new one is up."""
+        pid_file = os.path.join(self.tmp.name, "gunicorn.pid")
+        master = subprocess.Popen([sys.executable, "-c",
+                                   FAKE_GUNICORN_MASTER, pid_file,
+                                   "gunicorn"],
+                                  stdout=subprocess.PIPE)
+        master.stdout.readline()
+        master.stdout.close()
+        handoff_server(master.pid, pid_file, timeout=10)
+        self.assertEqual(master.wait(timeout=10), -15)
+        with open(pid_file) as file:
+            os.kill(int(file.read()), 15)
+
+
+class TestBenchmark(unittest.TestCase):
+    """Test cases for the deploy benchmark harness."""
+
+    def test_repeated_deploys_are_timed(self):
+        """Test that every stage of every run is reported."""
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "bench.json")
+            with mock.patch("builtins.print"):
+                status = bench_main(["--runs", "2", "--sql-rows", "100",
+                                     "--static-files", "2", "--work-dir",
+                                     os.path.join(root, "work"),
+                                     "--json", path])
+            with open(path) as file:
+                result = json.load(file)
+        self.assertEqual(status, 0)
+        self.assertEqual(len(result["runs"]), 2)
+        for stage in ("pull_code", "install_dependencies", "db_setting",
+                      "run_migrations", "collect_static"):
+            self.assertIn(stage, result["stages"])
+
+    def test_slower_stages_are_found(self):
+        """Test that stages slower than in the baseline are listed."""
+        baseline = {"stages": {"pull_code": {"median": 1.0},
+                               "db_setting": {"median": 1.0}},
+                    "total": {"median": 2.0}}
+        summary = {"stages": {"pull_code": {"median": 2.0},
+                              "db_setting": {"median": 1.1}},
+                   "total": {"median": 3.1}}
+        self.assertEqual(compare_baseline(summary, baseline),
+                         [("pull_code", 2.0, 1.0), ("Total", 3.1, 2.0)])
+
+
+if __name__ == "__main__":
+    unittest.main()